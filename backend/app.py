@@ -16,7 +16,10 @@ from werkzeug.utils import secure_filename
 from typing import List, Dict, Any, Optional
 import os.path as osp
 import random
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify, Response, stream_with_context, make_response
 from flask_cors import CORS, cross_origin
@@ -105,7 +108,7 @@ CORS(
             ],
             "methods": ["GET", "POST", "OPTIONS"],
             "allow_headers": ["Content-Type", "Authorization", "Accept", "X-Requested-With", "X-Session-Id"],
-            "expose_headers": ["Content-Type"],
+            "expose_headers": ["Content-Type", "X-TTS-Chunks", "X-TTS-Cache"],
             "supports_credentials": True,
             "max_age": 86400,
         },
@@ -346,7 +349,7 @@ CORS(
             ],
             "methods": ["POST", "OPTIONS"],
             "allow_headers": ["Content-Type", "Authorization", "Accept", "X-Requested-With", "X-Session-Id"],
-            "expose_headers": ["Content-Type"],
+            "expose_headers": ["Content-Type", "X-Interaction-Pairs", "X-Interaction-Cached", "X-Interaction-Pending"],
             "supports_credentials": True,
             "max_age": 86400,
         },
@@ -656,11 +659,19 @@ def _extract_json_dict(text: str):
             except Exception:
                 pass
     return None
-def _build_drg_validation_prompt(second_json: dict, patient_id: str):
+def _build_drg_validation_prompt(second_json: dict, patient_id: str, candidates: list | None = None):
     """
     Ask the model (through RAG) to validate against the DRG master embedded in Qdrant.
     Return STRICT JSON ONLY with the exact table schema the UI expects.
+    `candidates` (local DRG master rows for the principal diagnosis) narrow the choice when given.
     """
+    hint = ""
+    if candidates:
+        hint = (
+            "Candidate DRGs from the local DRG master for this principal diagnosis "
+            "(choose among these unless the documentation clearly supports another):\n"
+            + "\n".join(f"- {c['code']}: {c['label']}" for c in candidates) + "\n\n"
+        )
     return (
         "DRG VALIDATOR (STRICT JSON ONLY)\n"
         "You are validating Diagnosis-Related Group (DRG) coding using knowledge retrieved from the DRG master "
@@ -685,6 +696,7 @@ def _build_drg_validation_prompt(second_json: dict, patient_id: str):
         "- Obvious mismatches => FLAGGED with action=['Fix'] and concrete suggested_fixes_md.\n"
         "- When correct & sufficient => VALIDATED with nphies='Ready' and action=['Submit'].\n"
         "- Prefer the most appropriate DRG; include the human-readable label.\n\n"
+        f"{hint}"
         f"Patient ID: {patient_id}\n"
         "AI Second Opinion JSON:\n"
         f"{json.dumps(second_json, ensure_ascii=False)}\n"
@@ -740,8 +752,49 @@ def speech_to_text(audio_data_path):
         )
     return {"text": transcript}
 
+
+# ---------- Long recordings: split at silences, transcribe chunks in parallel, stitch ----------
+import audio_chunker
+
+TRANSCRIBE_MEM_MAX_BYTES = int(os.getenv("TRANSCRIBE_MEM_MAX_BYTES", str(25 * 1024 * 1024)))  # else temp file
+TRANSCRIBE_AUTO_CHUNK_BYTES = int(os.getenv("TRANSCRIBE_AUTO_CHUNK_BYTES", str(4 * 1024 * 1024)))
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", "4"))
+TRANSCRIBE_POOL = ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix="transcribe")
+
+
+def _transcribe_bytes(data: bytes, filename: str) -> str:
+    """whisper-1 on in-memory audio (no temp file)."""
+    return client.audio.transcriptions.create(
+        model="whisper-1",
+        response_format="text",
+        file=(filename, data),
+    )
+
+
+def _transcribe_chunked(src, ext: str):
+    """(text, chunks) for upload bytes or a temp-file path; None when the audio can't be decoded/split here."""
+    decoded = audio_chunker.decode(src, ext)
+    if decoded is None:
+        return None
+    pcm, sr = decoded
+    spans = audio_chunker.split_points(pcm, sr)
+    if len(spans) < 2:
+        return None
+    futures = [TRANSCRIBE_POOL.submit(_transcribe_bytes, audio_chunker.wav_bytes(pcm[a:b], sr), f"chunk{i}.wav")
+               for i, (a, b) in enumerate(spans)]
+    texts = [str(f.result() or "").strip() for f in futures]
+    return audio_chunker.stitch(texts), len(spans)
+
+
 @app.route("/transcribe", methods=["POST"])
 def transcribe():
+    """
+    multipart: audio_data (file), optional mode = auto | chunked | single.
+    chunked splits long audio at silences and transcribes the chunks in parallel (TRANSCRIBE_WORKERS);
+    auto does so for uploads over TRANSCRIBE_AUTO_CHUNK_BYTES. Uploads up to TRANSCRIBE_MEM_MAX_BYTES are
+    handled in memory; larger ones are saved to a temp file and chunked from there (one call only when
+    the file can't be decoded here).
+    """
     if "audio_data" not in request.files:
         return jsonify({"error": "No audio file provided"}), 400  
     audio_file = request.files["audio_data"]
@@ -749,15 +802,37 @@ def transcribe():
     file_extension = audio_file.filename.split('.')[-1].lower()
     if file_extension not in supported_formats:
         return jsonify({"error": f"Unsupported file format: {file_extension}. Supported formats: {supported_formats}"}), 400
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_extension}") as temp_audio:
-        audio_file.save(temp_audio.name)
-        temp_audio_path = temp_audio.name
+    mode = (request.form.get("mode") or "auto").strip().lower()
+
+    t0 = time.perf_counter()
+    size = request.content_length or 0
+    temp_audio_path = None
+    if size and size <= TRANSCRIBE_MEM_MAX_BYTES:
+        src = audio_file.read()
+        size = len(src)
+    else:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_extension}") as temp_audio:
+            audio_file.save(temp_audio.name)
+            temp_audio_path = src = temp_audio.name
+        size = os.path.getsize(temp_audio_path)
     try:
-        transcript_result = speech_to_text(temp_audio_path)
+        chunked = None
+        if mode == "chunked" or (mode == "auto" and size > TRANSCRIBE_AUTO_CHUNK_BYTES):
+            try:
+                chunked = _transcribe_chunked(src, file_extension)
+            except Exception as e:
+                log.warning(f"chunked transcription failed, retrying as one call: {e}")
+        if chunked:
+            text, chunks = chunked
+        elif temp_audio_path:
+            text, chunks = str(speech_to_text(temp_audio_path).get("text") or ""), 1
+        else:
+            text, chunks = str(_transcribe_bytes(src, f"audio.{file_extension}") or ""), 1
     finally:
-        os.remove(temp_audio_path)
-
-    return jsonify({"transcript": transcript_result.get("text", "")})
+        if temp_audio_path:
+            os.remove(temp_audio_path)
+    return jsonify({"transcript": text, "chunks": chunks,
+                    "ms": round((time.perf_counter() - t0) * 1000, 1)})
 
 
 
@@ -953,19 +1028,141 @@ def generate():
 
     return jsonify({"response": answer, "session_id": session_id})
 
+# ---------- Text-to-speech (streamed, content-hash cached) ----------
+import tts_cache
+
+TTS_MODEL = os.getenv("TTS_MODEL", "tts-1")
+TTS_VOICE = os.getenv("TTS_VOICE", "fable")
+TTS_CHUNK_BYTES = 16 * 1024
+TTS_MIN_SENTENCE_CHARS = int(os.getenv("TTS_MIN_SENTENCE_CHARS", "40"))  # shorter pieces join the next one
+TTS_LOOKAHEAD = int(os.getenv("TTS_LOOKAHEAD", "2"))                    # sentences synthesized ahead of playback
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "8"))                # "sentences" requests prefetching at once
+# Each request keeps at most TTS_LOOKAHEAD prefetches in flight, so concurrent requests don't queue behind
+# each other until more than TTS_CONCURRENCY of them are prefetching.
+TTS_POOL = ThreadPoolExecutor(max_workers=max(1, TTS_CONCURRENCY) * max(1, TTS_LOOKAHEAD), thread_name_prefix="tts")
+_TTS_SENTENCE_RX = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+
+def _tts_sentences(text: str) -> list[str]:
+    out, buf = [], ""
+    for part in _TTS_SENTENCE_RX.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        buf = f"{buf} {part}".strip()
+        if len(buf) >= TTS_MIN_SENTENCE_CHARS:
+            out.append(buf)
+            buf = ""
+    if buf:
+        if out and len(buf) < TTS_MIN_SENTENCE_CHARS:
+            out[-1] = f"{out[-1]} {buf}"
+        else:
+            out.append(buf)
+    return out
+
+
+def _tts_key(text: str, voice: str):
+    return tts_cache.cache_key(text, model=TTS_MODEL, voice=voice, fmt="mp3")
+
+
+def _tts_stream(text: str, voice: str, check_cache: bool = True):
+    """Audio bytes for `text` as they arrive from the provider (cached audio is replayed); caches on completion."""
+    key = _tts_key(text, voice)
+    cached = tts_cache.get(key) if check_cache else None
+    if cached is not None:
+        for i in range(0, len(cached), TTS_CHUNK_BYTES):
+            yield cached[i:i + TTS_CHUNK_BYTES]
+        return
+    parts = []
+    with client.audio.speech.with_streaming_response.create(
+        model=TTS_MODEL, voice=voice, input=text, response_format="mp3"
+    ) as resp:
+        for chunk in resp.iter_bytes(chunk_size=TTS_CHUNK_BYTES):
+            if chunk:
+                parts.append(chunk)
+                yield chunk
+    tts_cache.put(key, b"".join(parts))
+
+
+def _tts_bytes(text: str, voice: str) -> bytes:
+    return b"".join(_tts_stream(text, voice))
+
+
 @app.route("/tts", methods=["POST"])
 def tts():
-    text = (request.json or {}).get("text", "").strip()
+    """
+    Body: { "text": "...", "voice"?: "fable", "mode"?: "stream" | "sentences", "format"?: "base64" }
+    -> audio/mpeg streamed as it is synthesized (no temp file). "sentences" synthesizes sentence by sentence
+       (TTS_LOOKAHEAD ahead) so playback starts after the first one. "format": "base64" keeps the old JSON
+       response {"audio_base64": ...}. Repeated phrases are served from tts_cache.
+    """
+    d = request.get_json(silent=True) or {}
+    text = str(d.get("text") or "").strip()
     if not text:
         return jsonify({"error": "No text supplied"}), 400
+    voice = str(d.get("voice") or TTS_VOICE).strip().lower()
+    mode = str(d.get("mode") or "stream").strip().lower()
+
+    if str(d.get("format") or "").lower() == "base64":
+        try:
+            audio_bytes = _tts_bytes(text, voice)
+        except Exception as e:
+            return jsonify({"error": f"TTS failed: {e}"}), 502
+        return jsonify({"audio_base64": base64.b64encode(audio_bytes).decode("utf-8")})
+
+    if mode != "sentences":
+        cached = tts_cache.get(_tts_key(text, voice))
+        if cached is not None:
+            resp = Response(cached, mimetype="audio/mpeg")
+            resp.headers["X-TTS-Cache"] = "hit"
+            resp.headers["X-TTS-Chunks"] = "1"
+            return resp
+    pieces = _tts_sentences(text) if mode == "sentences" else [text]
+    ahead = {}
+
+    def prefetch(upto: int):
+        for j in range(1, min(upto, len(pieces) - 1) + 1):
+            if j not in ahead:
+                ahead[j] = TTS_POOL.submit(_tts_bytes, pieces[j], voice)
+
+    # Start the first piece before answering so a provider failure is still a JSON error, not an empty 200
+    prefetch(TTS_LOOKAHEAD)
+    head = _tts_stream(pieces[0], voice, check_cache=mode == "sentences")
+    try:
+        first = next(head, b"")
+    except Exception as e:
+        for fut in ahead.values():
+            fut.cancel()
+        log.warning(f"TTS failed: {e}")
+        return jsonify({"error": f"TTS failed: {e}"}), 502
+
+    def generate():
+        try:
+            # first piece streams straight through; the rest were synthesized while it played
+            yield first
+            for chunk in head:
+                yield chunk
+            for i in range(1, len(pieces)):
+                prefetch(i + TTS_LOOKAHEAD)
+                yield ahead.pop(i).result()
+        except Exception as e:
+            log.warning(f"TTS stream failed: {e}")
+        finally:
+            head.close()
+            for fut in ahead.values():
+                fut.cancel()
+
+    resp = Response(stream_with_context(generate()), mimetype="audio/mpeg")
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-TTS-Chunks"] = str(len(pieces))
+    resp.headers["X-TTS-Cache"] = "miss" if mode != "sentences" else "per-sentence"
+    return resp
 
-    response = client.audio.speech.create(model="tts-1", voice="fable", input=text)
-    audio_file = "temp_audio.mp3"
-    response.stream_to_file(audio_file)
-    with open(audio_file, "rb") as f:
-        audio_bytes = f.read()
-    audio_base64 = base64.b64encode(audio_bytes).decode("utf-8")
-    return jsonify({"audio_base64": audio_base64})
+
+@app.get("/tts/cache-stats")
+def tts_cache_stats():
+    return jsonify(tts_cache.stats()), 200
 
 @app.route("/reset", methods=["POST"])
 def reset():
@@ -2310,88 +2507,116 @@ def _json_error(message, status=400, **extra):
     return jsonify(payload), status
 
 
-# ===== OCR: helpers (replace your current _post_ocr_space / _aggregate_parsed_text) =====
-import mimetypes
-
-# Expand mimetypes so we don't default to image/png for everything
-mimetypes.add_type("application/pdf", ".pdf")
-mimetypes.add_type("image/jpeg", ".jpg")
-mimetypes.add_type("image/jpeg", ".jpeg")
-mimetypes.add_type("image/png", ".png")
-mimetypes.add_type("image/webp", ".webp")
-mimetypes.add_type("image/tiff", ".tif")
-mimetypes.add_type("image/tiff", ".tiff")
-mimetypes.add_type("image/bmp", ".bmp")
-mimetypes.add_type("image/gif", ".gif")
-mimetypes.add_type("image/heic", ".heic")
-mimetypes.add_type("image/heif", ".heif")
-
-# Accept **all common images + PDF** (no “png-only” behavior)
-ALLOWED_EXTS = {
-    "pdf", "png", "jpg", "jpeg", "webp", "tif", "tiff", "bmp", "gif", "heic", "heif"
-}
-REJECTED_PREFIXES = ("video/", "audio/")
-
-def _guess_mimetype(filename: str, fallback: str = None) -> str:
-    ext = (osp.splitext(filename)[1] or "").lower()
-    if not ext:
-        return fallback or "application/octet-stream"
-    mime, _ = mimetypes.guess_type(filename)
-    return mime or fallback or "application/octet-stream"
-
-def _post_ocr_space(file_storage, filename, ext, language, overlay, engine,
-                    is_table=None, scale=None, detect_orientation=None):
-    """
-    Sends the uploaded file stream to OCR.Space and returns parsed JSON.
-    Works for PDF and common image types. No PNG forcing anymore.
-    """
-    # Keep the original extension for the upstream provider
-    forced_name = secure_filename(filename or f"upload.{ext or 'bin'}")
-    # Prefer the browser/werkzeug-detected mimetype; otherwise guess by extension
-    forced_mime = file_storage.mimetype or _guess_mimetype(forced_name, "application/octet-stream")
-
-    data = {
-        "apikey": OCR_SPACE_API_KEY,
-        "language": language,
-        "isOverlayRequired": overlay,
-        "OCREngine": engine,  # "1" or "2"
-    }
-    if is_table is not None:
-        data["isTable"] = is_table
-    if scale is not None:
-        data["scale"] = scale
-    if detect_orientation is not None:
-        data["detectOrientation"] = detect_orientation
-
-    resp = requests.post(
-        "https://api.ocr.space/parse/image",
-        files={"file": (forced_name, file_storage.stream, forced_mime)},
-        data=data,
-        timeout=180,
-        headers={"Accept": "application/json"},
-    )
-    content_type = resp.headers.get("Content-Type", "")
+# ===== OCR: shared engine (cache, image prep, PDF text layer, page-split, providers) =====
+import ocr_cache
+import ocr_engine
+import image_prep
+from ocr_engine import OcrFailure
+
+ALLOWED_EXTS = ocr_engine.ALLOWED_EXTS
+REJECTED_PREFIXES = ocr_engine.REJECTED_PREFIXES
+
+
+def _ocr_form_options(form) -> dict:
+    """Read the OCR tunables + chat-attachment options from a multipart form."""
+    attach_role = (form.get("role") or "user").strip().lower()
+    if attach_role not in ("user", "assistant"):
+        attach_role = "user"
+
     try:
-        result = resp.json()
-    except ValueError:
-        snippet = (resp.text or "").strip()[:300]
-        raise RuntimeError(
-            f"OCR provider returned non-JSON response (status {resp.status_code}, ct {content_type}). "
-            f"Snippet: {snippet}"
+        max_chars_env = int(os.environ.get("OCR_HISTORY_MAX_CHARS", "8000"))
+    except Exception:
+        max_chars_env = 8000
+    try:
+        max_chars_req = int(form.get("max_chars", "") or max_chars_env)
+    except Exception:
+        max_chars_req = max_chars_env
+
+    return {
+        "attach": (form.get("attach", "true").strip().lower() != "false"),
+        "role": attach_role,
+        "label": (form.get("label") or "OCR Document").strip()[:48],
+        "max_chars": max(1000, min(200_000, max_chars_req)),
+        "language": form.get("language", "eng"),
+        "overlay": form.get("overlay", "false"),
+        "engine": form.get("engine", "2"),
+        "is_table": form.get("isTable"),
+        "scale": form.get("scale"),
+        "detect_orientation": form.get("detectOrientation"),
+    }
+
+
+def _ocr_validate_upload(f, ext: str):
+    """Shared guards for the sync + job endpoints; returns a _json_error tuple or None."""
+    if f.mimetype and f.mimetype.startswith(REJECTED_PREFIXES):
+        return _json_error("Video/audio files are not supported by OCR.", 400)
+
+    if ext and ext not in ALLOWED_EXTS:
+        # If extension is unknown but mimetype looks like image/pdf, allow it
+        looks_image_or_pdf = (
+            (f.mimetype or "").startswith("image/") or (f.mimetype == "application/pdf")
+        )
+        if not looks_image_or_pdf:
+            return _json_error(
+                "Unsupported file type. Only PDF or images are supported.",
+                400, allowed=sorted(ALLOWED_EXTS)
+            )
+
+    if request.content_length and request.content_length > MAX_BYTES:
+        return _json_error(
+            f"File too large for server cap (> {MAX_BYTES // (1024 * 1024)}MB).",
+            413, limit_mb=MAX_BYTES // (1024 * 1024)
+        )
+    return None
+
+
+def _ocr_payload(doc: dict, filename: str, session_id: str, opts: dict) -> dict:
+    """Optionally attach the OCR text into chat_sessions and build the response body."""
+    text, pages, forced_mime, result = doc["text"], doc["pages"], doc["mimetype"], doc["result"]
+    attached = False
+    chars_saved = 0
+    truncated = False
+
+    if opts["attach"]:
+        chat_sessions.setdefault(session_id, [])
+        header = (
+            f"[{opts['label']} Uploaded]\n"
+            f"- File: {filename}\n"
+            f"- Pages: {pages}\n"
+            f"- Language: {opts['language']}\n"
+            f"- Engine: {opts['engine']}\n"
+            f"- Mimetype: {forced_mime}\n"
+            f"---\n"
         )
-    return result, forced_mime
-
-def _aggregate_parsed_text(result_json):
-    """Combine text across OCR.Space pages; return (text, page_count)."""
-    if result_json.get("IsErroredOnProcessing") or "ParsedResults" not in result_json:
-        return None, 0
-    pages = result_json.get("ParsedResults") or []
-    texts = []
-    for p in pages:
-        t = (p or {}).get("ParsedText", "")
-        if t:
-            texts.append(t)
-    return ("\n\n".join(texts).strip(), len(pages))
+        content = text
+        if len(content) > opts["max_chars"]:
+            content = content[:opts["max_chars"]]
+            truncated = True
+
+        message_text = header + content + ("\n[...truncated...]" if truncated else "")
+        chat_sessions[session_id].append({"role": opts["role"], "content": message_text})
+        attached = True
+        chars_saved = len(content)
+
+    return {
+        "text": text,
+        "meta": {
+            "filename": filename,
+            "mimetype": forced_mime,
+            "pages": pages,
+            "language": opts["language"],
+            "engine": opts["engine"],
+            "cached": doc["cached"],
+            "text_layer_pages": result.get("TextLayerPages", 0),
+            "provider_pages": result.get("ProviderPages", 0 if result.get("TextLayerPages") else pages),
+            "image_prep": doc.get("prep"),
+        },
+        "session_id": session_id,
+        "attached": attached,
+        "chars_saved": chars_saved,
+        "truncated": truncated
+    }
+
 
 # ===== OCR: session-aware endpoints (replace your current /ocr + /api/ocr routes) =====
 @app.route("/ocr", methods=["POST"])
@@ -2413,7 +2638,7 @@ def ocr_from_image():
       { text, meta, session_id, attached, chars_saved, truncated }
     """
     try:
-        if not OCR_SPACE_API_KEY:
+        if not ocr_engine.provider().configured:
             app.logger.error("OCR_SPACE_API_KEY is not set")
             return _json_error("OCR_SPACE_API_KEY is not configured", 500)
 
@@ -2423,21 +2648,7 @@ def ocr_from_image():
             or (request.headers.get("X-Session-Id") or "").strip()
             or str(uuid4())
         )
-        attach_flag = (request.form.get("attach", "true").strip().lower() != "false")
-        attach_role = (request.form.get("role") or "user").strip().lower()
-        if attach_role not in ("user", "assistant"):
-            attach_role = "user"
-        label = (request.form.get("label") or "OCR Document").strip()[:48]
-
-        try:
-            max_chars_env = int(os.environ.get("OCR_HISTORY_MAX_CHARS", "8000"))
-        except Exception:
-            max_chars_env = 8000
-        try:
-            max_chars_req = int(request.form.get("max_chars", "") or max_chars_env)
-        except Exception:
-            max_chars_req = max_chars_env
-        max_chars_req = max(1000, min(200_000, max_chars_req))
+        opts = _ocr_form_options(request.form)
 
         # ---- input file (PDF or any image/*) ----
         f = request.files.get("image") or request.files.get("file")
@@ -2452,164 +2663,421 @@ def ocr_from_image():
             request.path, session_id, filename, getattr(f, "mimetype", None), request.content_length
         )
 
-        # ---- guards: allow PDF and images; reject audio/video; soft-check extension ----
-        if f.mimetype and f.mimetype.startswith(REJECTED_PREFIXES):
-            return _json_error("Video/audio files are not supported by OCR.", 400)
+        # ---- guards: allow PDF and images; reject audio/video; server size cap ----
+        rejected = _ocr_validate_upload(f, ext)
+        if rejected:
+            return rejected
 
-        if ext and ext not in ALLOWED_EXTS:
-            # If extension is unknown but mimetype looks like image/pdf, allow it
-            looks_image_or_pdf = (
-                (f.mimetype or "").startswith("image/") or (f.mimetype == "application/pdf")
-            )
-            if not looks_image_or_pdf:
-                return _json_error(
-                    "Unsupported file type. Only PDF or images are supported.",
-                    400, allowed=sorted(ALLOWED_EXTS)
-                )
+        try:
+            doc = ocr_engine.run(f.read(), filename, ext, f.mimetype, opts, session_id=session_id)
+        except OcrFailure as e:
+            return _json_error(e.message, e.status, **e.extra)
 
-        # ---- size caps (server + provider plan) ----
-        if request.content_length and request.content_length > MAX_BYTES:
-            return _json_error(
-                f"File too large for server cap (> {MAX_BYTES // (1024 * 1024)}MB).",
-                413, limit_mb=MAX_BYTES // (1024 * 1024)
-            )
+        # ---- success ----
+        return jsonify(_ocr_payload(doc, filename, session_id, opts))
 
-        provider_limit = PROVIDER_LIMIT_MB * 1024 * 1024
-        if request.content_length and request.content_length > provider_limit:
-            # Provider free plans are small; let clients see a helpful message
-            return _json_error(
-                f"File exceeds your OCR plan limit ({PROVIDER_LIMIT_MB}MB). "
-                f"Please compress the file or upgrade your OCR plan.",
-                413, provider_limit_mb=PROVIDER_LIMIT_MB
-            )
+    except Exception:
+        app.logger.exception("Unhandled error in /api/ocr")
+        return jsonify({"error": "Internal server error"}), 500
 
-        # ---- tunables ----
-        language = request.form.get("language", "eng")
-        overlay = request.form.get("overlay", "false")
-        engine = request.form.get("engine", "2")
-        is_table = request.form.get("isTable")
-        scale = request.form.get("scale")
-        detect_orientation = request.form.get("detectOrientation")
 
-        # ---- provider call (works for PDF + image types) ----
-        try:
-            result, forced_mime = _post_ocr_space(
-                f, filename, ext, language, overlay, engine,
-                is_table=is_table, scale=scale, detect_orientation=detect_orientation
-            )
-        except requests.exceptions.RequestException as e:
-            app.logger.exception("OCR provider network error")
-            return _json_error("OCR request failed", 502, detail=str(e))
-        except RuntimeError as e:
-            app.logger.error("OCR provider returned non-JSON/HTML error: %s", e)
-            return _json_error(str(e), 502)
-
-        # ---- parse / validate provider response ----
-        text, pages = _aggregate_parsed_text(result)
-        if text is None:
-            app.logger.error("OCR provider error payload: %s", result)
-            return _json_error(
-                "OCR failed",
-                400,
-                message=result.get("ErrorMessage", "No detailed message"),
-                details=result
-            )
-        if not text:
-            app.logger.warning("OCR succeeded but empty text")
-            return _json_error("OCR succeeded but returned no text", 502, provider=result)
+# ===== OCR: background jobs (upload returns immediately; progress via polling or SSE) =====
+OCR_JOB_WORKERS = int(os.getenv("OCR_JOB_WORKERS", "2"))
+OCR_JOB_TTL_S = int(os.getenv("OCR_JOB_TTL_S", "3600"))
+OCR_JOB_POOL = ThreadPoolExecutor(max_workers=OCR_JOB_WORKERS, thread_name_prefix="ocr-job")
+OCR_JOBS: Dict[str, Dict[str, Any]] = {}  # job_id -> {status, progress, events, cond, response, ...}
+OCR_JOBS_LOCK = threading.Lock()
 
-        # ---- optionally attach OCR text into chat history for context ----
-        attached = False
-        chars_saved = 0
-        truncated = False
 
-        if attach_flag:
-            chat_sessions.setdefault(session_id, [])
-            header = (
-                f"[{label} Uploaded]\n"
-                f"- File: {filename}\n"
-                f"- Pages: {pages}\n"
-                f"- Language: {language}\n"
-                f"- Engine: {engine}\n"
-                f"- Mimetype: {forced_mime}\n"
-                f"---\n"
-            )
-            content = text
-            if len(content) > max_chars_req:
-                content = content[:max_chars_req]
-                truncated = True
+def _ocr_job_public(job: dict) -> dict:
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],  # queued | running | done | error
+        "session_id": job["session_id"],
+        "filename": job["filename"],
+        "pages_done": job["pages_done"],
+        "pages_total": job["pages_total"],
+        "created_at": job["created_at"],
+        "finished_at": job.get("finished_at"),
+        "result": job.get("response"),
+        "error": job.get("error"),
+    }
 
-            message_text = header + content + ("\n[...truncated...]" if truncated else "")
-            chat_sessions[session_id].append({"role": attach_role, "content": message_text})
-            attached = True
-            chars_saved = len(content)
 
-        # ---- success ----
-        return jsonify({
-            "text": text,
-            "meta": {
-                "filename": filename,
-                "mimetype": forced_mime,
-                "pages": pages,
-                "language": language,
-                "engine": engine,
-            },
-            "session_id": session_id,
-            "attached": attached,
-            "chars_saved": chars_saved,
-            "truncated": truncated
-        })
+def _ocr_job_event(job: dict, obj: dict):
+    with job["cond"]:
+        job["events"].append(obj)
+        job["cond"].notify_all()
 
+
+def _ocr_jobs_gc():
+    cutoff = time.time() - OCR_JOB_TTL_S
+    with OCR_JOBS_LOCK:
+        for jid in [j for j, v in OCR_JOBS.items() if v.get("finished_at") and v["finished_at"] < cutoff]:
+            OCR_JOBS.pop(jid, None)
+
+
+def _run_ocr_job(job: dict, file_bytes: bytes, ext: str, mimetype: str, opts: dict):
+    job["status"] = "running"
+    _ocr_job_event(job, {"type": "status", "status": "running"})
+
+    def on_progress(done, total):
+        job["pages_done"], job["pages_total"] = done, total
+        _ocr_job_event(job, {"type": "progress", "pages_done": done, "pages_total": total})
+
+    try:
+        doc = ocr_engine.run(file_bytes, job["filename"], ext, mimetype, opts,
+                            session_id=job["session_id"], on_progress=on_progress)
+        job["response"] = _ocr_payload(doc, job["filename"], job["session_id"], opts)
+        job["status"] = "done"
+        _ocr_job_event(job, {"type": "done", "result": job["response"]})
+    except OcrFailure as e:
+        job["error"] = {"error": e.message, "status": e.status, **e.extra}
+        job["status"] = "error"
+        _ocr_job_event(job, {"type": "error", **job["error"]})
     except Exception:
-        app.logger.exception("Unhandled error in /api/ocr")
-        return jsonify({"error": "Internal server error"}), 500
+        app.logger.exception("Unhandled error in OCR job %s", job["job_id"])
+        job["error"] = {"error": "Internal server error", "status": 500}
+        job["status"] = "error"
+        _ocr_job_event(job, {"type": "error", **job["error"]})
+    finally:
+        job["finished_at"] = time.time()
+
+
+@app.route("/api/ocr/jobs", methods=["POST"])
+def ocr_job_create():
+    """
+    Same multipart form as /api/ocr, but returns 202 {job_id, ...} immediately.
+    Poll GET /api/ocr/jobs/<job_id> or stream GET /api/ocr/jobs/<job_id>/events (SSE).
+    The OCR text is attached into chat_sessions when the job completes.
+    """
+    if not ocr_engine.provider().configured:
+        app.logger.error("OCR_SPACE_API_KEY is not set")
+        return _json_error("OCR_SPACE_API_KEY is not configured", 500)
+
+    session_id = (
+        (request.form.get("session_id") or "").strip()
+        or (request.headers.get("X-Session-Id") or "").strip()
+        or str(uuid4())
+    )
+    opts = _ocr_form_options(request.form)
+
+    f = request.files.get("image") or request.files.get("file")
+    if not f:
+        return _json_error("No file uploaded. Use form field 'image' or 'file'.", 400)
+    filename = secure_filename(f.filename or "upload")
+    ext = (osp.splitext(filename)[1].lstrip(".") or "").lower()
+    rejected = _ocr_validate_upload(f, ext)
+    if rejected:
+        return rejected
+
+    _ocr_jobs_gc()
+    job_id = uuid4().hex
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "session_id": session_id,
+        "filename": filename,
+        "pages_done": 0,
+        "pages_total": None,
+        "created_at": time.time(),
+        "events": [],
+        "cond": threading.Condition(),
+    }
+    with OCR_JOBS_LOCK:
+        OCR_JOBS[job_id] = job
+    OCR_JOB_POOL.submit(_run_ocr_job, job, f.read(), ext, f.mimetype, opts)
+    app.logger.info("OCR job queued: job_id=%s session_id=%s filename=%s", job_id, session_id, filename)
+
+    return jsonify({
+        "job_id": job_id,
+        "session_id": session_id,
+        "status": "queued",
+        "status_url": f"/api/ocr/jobs/{job_id}",
+        "events_url": f"/api/ocr/jobs/{job_id}/events",
+    }), 202
+
+
+@app.get("/api/ocr/jobs/<job_id>")
+def ocr_job_status(job_id):
+    job = OCR_JOBS.get(job_id)
+    if not job:
+        return _json_error("Unknown job_id", 404)
+    return jsonify(_ocr_job_public(job))
+
+
+@app.get("/api/ocr/jobs/<job_id>/events")
+def ocr_job_events(job_id):
+    job = OCR_JOBS.get(job_id)
+    if not job:
+        return Response(_sse({"type": "error", "error": "Unknown job_id"}), mimetype="text/event-stream")
+
+    def gen():
+        yield _sse({"type": "hello", "job_id": job_id, "status": job["status"]})
+        i = 0
+        while True:
+            with job["cond"]:
+                if i >= len(job["events"]):
+                    job["cond"].wait(timeout=15)
+                batch = job["events"][i:]
+                i += len(batch)
+            if not batch:
+                yield _sse({"type": "ping", "ts": time.time()})
+                continue
+            for obj in batch:
+                yield _sse(obj)
+                if obj.get("type") in ("done", "error"):
+                    return
+
+    headers = {
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "Cache-Control": "no-cache, no-transform",
+        "X-Accel-Buffering": "no",
+        "Connection": "keep-alive",
+    }
+    return Response(stream_with_context(gen()), headers=headers)
+
+
+@app.get("/api/ocr/cache-stats")
+def ocr_cache_stats():
+    return jsonify(ocr_cache.stats())
+
+
+@app.get("/api/ocr/metrics")
+def ocr_metrics():
+    return jsonify(ocr_engine.metrics())
+
 # ---------- Labs: AI parse + classification ----------
 # Put near the top-level with other imports if missing
 import math
 
+LAB_UNITLESS_MAX_FOLD = float(os.getenv("LAB_UNITLESS_MAX_FOLD", "4"))  # unit-less value vs catalog range
+
 # Common adult reference ranges (generic; used only when none are found in the text)
-# Units are important; we do not auto-convert units here.
+# `unit` is the catalog unit for low/high; `convert` maps other (normalized) units to it:
+#   catalog_value = value * factor          (factor: float)
+#   catalog_value = value * scale + offset  (factor: (scale, offset))
 DEFAULT_LAB_RANGES = [
-    {"name": "hemoglobin",  "aliases": ["hb","hgb","hemoglobin"],         "unit": "g/dL",  "low": 13.0, "high": 17.0},
-    {"name": "hematocrit",  "aliases": ["hct","hematocrit"],              "unit": "%",     "low": 40.0, "high": 50.0},
-    {"name": "wbc",         "aliases": ["wbc","wbc count","white blood"], "unit": "10^3/uL","low": 4.0, "high": 10.0},
-    {"name": "rbc",         "aliases": ["rbc","red blood cells"],         "unit": "10^6/uL","low": 4.5, "high": 5.9},
-    {"name": "platelets",   "aliases": ["plt","platelet","platelets"],    "unit": "10^3/uL","low": 150, "high": 450},
+    # --- CBC ---
+    {"name": "hemoglobin",  "aliases": ["hb","hgb","hemoglobin","haemoglobin"], "unit": "g/dL", "low": 13.0, "high": 17.0,
+     "convert": {"g/l": 0.1, "mmol/l": 1.611}},
+    {"name": "hematocrit",  "aliases": ["hct","hematocrit","haematocrit","pcv"], "unit": "%", "low": 40.0, "high": 50.0,
+     "convert": {"l/l": 100.0}},
+    {"name": "wbc",         "aliases": ["wbc","wbc count","white blood","white blood cells","tlc","total leukocyte count"],
+     "unit": "10^3/uL", "low": 4.0, "high": 10.0},
+    {"name": "rbc",         "aliases": ["rbc","red blood cells","rbc count"], "unit": "10^6/uL", "low": 4.5, "high": 5.9},
+    {"name": "platelets",   "aliases": ["plt","platelet","platelets","platelet count"], "unit": "10^3/uL", "low": 150, "high": 450},
     {"name": "mcv",         "aliases": ["mcv"],                           "unit": "fL",    "low": 80,   "high": 100},
     {"name": "mch",         "aliases": ["mch"],                           "unit": "pg",    "low": 27,   "high": 33},
-    {"name": "mchc",        "aliases": ["mchc"],                          "unit": "g/dL",  "low": 32,   "high": 36},
-    {"name": "rdw",         "aliases": ["rdw"],                           "unit": "%",     "low": 11.5, "high": 14.5},
-    {"name": "neutrophils", "aliases": ["neutrophil","neut%"],            "unit": "%",     "low": 40,   "high": 70},
-    {"name": "lymphocytes", "aliases": ["lymphocyte","lymph%"],           "unit": "%",     "low": 20,   "high": 45},
+    {"name": "mchc",        "aliases": ["mchc"],                          "unit": "g/dL",  "low": 32,   "high": 36,
+     "convert": {"g/l": 0.1}},
+    {"name": "rdw",         "aliases": ["rdw","rdw-cv"],                  "unit": "%",     "low": 11.5, "high": 14.5},
+    {"name": "neutrophils", "aliases": ["neutrophil","neut%","neutrophils %"], "unit": "%", "low": 40,   "high": 70},
+    {"name": "lymphocytes", "aliases": ["lymphocyte","lymph%","lymphocytes %"], "unit": "%", "low": 20,  "high": 45},
     {"name": "monocytes",   "aliases": ["monocyte","mono%"],              "unit": "%",     "low": 2,    "high": 8},
     {"name": "eosinophils", "aliases": ["eosinophil","eos%"],             "unit": "%",     "low": 1,    "high": 4},
     {"name": "basophils",   "aliases": ["basophil","baso%"],              "unit": "%",     "low": 0,    "high": 1},
+    # --- Chemistry / electrolytes ---
+    {"name": "glucose",     "aliases": ["glu","fbs","fasting glucose","fasting blood sugar","blood sugar","glucose fasting","fpg"],
+     "unit": "mg/dL", "low": 70, "high": 99, "convert": {"mmol/l": 18.016}},
+    {"name": "sodium",      "aliases": ["na","na+"],                      "unit": "mmol/L", "low": 135, "high": 145, "convert": {"meq/l": 1.0}},
+    {"name": "potassium",   "aliases": ["k","k+"],                        "unit": "mmol/L", "low": 3.5, "high": 5.1, "convert": {"meq/l": 1.0}},
+    {"name": "chloride",    "aliases": ["cl","cl-"],                      "unit": "mmol/L", "low": 98,  "high": 107, "convert": {"meq/l": 1.0}},
+    {"name": "bicarbonate", "aliases": ["hco3","bicarb","co2","total co2","tco2"], "unit": "mmol/L", "low": 22, "high": 29,
+     "convert": {"meq/l": 1.0}},
+    {"name": "calcium",     "aliases": ["ca","total calcium","calcium total"], "unit": "mg/dL", "low": 8.6, "high": 10.3,
+     "convert": {"mmol/l": 4.008, "meq/l": 2.004}},
+    {"name": "magnesium",   "aliases": ["mg2+","magnesium serum"],        "unit": "mg/dL", "low": 1.7, "high": 2.2,
+     "convert": {"mmol/l": 2.431, "meq/l": 1.215}},
+    {"name": "phosphate",   "aliases": ["phosphorus","phos","po4","inorganic phosphorus"], "unit": "mg/dL", "low": 2.5, "high": 4.5,
+     "convert": {"mmol/l": 3.097}},
+    {"name": "uric acid",   "aliases": ["urate","ua"],                    "unit": "mg/dL", "low": 3.5, "high": 7.2,
+     "convert": {"umol/l": 0.01681}},
+    {"name": "albumin",     "aliases": ["alb"],                           "unit": "g/dL",  "low": 3.5, "high": 5.0, "convert": {"g/l": 0.1}},
+    {"name": "total protein", "aliases": ["tp","protein total","protein"], "unit": "g/dL", "low": 6.0, "high": 8.3, "convert": {"g/l": 0.1}},
+    {"name": "crp",         "aliases": ["c-reactive protein","c reactive protein"], "unit": "mg/L", "low": 0, "high": 10,
+     "convert": {"mg/dl": 10.0}},
+    {"name": "hba1c",       "aliases": ["a1c","hb a1c","glycated hemoglobin","glycosylated hemoglobin","hemoglobin a1c"],
+     "unit": "%", "low": 4.0, "high": 5.6, "convert": {"mmol/mol": (0.09148, 2.152)}},
+    # --- Renal ---
+    {"name": "creatinine",  "aliases": ["cr","creat","creatinine serum"], "unit": "mg/dL", "low": 0.6, "high": 1.3,
+     "convert": {"umol/l": 0.01131}},
+    {"name": "bun",         "aliases": ["blood urea nitrogen","urea nitrogen"], "unit": "mg/dL", "low": 7, "high": 20,
+     "convert": {"mmol/l": 2.801}},
+    {"name": "urea",        "aliases": ["blood urea","serum urea"],       "unit": "mmol/L", "low": 2.5, "high": 7.1,
+     "convert": {"mg/dl": 0.1665}},
+    # --- Lipids ---
+    {"name": "total cholesterol", "aliases": ["cholesterol","chol","tc","cholesterol total"], "unit": "mg/dL", "low": 0, "high": 200,
+     "convert": {"mmol/l": 38.67}},
+    {"name": "ldl",         "aliases": ["ldl-c","ldl cholesterol","ldl c","ldl-cholesterol","low density lipoprotein"],
+     "unit": "mg/dL", "low": 0, "high": 100, "convert": {"mmol/l": 38.67}},
+    {"name": "hdl",         "aliases": ["hdl-c","hdl cholesterol","hdl c","hdl-cholesterol","high density lipoprotein"],
+     "unit": "mg/dL", "low": 40, "high": 100, "convert": {"mmol/l": 38.67}},
+    {"name": "triglycerides", "aliases": ["tg","trig","triglyceride","trigs"], "unit": "mg/dL", "low": 0, "high": 150,
+     "convert": {"mmol/l": 88.57}},
+    # --- Liver function ---
+    {"name": "alt",         "aliases": ["sgpt","alt (sgpt)","alanine aminotransferase","alanine transaminase"], "unit": "U/L", "low": 7, "high": 56},
+    {"name": "ast",         "aliases": ["sgot","ast (sgot)","aspartate aminotransferase","aspartate transaminase"], "unit": "U/L", "low": 10, "high": 40},
+    {"name": "alp",         "aliases": ["alk phos","alkaline phosphatase","alkp"], "unit": "U/L", "low": 44, "high": 147},
+    {"name": "ggt",         "aliases": ["gamma gt","gamma-gt","ggtp","gamma glutamyl transferase"], "unit": "U/L", "low": 9, "high": 48},
+    {"name": "total bilirubin", "aliases": ["bilirubin","tbil","t bil","t. bilirubin","bilirubin total","t.bilirubin"],
+     "unit": "mg/dL", "low": 0.1, "high": 1.2, "convert": {"umol/l": 0.05848}},
+    {"name": "direct bilirubin", "aliases": ["dbil","d bil","d. bilirubin","bilirubin direct","conjugated bilirubin","d.bilirubin"],
+     "unit": "mg/dL", "low": 0.0, "high": 0.3, "convert": {"umol/l": 0.05848}},
+    # --- Thyroid ---
+    {"name": "tsh",         "aliases": ["thyroid stimulating hormone","thyrotropin"], "unit": "mIU/L", "low": 0.4, "high": 4.0},
+    {"name": "free t4",     "aliases": ["ft4","f t4","free thyroxine"], "unit": "ng/dL", "low": 0.8, "high": 1.8,
+     "convert": {"pmol/l": 0.0777}},
+    {"name": "free t3",     "aliases": ["ft3","f t3","free triiodothyronine"], "unit": "pg/mL", "low": 2.3, "high": 4.2,
+     "convert": {"pmol/l": 0.651}},
+    # --- Coagulation ---
+    {"name": "pt",          "aliases": ["prothrombin time","pt (sec)"],  "unit": "s",     "low": 11.0, "high": 13.5},
+    {"name": "inr",         "aliases": ["pt inr","pt-inr"],              "unit": "",      "low": 0.8,  "high": 1.1},
+    {"name": "aptt",        "aliases": ["ptt","activated partial thromboplastin time","a ptt"], "unit": "s", "low": 25, "high": 35},
+    {"name": "fibrinogen",  "aliases": ["fib"],                          "unit": "mg/dL", "low": 200,  "high": 400, "convert": {"g/l": 100.0}},
+    # --- Tumour markers (number-suffixed names; "CA" alone is calcium) ---
+    {"name": "ca 125",      "aliases": ["ca-125","ca125","cancer antigen 125"], "unit": "U/mL", "low": 0, "high": 35,
+     "convert": {"ku/l": 1.0}},
+    {"name": "ca 19-9",     "aliases": ["ca-19-9","ca19-9","ca 19.9","cancer antigen 19-9","carbohydrate antigen 19-9"],
+     "unit": "U/mL", "low": 0, "high": 37, "convert": {"ku/l": 1.0}},
+    {"name": "ca 15-3",     "aliases": ["ca-15-3","ca15-3","ca 15.3","cancer antigen 15-3"], "unit": "U/mL", "low": 0, "high": 30,
+     "convert": {"ku/l": 1.0}},
+    {"name": "ca 27.29",    "aliases": ["ca-27.29","ca27.29","ca 27-29","cancer antigen 27.29"], "unit": "U/mL", "low": 0, "high": 38,
+     "convert": {"ku/l": 1.0}},
 ]
 
-def _canon_name(name: str) -> str:
-    t = (name or "").strip().lower()
-    t = re.sub(r"[^a-z0-9 %/\^\-\+\.\(\)]", " ", t)
-    t = re.sub(r"\s+", " ", t).strip()
-    # try alias matching
-    for item in DEFAULT_LAB_RANGES:
-        if t == item["name"]:
-            return item["name"]
-        for a in item["aliases"]:
-            if t == a:
-                return item["name"]
-    # light heuristic: remove trailing units in name
-    t2 = re.sub(r"\(.*?\)$", "", t).strip()
-    for item in DEFAULT_LAB_RANGES:
-        if t2 == item["name"] or t2 in item["aliases"]:
-            return item["name"]
-    return t  # fallback
+# ---- Prebuilt lookup index (built once at import; O(1) per row) ----
+_LAB_KEY_STRIP_RX = re.compile(r"[^a-z0-9 %/\^\-\+\.\(\)]")
+_LAB_KEY_WS_RX = re.compile(r"\s+")
+_LAB_KEY_TRAIL_PAREN_RX = re.compile(r"\(.*?\)$")
+_LAB_KEY_PREFIXES = ("serum ", "plasma ", "blood ", "s. ", "s ", "p. ")
+
+# Equivalent spellings -> one normalized unit key
+_LAB_UNIT_ALIASES = {
+    "x10^9/l": "10^3/ul", "10^9/l": "10^3/ul", "x10^3/ul": "10^3/ul", "k/ul": "10^3/ul", "10^3/mm3": "10^3/ul",
+    "thou/ul": "10^3/ul", "x10^12/l": "10^6/ul", "10^12/l": "10^6/ul", "x10^6/ul": "10^6/ul", "m/ul": "10^6/ul",
+    "iu/l": "u/l", "uiu/ml": "miu/l", "miu/ml": "miu/l", "sec": "s", "secs": "s", "seconds": "s",
+    "mg/dl.": "mg/dl", "mg%": "mg/dl", "gm/dl": "g/dl", "gm%": "g/dl",
+}
 
-def _default_range_for(name: str):
-    n = _canon_name(name)
+
+def _lab_key(name: str) -> str:
+    t = _LAB_KEY_STRIP_RX.sub(" ", (name or "").strip().lower())
+    return _LAB_KEY_WS_RX.sub(" ", t).strip()
+
+
+def _norm_unit(unit: str) -> str:
+    u = (unit or "").strip().lower().replace("µ", "u").replace("μ", "u").replace("×", "x").replace(" ", "")
+    return _LAB_UNIT_ALIASES.get(u, u)
+
+
+def _build_lab_index():
+    index = {}
     for item in DEFAULT_LAB_RANGES:
-        if item["name"] == n:
-            return {"low": item["low"], "high": item["high"], "unit": item["unit"], "canonical": n}
-    return None
+        item["unit_key"] = _norm_unit(item["unit"])
+        for alias in [item["name"], *item["aliases"]]:
+            index.setdefault(_lab_key(alias), item)
+    return index
+
+
+_LAB_INDEX = _build_lab_index()
+
+
+@lru_cache(maxsize=4096)
+def _lab_entry(name: str):
+    """Catalog entry for a printed lab name (exact alias, then without trailing '(...)' / specimen prefix)."""
+    t = _lab_key(name)
+    hit = _LAB_INDEX.get(t)
+    if hit is None:
+        t2 = _LAB_KEY_TRAIL_PAREN_RX.sub("", t).strip()
+        hit = _LAB_INDEX.get(t2)
+        if hit is None:
+            for p in _LAB_KEY_PREFIXES:
+                if t2.startswith(p):
+                    hit = _LAB_INDEX.get(t2[len(p):])
+                    break
+    return hit
+
+
+def _canon_name(name: str) -> str:
+    hit = _lab_entry(name)
+    return hit["name"] if hit else _lab_key(name)  # fallback
+
+
+def _unit_factor(entry: dict, unit: str):
+    """(scale, offset) that converts `unit` into the catalog unit, or None if not convertible."""
+    u = _norm_unit(unit)
+    if not u or u == entry["unit_key"]:
+        return (1.0, 0.0)
+    f = (entry.get("convert") or {}).get(u)
+    if f is None:
+        return None
+    return f if isinstance(f, tuple) else (float(f), 0.0)
+
+
+def _convert_lab_value(name: str, value, from_unit: str, to_unit: str = None):
+    """Convert a value between units of the same analyte (to the catalog unit by default); None if unknown."""
+    entry = _lab_entry(name)
+    v = _to_num(value)
+    if not entry or v is None:
+        return None
+    src = _unit_factor(entry, from_unit)
+    dst = _unit_factor(entry, to_unit) if to_unit else (1.0, 0.0)
+    if src is None or dst is None:
+        return None
+    canon = v * src[0] + src[1]
+    return (canon - dst[1]) / dst[0]
+
+
+def _lab_scale_distance(v: float, low: float, high: float) -> float:
+    """Log-distance from `v` to [low, high] (0 inside): how many 'e-folds' the value is off the range."""
+    if low <= v <= high:
+        return 0.0
+    if v > high:
+        return math.log(v / high) if high > 0 else math.inf
+    return math.log(low / v) if v > 0 else math.inf
+
+
+def _unitless_on_catalog_scale(entry: dict, value) -> bool:
+    """
+    A row printed without a unit is read on the catalog scale when its value sits within
+    LAB_UNITLESS_MAX_FOLD of the catalog range and no alternative unit's range is nearer
+    (hemoglobin 12.1 -> g/dL; glucose 6.1 is nearer the mmol/L range, so stays unresolved).
+    """
+    v = _to_num(value)
+    if v is None:
+        return False
+    d = _lab_scale_distance(v, entry["low"], entry["high"])
+    if d > math.log(LAB_UNITLESS_MAX_FOLD):
+        return False
+    for f in (entry.get("convert") or {}).values():
+        scale, offset = f if isinstance(f, tuple) else (float(f), 0.0)
+        lo, hi = sorted(((entry["low"] - offset) / scale, (entry["high"] - offset) / scale))
+        if _lab_scale_distance(v, lo, hi) < d:
+            return False
+    return True
+
+
+def _default_range_for(name: str, unit: str = None, value=None):
+    """
+    Default range for `name`, expressed in the row's `unit` when it is a known alternative
+    (e.g. glucose in mmol/L). Returns None for unknown analytes and unconvertible units. A row without
+    a unit gets the catalog unit and range only when the analyte is unitless (INR) or `value` is
+    plausible on the catalog scale (_unitless_on_catalog_scale).
+    """
+    entry = _lab_entry(name)
+    if not entry:
+        return None
+    if not unit and entry["unit_key"] and not _unitless_on_catalog_scale(entry, value):
+        return None
+    f = _unit_factor(entry, unit) if unit else (1.0, 0.0)
+    if f is None:
+        return None
+    scale, offset = f
+    low = round((entry["low"] - offset) / scale, 4)
+    high = round((entry["high"] - offset) / scale, 4)
+    out_unit = unit if unit and f != (1.0, 0.0) else entry["unit"]
+    return {"low": low, "high": high, "unit": out_unit, "canonical": entry["name"]}
 
 def _to_num(x):
     if isinstance(x, (int, float)):
@@ -2638,27 +3106,171 @@ def _classify(value, low, high, band_frac=0.075):
         return {"status": "borderline", "direction": None}
     return {"status": "normal", "direction": None}
 
-@app.post("/labs/parse")
-def labs_parse():
+def _classify_batch(values, lows, highs, band_frac=0.075):
     """
-    Body: { "text": "OCR raw text" }
-    Returns: { "labs": [ {name,value,unit,low,high,status,direction} ... ] }
+    Vectorized _classify over equal-length sequences (None -> NaN).
+    Returns (status, direction) as lists with the same values _classify would give per row.
     """
-    payload = request.get_json(silent=True) or {}
-    raw_text = (payload.get("text") or "").strip()
-    if not raw_text:
-        return jsonify({"labs": []}), 200
+    v = np.array(values, dtype=float)
+    lo = np.array(lows, dtype=float)
+    hi = np.array(highs, dtype=float)
+    valid = ~(np.isnan(v) | np.isnan(lo) | np.isnan(hi)) & (hi > lo)
+    with np.errstate(invalid="ignore"):
+        below = valid & (v < lo)
+        above = valid & (v > hi)
+        band = np.maximum((hi - lo) * band_frac, 1e-9)
+        near = valid & ~below & ~above & ((np.abs(v - lo) <= band) | (np.abs(v - hi) <= band))
+    status = np.full(v.shape, None, dtype=object)
+    status[valid] = "normal"
+    status[near] = "borderline"
+    status[below | above] = "abnormal"
+    direction = np.full(v.shape, None, dtype=object)
+    direction[below] = "low"
+    direction[above] = "high"
+    return status.tolist(), direction.tolist()
+
+# ---------- Labs: deterministic line parser (runs before any LLM call) ----------
+# Typical printouts are "Name value unit (low-high)" tables; these resolve locally in microseconds.
+# Only lines that look like results but don't parse are sent to the model.
+_LAB_VALUE_TOKEN_RX = re.compile(r"^[<>≤≥]?-?\d+(?:[.,]\d+)?$")
+_LAB_GLUED_RX = re.compile(r"^([<>≤≥]?-?\d+(?:[.,]\d+)?)([A-Za-zµ%][A-Za-z0-9µ%/\^\.\*]*)$")
+_LAB_RANGE_RX = re.compile(r"(-?\d+(?:[.,]\d+)?)\s*(?:-|–|—|to)\s*(-?\d+(?:[.,]\d+)?)", re.I)
+_LAB_UPPER_RX = re.compile(r"(?:^|[\s(\[:])(?:<=?|≤|up\s*to)\s*(\d+(?:[.,]\d+)?)", re.I)
+_LAB_LOWER_RX = re.compile(r"(?:^|[\s(\[:])(?:>=?|≥)\s*(\d+(?:[.,]\d+)?)")
+_LAB_UNIT_RX = re.compile(r"^(?:[A-Za-zµ%]|[x×]?10\^)[A-Za-z0-9µ%/\^\.\*]*$")
+_LAB_NAME_UNIT_RX = re.compile(r"^(.*?)\s*[\(\[]\s*([A-Za-zµ%][A-Za-z0-9µ%/\^\.\*]*)\s*[\)\]]$")
+_LAB_HEADER_WORDS = (
+    r"patient|name|mrn|dob|d\.o\.b|age|sex|gender|date|time|collected|received|reported|printed|page|"
+    r"physician|doctor|ward|bed|room|phone|tel|fax|lab\s*no|accession|barcode|order|visit|file\s*no|id"
+)
+_LAB_SKIP_RX = re.compile(rf"\b({_LAB_HEADER_WORDS})\b", re.I)
+# A header row's leading label is made of header words only ("Patient Name:", "Date of Birth", "Lab No");
+# "Prothrombin Time" or "Sex Hormone Binding Globulin" are analytes that merely contain one.
+_LAB_HEADER_LABEL_RX = re.compile(
+    rf"^(?:(?:{_LAB_HEADER_WORDS}|of|birth|no|number|by|referring|requesting|dr)\b[\s.#/-]*)+$", re.I
+)
+# number + something unit-like ("14.2 sec", "30 nmol/L", "5.6H mmol/L", "42 %", "7.1 x10^9/L")
+_LAB_VALUE_UNIT_RX = re.compile(
+    r"\d(?:[.,]\d+)?\s*(?:[HL]\s*)?(?:%|[x×]?10\^|[A-Za-zµ]+/|(?:s|secs?|seconds|min|fl|pg|u|iu|ratio)\b)", re.I
+)
+# "CA 125", "CA 27.29": the number belongs to the marker's name, not the value
+_LAB_MARKER_NAME_RX = re.compile(r"(?:^|\s)ca[\s-]*(?:125|19[.-]9|15[.-]3|27[.-]29|72[.-]4|242|50)$", re.I)
+_LAB_FLAGS = {"h", "l", "hh", "ll", "high", "low", "*", "a", "abn", "abnormal", "n", "normal", "crit", "c"}
+
+
+def _lab_is_header_label(label: str) -> bool:
+    return bool(_LAB_HEADER_LABEL_RX.match(label.strip(" :-.,")))
+
+
+def _lab_line_is_candidate(line: str) -> bool:
+    """
+    A line worth parsing at all: has letters and digits, and is not a header/ID/date row. A row is a
+    header when its leading label is one ("Patient Name: ...", "Age 45 Y"), or when it mentions a header
+    word and carries no number-plus-unit value ("Collected 12/03/2024 08:15").
+    """
+    if not (re.search(r"[A-Za-z]", line) and re.search(r"\d", line)):
+        return False
+    label = re.split(r"[:\d]", line, 1)[0]
+    if _lab_is_header_label(label):
+        return False
+    return not (_LAB_SKIP_RX.search(line) and not _LAB_VALUE_UNIT_RX.search(line))
+
+
+def _parse_lab_line(line: str):
+    """
+    Tokenize one printout line into {name, value, unit, low, high, flag}; None if it doesn't parse.
+    Handles "Name: 13,5 g/dL (13-17)", "Name 13.5 H g/dL 13.0 - 17.0", "Name (mg/dL) 180 <200", tabs, glued units.
+    """
+    t = line.replace("\t", " ").replace(":", " : ").replace("|", " ")
+    toks = [x for x in t.split() if x not in (":", "=")]
+    name_toks, i = [], 0
+    while i < len(toks):
+        tok = toks[i]
+        if name_toks and (_LAB_VALUE_TOKEN_RX.match(tok) or _LAB_GLUED_RX.match(tok)):
+            if not _LAB_MARKER_NAME_RX.search(" ".join(name_toks + [tok])):
+                break
+        name_toks.append(tok)
+        i += 1
+    if i >= len(toks) or not name_toks:
+        return None
 
-    # 1) Ask the model to extract structured labs (JSON ONLY)
+    name = " ".join(name_toks).strip(" -.,")
+    if sum(ch.isalpha() for ch in name) < 2 or _lab_is_header_label(name):
+        return None
+
+    unit, flag = "", None
+    m = _LAB_GLUED_RX.match(toks[i])
+    value = _to_num((m.group(1) if m else toks[i]).lstrip("<>≤≥"))
+    if m:
+        # "5.6H mmol/L": a glued high/low flag, not a unit
+        if m.group(2).lower() in _LAB_FLAGS:
+            flag = m.group(2)
+        else:
+            unit = m.group(2)
+    if value is None:
+        return None
+    rest_toks = toks[i + 1:]
+    while rest_toks and rest_toks[0].lower().strip("()[]") in _LAB_FLAGS:
+        flag = flag or rest_toks[0].strip("()[]")
+        rest_toks = rest_toks[1:]
+    if not unit and rest_toks:
+        cand = rest_toks[0]
+        if _LAB_UNIT_RX.match(cand) and len(cand) <= 14 and cand.lower() not in ("to", "ref", "range", "normal"):
+            unit = cand
+            rest_toks = rest_toks[1:]
+    if not unit:
+        mu = _LAB_NAME_UNIT_RX.match(name)
+        if mu:
+            name, unit = mu.group(1).strip(), mu.group(2)
+
+    rest = " ".join(rest_toks)
+    low = high = None
+    mr = _LAB_RANGE_RX.search(rest)
+    if mr:
+        low, high = _to_num(mr.group(1)), _to_num(mr.group(2))
+    else:
+        mu_ = _LAB_UPPER_RX.search(rest)
+        ml_ = _LAB_LOWER_RX.search(rest)
+        if mu_:
+            low, high = 0.0, _to_num(mu_.group(1))
+        elif ml_:
+            low = _to_num(ml_.group(1))
+
+    return {"name": name, "value": value, "unit": unit, "low": low, "high": high, "flag": flag}
+
+
+def _local_parse_labs(raw_text: str):
+    """Run the deterministic parser over every line; returns (rows, leftover_lines, report)."""
+    rows, leftovers = [], []
+    lines = [ln.strip() for ln in raw_text.splitlines() if ln.strip()]
+    ignored = 0
+    for ln in lines:
+        if not _lab_line_is_candidate(ln):
+            ignored += 1
+            continue
+        row = _parse_lab_line(ln)
+        if row:
+            rows.append(row)
+        else:
+            leftovers.append(ln)
+    report = {
+        "lines": len(lines),
+        "resolved_locally": len(rows),
+        "sent_to_llm": len(leftovers),
+        "ignored": ignored,
+    }
+    return rows, leftovers, report
+
+
+def _llm_extract_labs(text: str) -> list:
+    """Ask the model to extract structured labs (JSON ONLY) from the given lines."""
     system = (
         "Extract laboratory results from text and return STRICT JSON with key 'labs' as an array. "
         "Each item: {name, value, unit, low, high}. "
         "Prefer numeric 'low' and 'high' if a reference range is present. "
         "If a line is not a lab (IDs, dates, headings), ignore it."
     )
-    user = f"Text:\n{raw_text[:12000]}"
-
-    llm_labs = []
+    user = f"Text:\n{text[:12000]}"
     try:
         resp = client.chat.completions.create(
             model=os.environ.get("STRUCTURE_MODEL","gpt-4o-mini"),
@@ -2670,14 +3282,19 @@ def labs_parse():
         content = re.sub(r"```json|```", "", content, flags=re.I).strip()
         doc = json.loads(content) if content.startswith("{") else {}
         if isinstance(doc, dict) and isinstance(doc.get("labs"), list):
-            llm_labs = doc["labs"]
+            return doc["labs"]
     except Exception:
-        llm_labs = []
+        pass
+    return []
+
 
-    # 2) Normalize + fill defaults + classify
+def _finalize_lab_rows(items: list, seen: set, source: str, classify: bool = True) -> list:
+    """
+    Normalize + fill default ranges + classify; dedupes against `seen` in place.
+    With classify=False the status/direction are left None for _classify_batch.
+    """
     out = []
-    seen = set()
-    for item in llm_labs:
+    for item in items:
         name = str(item.get("name") or "").strip()
         value = _to_num(item.get("value"))
         unit  = (item.get("unit") or "").strip()
@@ -2687,91 +3304,266 @@ def labs_parse():
         if not name or value is None:
             continue
 
-        # Add defaults when missing
+        # Add defaults when missing (converted into the row's unit when needed)
         if low is None or high is None or (high is not None and low is not None and high <= low):
-            d = _default_range_for(name)
+            d = _default_range_for(name, unit, value)
             if d:
                 if not unit: unit = d["unit"]
                 if low is None: low = d["low"]
                 if high is None: high = d["high"]
 
-        # final guard: ignore obvious non-labs
         canon = _canon_name(name)
-        key = (canon, value, unit, low, high)
+        key = (canon, value, _norm_unit(unit), low, high)
         if key in seen:
             continue
         seen.add(key)
 
-        cls = _classify(value, low, high)
+        cls = _classify(value, low, high) if classify else {"status": None, "direction": None}
         out.append({
             "name": name,
+            "canonical": canon,
             "value": value,
             "unit": unit,
             "low": low,
             "high": high,
             "status": cls["status"],       # "normal" | "borderline" | "abnormal" | None
             "direction": cls["direction"], # "low" | "high" | None
+            "flag": item.get("flag"),      # printed flag ("H", "L", ...) when the parser saw one
+            "source": source,              # "local" | "llm"
         })
+    return out
 
-    # 3) Fallback: try a tiny regex parser if LLM returned nothing useful
-    if not out:
-        lines = [ln.strip() for ln in raw_text.splitlines() if ln.strip()]
-        rx = re.compile(
-            r"^([A-Za-z][A-Za-z0-9\s\(\)\/\+\-%\.]+?)\s*[:\-]?\s*"
-            r"(-?\d+(?:[.,]\d+)?)\s*"
-            r"([A-Za-zµ%\/\^\d\.\-]*)\s*"
-            r"(?:\(\s*(-?\d+(?:[.,]\d+)?)\s*[\-–]\s*(-?\d+(?:[.,]\d+)?)\s*\)|"
-            r"(?:ref(?:erence)?|range|normal)\s*:?[^0-9\-]*(-?\d+(?:[.,]\d+)?)\s*[\-–]\s*(-?\d+(?:[.,]\d+)?)"
-            r")?",
-            re.I
-        )
-        for ln in lines:
-            m = rx.match(ln)
-            if not m: 
-                continue
-            name = m.group(1).strip()
-            v    = _to_num(m.group(2))
-            unit = (m.group(3) or "").strip()
-            lo   = _to_num(m.group(4) or m.group(6))
-            hi   = _to_num(m.group(5) or m.group(7))
-            if v is None: 
-                continue
 
-            if lo is None or hi is None or (hi is not None and lo is not None and hi <= lo):
-                d = _default_range_for(name)
-                if d:
-                    if not unit: unit = d["unit"]
-                    if lo is None: lo = d["low"]
-                    if hi is None: hi = d["high"]
-
-            cls = _classify(v, lo, hi)
-            out.append({
-                "name": name, "value": v, "unit": unit,
-                "low": lo, "high": hi, "status": cls["status"], "direction": cls["direction"]
-            })
+@app.post("/labs/parse")
+def labs_parse():
+    """
+    Body: { "text": "OCR raw text", "use_llm": true }
+    Returns: { "labs": [ {name,value,unit,low,high,status,direction,flag,source} ... ], "parse_report": {...} }
+
+    Deterministic parser first; only lines it could not resolve are sent to the model.
+    """
+    payload = request.get_json(silent=True) or {}
+    raw_text = (payload.get("text") or "").strip()
+    if not raw_text:
+        return jsonify({"labs": []}), 200
+    use_llm = payload.get("use_llm", True) is not False
+
+    t0 = time.perf_counter()
+    # 1) Local pass over every line
+    local_rows, leftovers, report = _local_parse_labs(raw_text)
+    seen = set()
+    out = _finalize_lab_rows(local_rows, seen, "local")
+    report["local_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+    # 2) Model only for the leftovers
+    report["llm_used"] = False
+    if leftovers and use_llm:
+        t1 = time.perf_counter()
+        llm_labs = _llm_extract_labs("\n".join(leftovers))
+        out += _finalize_lab_rows(llm_labs, seen, "llm")
+        report["llm_used"] = True
+        report["llm_rows"] = len(llm_labs)
+        report["llm_ms"] = round((time.perf_counter() - t1) * 1000, 1)
 
     # keep only sensible rows
     filtered = []
     for r in out:
-        # require a numeric value and either a range OR a status decided by AI/fallback
+        # require a numeric value and either a range, a status decided by AI/fallback, or a known
+        # analyte (e.g. printed without a unit on an ambiguous scale: kept with status null)
         if r.get("value") is None:
             continue
-        if (r.get("low") is None or r.get("high") is None) and r.get("status") is None:
+        if (r.get("low") is None or r.get("high") is None) and r.get("status") is None and not _lab_entry(r["name"]):
             continue
         filtered.append(r)
 
-    return jsonify({"labs": filtered}), 200
-# ---------- Utilities ----------
+    report["total_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return jsonify({"labs": filtered, "parse_report": report}), 200
 
-def _json_only(s: str):
-    try:
-        return json.loads(re.sub(r"```json|```", "", (s or "").strip(), flags=re.I))
-    except Exception:
-        m = re.search(r"\{[\s\S]*\}", s or "")
-        if m:
-            try: return json.loads(m.group(0))
-            except Exception: pass
-    return None
+
+# ---------- Labs: many reports at once -> per-analyte time series ----------
+LABS_BATCH_MAX_REPORTS = int(os.getenv("LABS_BATCH_MAX_REPORTS", "24"))
+LABS_TREND_STABLE_FRAC = float(os.getenv("LABS_TREND_STABLE_FRAC", "0.05"))  # of range width (or of value)
+
+
+def _report_sort_key(rep: dict):
+    try:
+        return datetime.fromisoformat(str(rep.get("date") or "").strip()[:19])
+    except ValueError:
+        return None
+
+
+def _lab_series(rows: list) -> dict:
+    """
+    Group classified rows (each with "report" index) by analyte, in report order, and compute
+    deltas / trend flags on values converted to the catalog unit where possible.
+    """
+    if not rows:
+        return {}
+    n = len(rows)
+    scale = np.ones(n)
+    offset = np.zeros(n)
+    units = []
+    for i, r in enumerate(rows):
+        entry = _lab_entry(r["name"])
+        f = _unit_factor(entry, r["unit"]) if entry else None
+        if f is None:
+            units.append(r["unit"] or "")
+        else:
+            scale[i], offset[i] = f
+            units.append(entry["unit"])
+    val = np.array([r["value"] for r in rows], dtype=float) * scale + offset
+    lo = np.array([np.nan if r["low"] is None else r["low"] for r in rows], dtype=float) * scale + offset
+    hi = np.array([np.nan if r["high"] is None else r["high"] for r in rows], dtype=float) * scale + offset
+
+    # stable sort by (analyte, unit, report order) so consecutive rows of a group are neighbours
+    keys = [(r["canonical"], units[i]) for i, r in enumerate(rows)]
+    order = sorted(range(n), key=lambda i: (keys[i], rows[i]["report"]))
+    o = np.array(order)
+    v_o, lo_o, hi_o = val[o], lo[o], hi[o]
+    same = np.array([keys[order[k]] == keys[order[k - 1]] for k in range(1, n)], dtype=bool)
+    delta = np.full(n, np.nan)
+    if n > 1:
+        d = np.diff(v_o)
+        delta[1:][same] = d[same]
+    prev = np.concatenate(([np.nan], v_o[:-1]))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        delta_pct = np.where(np.isfinite(delta) & (prev != 0), delta / np.abs(prev) * 100.0, np.nan)
+        width = np.where(hi_o > lo_o, hi_o - lo_o, np.abs(prev))
+        stable = np.abs(delta) <= width * LABS_TREND_STABLE_FRAC
+
+    def _f(x, nd=4):
+        return None if not np.isfinite(x) else round(float(x), nd)
+
+    series = {}
+    for k, i in enumerate(order):
+        r = rows[i]
+        name, unit = keys[i]
+        sid = name if (name not in series or series[name]["unit"] == unit) else f"{name} [{unit}]"
+        s = series.setdefault(sid, {"analyte": name, "unit": unit, "points": []})
+        s["points"].append({
+            "report": r["report"],
+            "date": r.get("date"),
+            "name": r["name"],
+            "value": _f(v_o[k]),
+            "low": _f(lo_o[k]),
+            "high": _f(hi_o[k]),
+            "status": r["status"],
+            "direction": r["direction"],
+            "delta": _f(delta[k]),
+            "delta_pct": _f(delta_pct[k], 1),
+            "trend": None if not np.isfinite(delta[k]) else ("stable" if stable[k] else ("rising" if delta[k] > 0 else "falling")),
+        })
+
+    for s in series.values():
+        pts = s["points"]
+        last = pts[-1]
+        s["latest"] = last["value"]
+        s["trend"] = last["trend"]
+        s["status_change"] = None
+        if len(pts) > 1:
+            before, now = pts[-2]["status"], last["status"]
+            if now == "abnormal" and before != "abnormal":
+                s["status_change"] = "became_abnormal"
+            elif before == "abnormal" and now in ("normal", "borderline"):
+                s["status_change"] = "returned_to_range"
+        # consistent direction across every step (e.g. a creatinine that keeps climbing)
+        steps = [p["trend"] for p in pts[1:]]
+        s["sustained"] = bool(steps) and len(steps) >= 2 and len(set(steps)) == 1 and steps[0] != "stable"
+    return series
+
+
+@app.post("/labs/parse-batch")
+def labs_parse_batch():
+    """
+    Body: { "reports": [ {"text": "...", "date": "2024-05-01", "label": "admission"}, ... ], "use_llm": true }
+    Returns: {
+      "reports": [ {index, date, label, labs:[...], parse_report} ... ],
+      "series":  { analyte: {analyte, unit, latest, trend, status_change, sustained, points:[...]} },
+      "summary": {...}
+    }
+
+    Reports are ordered by "date" when every report has an ISO date, otherwise as given.
+    All values are classified in one vectorized pass; trends use the catalog unit when convertible.
+    """
+    payload = request.get_json(silent=True) or {}
+    reports = [r for r in (payload.get("reports") or []) if isinstance(r, dict) and (r.get("text") or "").strip()]
+    if not reports:
+        return jsonify({"reports": [], "series": {}, "summary": {"reports": 0}}), 200
+    if len(reports) > LABS_BATCH_MAX_REPORTS:
+        return jsonify({"error": f"Too many reports (max {LABS_BATCH_MAX_REPORTS})"}), 400
+    use_llm = payload.get("use_llm", True) is not False
+
+    dated = [_report_sort_key(r) for r in reports]
+    if all(d is not None for d in dated):
+        reports = [r for _, r in sorted(zip(dated, reports), key=lambda p: p[0])]
+
+    t0 = time.perf_counter()
+    out_reports, rows = [], []
+    llm_calls = 0
+    for idx, rep in enumerate(reports):
+        local_rows, leftovers, report = _local_parse_labs(rep["text"].strip())
+        seen = set()
+        labs = _finalize_lab_rows(local_rows, seen, "local", classify=False)
+        report["llm_used"] = False
+        if leftovers and use_llm:
+            labs += _finalize_lab_rows(_llm_extract_labs("\n".join(leftovers)), seen, "llm", classify=False)
+            report["llm_used"] = True
+            llm_calls += 1
+        # one value per analyte per report (first wins, as printed)
+        per_analyte = set()
+        kept = []
+        for r in labs:
+            if r["canonical"] in per_analyte:
+                continue
+            per_analyte.add(r["canonical"])
+            r["report"] = idx
+            r["date"] = rep.get("date")
+            kept.append(r)
+        rows += kept
+        out_reports.append({"index": idx, "date": rep.get("date"), "label": rep.get("label"),
+                            "labs": kept, "parse_report": report})
+    t_parse = time.perf_counter()
+
+    status, direction = _classify_batch(
+        [r["value"] for r in rows],
+        [np.nan if r["low"] is None else r["low"] for r in rows],
+        [np.nan if r["high"] is None else r["high"] for r in rows],
+    )
+    for r, st, dr in zip(rows, status, direction):
+        r["status"], r["direction"] = st, dr
+    for rep in out_reports:
+        rep["labs"] = [r for r in rep["labs"] if r["status"] is not None]
+    rows = [r for r in rows if r["status"] is not None]
+    t_cls = time.perf_counter()
+
+    series = _lab_series(rows)
+    t1 = time.perf_counter()
+    return jsonify({
+        "reports": out_reports,
+        "series": series,
+        "summary": {
+            "reports": len(out_reports),
+            "values": len(rows),
+            "analytes": len(series),
+            "abnormal_latest": sorted(k for k, s in series.items() if s["points"][-1]["status"] == "abnormal"),
+            "llm_calls": llm_calls,
+            "parse_ms": round((t_parse - t0) * 1000, 3),
+            "classify_ms": round((t_cls - t_parse) * 1000, 3),
+            "series_ms": round((t1 - t_cls) * 1000, 3),
+            "total_ms": round((t1 - t0) * 1000, 3),
+        },
+    }), 200
+# ---------- Utilities ----------
+
+def _json_only(s: str):
+    try:
+        return json.loads(re.sub(r"```json|```", "", (s or "").strip(), flags=re.I))
+    except Exception:
+        m = re.search(r"\{[\s\S]*\}", s or "")
+        if m:
+            try: return json.loads(m.group(0))
+            except Exception: pass
+    return None
 
 def _norm_token(s: str) -> str:
     t = re.sub(r"[^a-z0-9\s\-]", " ", (s or "").lower())
@@ -2782,29 +3574,13 @@ def _best_generic_for_line(line: str, normalized_list: list[str]) -> str | None:
     L = _norm_token(line or "")
     for g in normalized_list or []:
         gt = _norm_token(g)
-        if re.search(rf"\b{re.escape(gt)}\b", L) or gt in L:
+        if gt and gt in L:  # substring test already covers the whole-word case
             return g
     return None
 
 # ---------- Local parsing helpers (no external services) ----------
-
-STRENGTH_RX = r"(?P<strength>\d+(?:\.\d+)?)(?:\s*)(?P<unit>mg|mcg|g|iu|units|ml)\b"
-FREQ_WORDS   = r"(once daily|twice daily|three times daily|every\s*\d+\s*(?:h|hr|hrs|hours)|bid|tid|qid|q\d+h|qhs|qam|qpm|prn)"
-FORM_WORDS   = r"(tablet|tab|capsule|cap|syrup|solution|suspension|patch|injection|cream|ointment|drops|spray)"
-ROUTE_WORDS  = r"(po|oral|by mouth|iv|im|sc|subcut|subcutaneous|topical|inhalation|ophthalmic|otic|nasal|rectal|vaginal)"
-
-NAME_FIRST_RX = re.compile(
-    rf"""
-    ^\s*
-    (?P<name>[A-Za-z][A-Za-z0-9\-\s']+)
-    (?:[,;\s]+{STRENGTH_RX})?
-    (?:[,;\s]+(?P<form>{FORM_WORDS}))?
-    (?:[,;\s]+(?P<route>{ROUTE_WORDS}))?
-    (?:[,;\s]+(?P<frequency>{FREQ_WORDS}))?
-    (?:[,;\s]+(?P<prn>prn))?
-    """,
-    re.IGNORECASE | re.VERBOSE,
-)
+# Token-trie parser (see med_parser.py); the legacy NAME_FIRST_RX is kept there for med_bench.py.
+import med_parser
 
 def _clean_str(s: str | None) -> str | None:
     if s is None: return None
@@ -2821,20 +3597,7 @@ def _normalize_lines(text: str) -> list[str]:
     return out
 
 def _parse_line(line: str) -> dict | None:
-    m = NAME_FIRST_RX.search(line or "")
-    if not m:
-        return None
-    d = m.groupdict()
-    return {
-        "name": _clean_str(d.get("name")),
-        "strength": _clean_str(d.get("strength")),
-        "unit": _clean_str(d.get("unit")),
-        "form": _clean_str(d.get("form")),
-        "route": _clean_str(d.get("route")),
-        "frequency": _clean_str(d.get("frequency")),
-        "prn": True if (d.get("prn") or "").lower() == "prn" else False,
-        "raw": (line or "").strip(),
-    }
+    return med_parser.parse_line(line)
 
 # ---------- Dedicated Drug RAG chain (Qdrant-backed) ----------
 
@@ -2850,6 +3613,110 @@ def get_drug_context_retriever_chain():
     ])
     return create_history_aware_retriever(llm, retriever, query_prompt)
 
+# ---------- Pairwise interaction findings (cached per sorted generic pair) ----------
+import interaction_store
+from itertools import combinations
+from concurrent.futures import wait as _futures_wait, FIRST_COMPLETED
+
+MED_PAIR_WORKERS = int(os.getenv("MED_PAIR_WORKERS", "4"))
+MED_PAIR_MAX = int(os.getenv("MED_PAIR_MAX", "120"))              # pairs looked up per request
+MED_PAIR_DEADLINE_S = float(os.getenv("MED_PAIR_DEADLINE_S", "25"))  # wait for new pairs before synthesizing
+MED_ANALYSIS_MODEL = os.getenv("MED_ANALYSIS_MODEL", "gpt-4o")
+MED_PAIR_POOL = ThreadPoolExecutor(max_workers=MED_PAIR_WORKERS, thread_name_prefix="med-pair")
+_DRUG_RETRIEVER = None
+_DRUG_RETRIEVER_LOCK = threading.Lock()
+
+
+def _drug_retriever():
+    global _DRUG_RETRIEVER
+    with _DRUG_RETRIEVER_LOCK:
+        if _DRUG_RETRIEVER is None:
+            _DRUG_RETRIEVER = get_drug_context_retriever_chain()
+        return _DRUG_RETRIEVER
+
+
+def _pair_finding(a: str, b: str) -> dict | None:
+    """Retrieve sources for one pair, ask for a structured finding, store it. None on failure."""
+    try:
+        docs = _drug_retriever().invoke({"chat_history": [], "input": f"Drug interaction between {a} and {b}"}) or []
+        context = "\n\n".join((getattr(d, "page_content", "") or "")[:1500] for d in docs[:4])
+        system = (
+            "You are a clinical pharmacology assistant. Using ONLY the provided sources (and well-established "
+            "pharmacology when the sources are silent), describe the interaction between the two drugs.\n"
+            "Return STRICT JSON: {\"severity\": \"none|minor|moderate|major|contraindicated\", "
+            "\"mechanism\": string|null, \"effect\": string|null, \"management\": string|null}. "
+            "Keep each field to one sentence. No markdown."
+        )
+        resp = client.chat.completions.create(
+            model=STRUCTURE_MODEL,
+            temperature=0,
+            messages=[{"role": "system", "content": system},
+                      {"role": "user", "content": f"Drugs: {a} + {b}\n\nSources:\n{context or '(none)'}"}],
+        )
+        doc = _extract_json_dict((resp.choices[0].message.content or "").strip()) or {}
+        severity = str(doc.get("severity") or "").strip().lower()
+        if severity not in interaction_store.SEVERITIES:
+            # unparseable answer: storing it would pin the pair for the whole TTL
+            log.warning(f"interaction lookup for {a} + {b} returned no usable severity: {severity or '(none)'}")
+            return None
+        finding = {
+            "severity": severity,
+            "mechanism": doc.get("mechanism"),
+            "effect": doc.get("effect"),
+            "management": doc.get("management"),
+            "sources": len(docs),
+        }
+        return interaction_store.put(a, b, finding)
+    except Exception as e:
+        log.warning(f"interaction lookup failed for {a} + {b}: {e}")
+        return None
+
+
+def _regimen_generics(meds: list, mapped: list) -> list[str]:
+    """Distinct lowercase generics: /meds/map rxnorm name, parsed generic, learned index, then raw name."""
+    out, seen = [], set()
+    for i, m in enumerate(meds):
+        m = m if isinstance(m, dict) else {"name": str(m)}
+        mp = mapped[i] if i < len(mapped) and isinstance(mapped[i], dict) else {}
+        g = (mp.get("rxnorm") or {}).get("name") or m.get("generic")
+        if not g:
+            hit = med_index.lookup(m.get("name") or "")
+            g = hit["generic"] if hit else m.get("name")
+        g = (g or "").strip().lower()
+        if g and g not in seen:
+            seen.add(g)
+            out.append(g)
+    return out
+
+
+def _regimen_cached_pairs(generics: list[str]):
+    """(pairs, findings, missing): store hits keyed by pair, and the pairs that still need a lookup."""
+    pairs = list(combinations(generics, 2))[:MED_PAIR_MAX]
+    findings, missing = {}, []
+    for a, b in pairs:
+        hit = interaction_store.get(a, b)
+        if hit:
+            findings[interaction_store.pair_key(a, b)] = hit
+        else:
+            missing.append((a, b))
+    return pairs, findings, missing
+
+
+def _fetch_pair_findings(missing: list, findings: dict):
+    """Look up missing pairs in parallel up to MED_PAIR_DEADLINE_S, adding them to `findings`; (fetched, pending)."""
+    futures = {MED_PAIR_POOL.submit(_pair_finding, a, b): (a, b) for a, b in missing}
+    done, pending = _futures_wait(futures, timeout=MED_PAIR_DEADLINE_S) if futures else (set(), set())
+    fetched = 0
+    for fut in done:
+        res = fut.result()
+        if res:
+            findings[interaction_store.pair_key(*futures[fut])] = res
+            fetched += 1
+    if missing:
+        interaction_store.save()  # pending futures still store their result when they finish
+    return fetched, len(pending)
+
+
 # ---------- ROUTES (POST + OPTIONS to satisfy preflight) ----------
 
 @app.route("/meds/parse", methods=["POST", "OPTIONS"])
@@ -2866,6 +3733,9 @@ def meds_parse():
     return jsonify({"meds": meds})
 
 # ====================== helpers for /meds/map (RAG-only) ======================
+# Names seen before (lexicon or earlier RAG answers) resolve from med_index.py without a model call.
+import med_index
+MED_MAP_BATCH = int(os.getenv("MED_MAP_BATCH", "40"))  # unknown lines per RAG call
 
 def _slugify_generic(name: str) -> str:
     """Deterministic, URL-safe id from a generic name (used as pseudo RxCUI)."""
@@ -2948,10 +3818,11 @@ def _rag_map_meds(meds: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
 @app.post("/meds/map")
 def meds_map():
     """
-    RAG-only canonicalization & duplicate detection.
+    Canonicalization & duplicate detection (learned index first, RAG for unknown names).
     Request: { "meds": [ { name,strength,unit,form,route,frequency,prn,raw } ... ] }
     Response: { "mapped": [ { name,strength,unit,form,route,frequency,prn, raw,
-                               rxnorm: { rxcui, name }, dup: bool } ... ] }
+                               rxnorm: { rxcui, name }, dup: bool } ... ],
+                "map_report": { local, sent_to_llm, llm_batches, total_ms, index: {...} } }
     - rxnorm.rxcui is a deterministic slug from generic name (pseudo-RxCUI).
     - 'dup' is true when multiple entries share the same generic slug.
     """
@@ -2960,12 +3831,38 @@ def meds_map():
     if not isinstance(meds, list):
         return jsonify({"error": "meds must be a list"}), 400
 
-    # 1) Ask RAG to canonicalize (best effort)
-    rag = _rag_map_meds(meds)
-
-    # 2) Merge RAG output into original rows (preserving any parsed fields)
+    t0 = time.perf_counter()
+    # 1) Resolve names already in the learned index (lexicon + past RAG mappings)
+    rag_by_idx: Dict[int, Dict[str, Any]] = {}
+    unknown: List[int] = []
+    for i, m in enumerate(meds):
+        hit = med_index.lookup(m.get("name") or "") if isinstance(m, dict) else None
+        if hit:
+            rag_by_idx[i] = {
+                "index": i,
+                "generic": hit["generic"],
+                "form": m.get("form") or hit.get("form"),
+                "route": m.get("route") or hit.get("route"),
+            }
+        else:
+            unknown.append(i)
+
+    # 2) Ask RAG to canonicalize only the unknown lines (best effort, batched), and learn the answers
+    llm_batches = 0
+    for b in range(0, len(unknown), MED_MAP_BATCH):
+        chunk = unknown[b:b + MED_MAP_BATCH]
+        llm_batches += 1
+        for it in _rag_map_meds([meds[i] for i in chunk]):
+            i = chunk[it["index"]]
+            it["index"] = i
+            rag_by_idx[i] = it
+            if it.get("generic"):
+                med_index.learn(meds[i].get("name") or "", it["generic"], it.get("form"), it.get("route"))
+    if unknown:
+        med_index.save()
+
+    # 3) Merge mapped output into original rows (preserving any parsed fields)
     merged: List[Dict[str, Any]] = []
-    rag_by_idx = {it["index"]: it for it in rag}
 
     for i, m in enumerate(meds):
         r = rag_by_idx.get(i, {})
@@ -2991,7 +3888,7 @@ def meds_map():
             },
         })
 
-    # 3) Duplicate marking by canonical id (slug)
+    # 4) Duplicate marking by canonical id (slug)
     bucket: Dict[str, List[int]] = {}
     for idx, m in enumerate(merged):
         key = (m.get("rxnorm") or {}).get("rxcui") or ""
@@ -3004,7 +3901,19 @@ def meds_map():
             for i in idxs:
                 merged[i]["dup"] = True
 
-    return jsonify({"mapped": merged}), 200
+    report = {
+        "local": len(meds) - len(unknown),
+        "sent_to_llm": len(unknown),
+        "llm_batches": llm_batches,
+        "total_ms": round((time.perf_counter() - t0) * 1000, 1),
+        "index": med_index.stats(),
+    }
+    return jsonify({"mapped": merged, "map_report": report}), 200
+
+
+@app.get("/meds/index-stats")
+def meds_index_stats():
+    return jsonify(med_index.stats()), 200
 
 
 # ========================= /meds/analyze-stream (NEW) ==========================
@@ -3020,6 +3929,11 @@ def meds_analyze_stream():
       "interactions": [...]
     }
     Response: text/plain stream with token-by-token analysis
+              (X-Interaction-Pairs / -Cached / -Pending headers report the pair lookups and arrive at
+              once; "pending" pairs are looked up inside the stream before the first token. The body is
+              model output only)
+
+    Pair findings are reused from interaction_store; the model only streams the synthesis.
     """
     data = request.get_json(silent=True) or {}
     session_id = data.get("session_id", str(uuid4()))
@@ -3031,11 +3945,26 @@ def meds_analyze_stream():
     if not meds:
         return Response("No medications provided", status=400, mimetype="text/plain")
 
-    # Build analysis prompt
+    # Pair findings come from the interaction store; only pairs never seen before hit the retriever.
+    # Cached pairs are read here; new ones are looked up inside the stream so the response starts at once.
+    generics = _regimen_generics(meds, mapped)
+    pairs, findings, missing = _regimen_cached_pairs(generics)
+
     med_list = "\n".join([f"- {m.get('name', 'Unknown')}" for m in meds])
     interactions_str = "\n".join([str(i) for i in interactions]) if interactions else "None detected"
 
-    prompt = f"""
+    def build_prompt():
+        flagged = sorted(
+            (f for f in findings.values() if f.get("severity") not in (None, "none")),
+            key=lambda f: -interaction_store.SEVERITIES.index(f["severity"]) if f["severity"] in interaction_store.SEVERITIES else 0,
+        )
+        pair_lines = "\n".join(
+            f"- {' + '.join(f['pair'])} [{f['severity']}]: {f.get('effect') or ''} "
+            f"Mechanism: {f.get('mechanism') or 'n/a'}. Management: {f.get('management') or 'n/a'}"
+            for f in flagged
+        ) or "No clinically relevant pairwise interactions found."
+
+        return f"""
 Provide a concise clinical analysis of the following medications and their interactions:
 
 Medications:
@@ -3044,7 +3973,10 @@ Medications:
 Clinical Text Context:
 {text}
 
-Medication Interactions Detected:
+Pairwise interaction findings ({len(pairs)} pairs checked):
+{pair_lines}
+
+Medication Interactions Detected (client):
 {interactions_str}
 
 Please provide:
@@ -3058,15 +3990,13 @@ Be brief and clinician-focused. Use professional medical language.
 
     def generate():
         try:
+            if missing:
+                yield ""  # flushes the status line + headers (the pending count) before the lookups
+                _fetch_pair_findings(missing, findings)
             acc = ""
-            for chunk in conversation_rag_chain.stream({
-                "chat_history": chat_sessions.get(session_id, []),
-                "input": prompt
-            }):
-                token = chunk.get("answer", "")
-                if token:
-                    acc += token
-                    yield token
+            for token in _openai_chat_stream([{"role": "user", "content": build_prompt()}], model=MED_ANALYSIS_MODEL):
+                acc += token
+                yield token
             # Store in session history
             chat_sessions.setdefault(session_id, [])
             chat_sessions[session_id].append({"role": "user", "content": "[Medication Analysis]"})
@@ -3077,9 +4007,17 @@ Be brief and clinician-focused. Use professional medical language.
     resp = Response(stream_with_context(generate()), mimetype="text/plain; charset=utf-8")
     resp.headers["X-Accel-Buffering"] = "no"
     resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Interaction-Pairs"] = str(len(pairs))
+    resp.headers["X-Interaction-Cached"] = str(len(pairs) - len(missing))
+    resp.headers["X-Interaction-Pending"] = str(len(missing))
     return resp
 
 
+@app.get("/meds/interaction-stats")
+def meds_interaction_stats():
+    return jsonify(interaction_store.stats()), 200
+
+
 # ===================== Streaming Symptom Analysis (NEW) ========================
 
 @app.post("/api/symptoms/triage-stream")
@@ -3269,9 +4207,13 @@ Patient transcript:
     return resp
 
 # ============================== Medical Vision ==============================
+import vision_files  # upload-once image handles shared by phase A and phase B
+
 # In-memory caches (swap to Redis/DB in production)
-VISION_CACHE = {}        # image_id -> {"data_url": ..., "meta": {...}, "session_id": ...}
+VISION_CACHE = {}        # image_id -> {"handle": {...}, "meta": {...}, "session_id": ..., "created_at": ...}
 SESSION_CONTEXT = {}     # session_id -> {"transcript": "...", "summary": "...", ...}
+VISION_REPORTS: "OrderedDict[str, dict]" = OrderedDict()  # image_id -> final report text + timings
+VISION_REPORTS_MAX = int(os.getenv("VISION_REPORTS_MAX", "500"))
 # ^ If you already have a context store from /set-context, reuse that instead of this dict.
 
 MEDICAL_VISION_SYSTEM_PROMPT = (
@@ -3282,13 +4224,31 @@ MEDICAL_VISION_SYSTEM_PROMPT = (
     "Never fabricate measurements; do not claim a diagnosis."
 )
 
-def _file_to_data_url(file_storage):
+def _read_upload_image(file_storage, profile: str = "vision"):
+    """Read an upload, fit it to the vision payload budget; returns (bytes, mimetype, prep_report)."""
     data = file_storage.read()
     if not data:
-        return None
+        return None, None, None
     mimetype = file_storage.mimetype or "application/octet-stream"
+    return image_prep.prepare_image(data, mimetype, profile)
+
+def _file_to_data_url(file_storage, profile: str = "vision"):
+    """Read an upload, fit it to the vision payload budget; returns (data_url, prep_report)."""
+    data, mimetype, prep = _read_upload_image(file_storage, profile)
+    if not data:
+        return None, None
     b64 = base64.b64encode(data).decode("ascii")
-    return f"data:{mimetype};base64,{b64}"
+    return f"data:{mimetype};base64,{b64}", prep
+
+def _vision_cache_prune():
+    """Forget studies whose uploaded image handle has expired."""
+    cutoff = time.time() - vision_files.VISION_FILES_TTL_S
+    for image_id, rec in list(VISION_CACHE.items()):
+        if rec.get("created_at", 0) < cutoff:
+            VISION_CACHE.pop(image_id, None)
+
+def _payload_bytes(payload) -> int:
+    return len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
 
 def _get_session_context_text(session_id: str) -> str:
     """
@@ -3326,6 +4286,79 @@ def _extract_numbered_questions(markdown_text: str):
                 out.append(q)
     return out
 
+def _vision_phase_b_prepare(data: dict):
+    """Validate a phase-B body -> (image_id, input_b, meta, error); the image is referenced by its handle."""
+    image_id = (data.get("image_id") or "").strip()
+    answers = data.get("answers")
+    session_id = (data.get("session_id") or "").strip() or None
+
+    if not image_id:
+        return None, None, None, "Missing image_id."
+    if answers is None:
+        return None, None, None, "Missing answers (array or string)."
+
+    rec = VISION_CACHE.get(image_id)
+    if not rec or not vision_files.alive(rec["handle"]["file_id"]):
+        VISION_CACHE.pop(image_id, None)
+        return None, None, None, "Unknown or expired image_id."
+
+    handle = rec["handle"]
+    meta = dict(rec["meta"])
+    ctx_text = _get_session_context_text(session_id or rec.get("session_id"))
+
+    if isinstance(answers, list):
+        answers_text = "\n".join(f"- {a}" for a in answers if str(a).strip())
+    else:
+        answers_text = str(answers or "").strip()
+
+    # Compose FINAL report with answers + context
+    input_b = [
+        {
+            "role": "system",
+            "content": [
+                {"type": "input_text", "text": MEDICAL_VISION_SYSTEM_PROMPT},
+                {"type": "input_text", "text":
+                    "You are now in PHASE B (final report). "
+                    "Integrate: case context, the image, and the doctor's answers. "
+                    "Return a concise, physician-facing read with this structure:\n"
+                    "1) Modality & adequacy (if relevant)\n"
+                    "2) Key findings (bulleted, precise)\n"
+                    "3) Focused differential with rationale\n"
+                    "4) Recommendations (next steps / measurements / views)\n"
+                    "5) Safety red flags\n"
+                    "Avoid patient-facing language. Do not fabricate measurements."
+                 },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {"type": "input_text", "text":
+                    f"CASE CONTEXT (from session {session_id or 'n/a'}):\n{ctx_text}"
+                 },
+                {"type": "input_text", "text":
+                    f"PHASE B – DOCTOR ANSWERS:\n{answers_text or 'No additional answers provided.'}"
+                 },
+                vision_files.image_part(handle),
+            ],
+        },
+    ]
+    b_bytes = _payload_bytes(input_b)
+    vision_files.record_request(b_bytes)
+
+    transfer = dict(meta.get("transfer") or {}, phase_b_request_bytes=b_bytes)
+    transfer["total_sent_bytes"] = (transfer.get("uploaded_bytes", 0) + transfer.get("phase_a_request_bytes", 0)
+                                    + b_bytes)
+    meta["transfer"] = transfer
+    return image_id, input_b, meta, None
+
+def _vision_save_report(image_id: str, text: str, meta: dict, **timing):
+    """Keep the final report for GET /vision/report/<image_id> (bounded, oldest evicted)."""
+    VISION_REPORTS[image_id] = {"image_id": image_id, "text": text, "meta": meta, "saved_at": time.time(), **timing}
+    VISION_REPORTS.move_to_end(image_id)
+    while len(VISION_REPORTS) > VISION_REPORTS_MAX:
+        VISION_REPORTS.popitem(last=False)
+
 @app.route("/vision/analyze", methods=["POST"])
 def vision_analyze():
     """
@@ -3347,6 +4380,7 @@ def vision_analyze():
       { "image_id": "<from init>", "answers": ["...","..."], "session_id": "..." }
     -> returns:
        { phase: "final", text: "<final report markdown>", meta: {...} }
+       (POST /vision/analyze-stream takes the same body and streams the report instead)
     """
     try:
         # -------- PHASE A: INIT (upload) --------
@@ -3355,10 +4389,15 @@ def vision_analyze():
             if not (f and (f.mimetype or "").startswith("image/")):
                 return jsonify(error="Only image/* files are accepted."), 400
 
-            data_url = _file_to_data_url(f)
-            if not data_url:
+            data, mimetype, prep = _read_upload_image(f)
+            if not data:
                 return jsonify(error="Empty file or read error."), 400
 
+            # Upload once; phase A and phase B reference the same file handle
+            vision_files.prune(client)
+            _vision_cache_prune()
+            handle = vision_files.upload(client, data, mimetype, secure_filename(f.filename or "") or "image.jpg")
+
             session_id = (request.form.get("session_id") or "").strip() or None
             user_prompt = request.form.get("prompt", "").strip() or \
                 "Before any final report, ask targeted follow-up questions you need to optimize the read."
@@ -3367,35 +4406,35 @@ def vision_analyze():
 
             # Compose: ask QUESTIONS FIRST (no final report yet)
             # Return a short, physician-facing set of 3–6 targeted questions.
-            init_resp = client.responses.create(
-                model="gpt-4o",
-                input=[
-                    {
-                        "role": "system",
-                        "content": [
-                            {"type": "input_text", "text": MEDICAL_VISION_SYSTEM_PROMPT},
-                            {"type": "input_text", "text":
-                                "You are in PHASE A (follow-up questions first). "
-                                "Given the image and case context, produce 3–6 concise, targeted questions "
-                                "that would materially change or sharpen your final read. "
-                                "Prefer specifics (e.g., acuity, clinical status, device placement context, "
-                                "prior comparisons, suspected complication). "
-                                "Do NOT produce a final report in this phase."
-                             },
-                        ],
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "input_text", "text":
-                                f"CASE CONTEXT (from session {session_id or 'n/a'}):\n{ctx_text}\n\n"
-                                f"PHASE A TASK: {user_prompt}"
-                             },
-                            {"type": "input_image", "image_url": data_url},
-                        ],
-                    },
-                ],
-            )
+            input_a = [
+                {
+                    "role": "system",
+                    "content": [
+                        {"type": "input_text", "text": MEDICAL_VISION_SYSTEM_PROMPT},
+                        {"type": "input_text", "text":
+                            "You are in PHASE A (follow-up questions first). "
+                            "Given the image and case context, produce 3–6 concise, targeted questions "
+                            "that would materially change or sharpen your final read. "
+                            "Prefer specifics (e.g., acuity, clinical status, device placement context, "
+                            "prior comparisons, suspected complication). "
+                            "Do NOT produce a final report in this phase."
+                         },
+                    ],
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text":
+                            f"CASE CONTEXT (from session {session_id or 'n/a'}):\n{ctx_text}\n\n"
+                            f"PHASE A TASK: {user_prompt}"
+                         },
+                        vision_files.image_part(handle),
+                    ],
+                },
+            ]
+            a_bytes = _payload_bytes(input_a)
+            vision_files.record_request(a_bytes)
+            init_resp = client.responses.create(model="gpt-4o", input=input_a)
 
             text = init_resp.output_text or "Please answer the follow-up questions to proceed."
             questions = _extract_numbered_questions(text)
@@ -3405,11 +4444,19 @@ def vision_analyze():
                 "filename": getattr(f, "filename", None),
                 "mimetype": f.mimetype,
                 "size": request.content_length or None,
+                "image_prep": prep,
+                "transfer": {
+                    "image_bytes": handle["bytes"],
+                    "uploaded_bytes": 0 if handle["reused"] else handle["bytes"],
+                    "handle_reused": handle["reused"],
+                    "phase_a_request_bytes": a_bytes,
+                },
             }
             VISION_CACHE[image_id] = {
-                "data_url": data_url,
+                "handle": handle,
                 "meta": meta,
                 "session_id": session_id,
+                "created_at": time.time(),
             }
 
             return jsonify(
@@ -3421,70 +4468,81 @@ def vision_analyze():
             ), 200
 
         # -------- PHASE B: FINALIZE (answers -> final report) --------
-        data = request.get_json(silent=True) or {}
-        image_id = (data.get("image_id") or "").strip()
-        answers = data.get("answers")
-        session_id = (data.get("session_id") or "").strip() or None
-
-        if not image_id:
-            return jsonify(error="Missing image_id."), 400
-        if answers is None:
-            return jsonify(error="Missing answers (array or string)."), 400
-
-        rec = VISION_CACHE.get(image_id)
-        if not rec:
-            return jsonify(error="Unknown or expired image_id."), 400
+        image_id, input_b, meta, err = _vision_phase_b_prepare(request.get_json(silent=True) or {})
+        if err:
+            return jsonify(error=err), 400
 
-        data_url = rec["data_url"]
-        meta = rec["meta"]
-        ctx_text = _get_session_context_text(session_id or rec.get("session_id"))
-
-        if isinstance(answers, list):
-            answers_text = "\n".join(f"- {a}" for a in answers if str(a).strip())
-        else:
-            answers_text = str(answers or "").strip()
-
-        # Compose FINAL report with answers + context
-        final_resp = client.responses.create(
-            model="gpt-4o",
-            input=[
-                {
-                    "role": "system",
-                    "content": [
-                        {"type": "input_text", "text": MEDICAL_VISION_SYSTEM_PROMPT},
-                        {"type": "input_text", "text":
-                            "You are now in PHASE B (final report). "
-                            "Integrate: case context, the image, and the doctor's answers. "
-                            "Return a concise, physician-facing read with this structure:\n"
-                            "1) Modality & adequacy (if relevant)\n"
-                            "2) Key findings (bulleted, precise)\n"
-                            "3) Focused differential with rationale\n"
-                            "4) Recommendations (next steps / measurements / views)\n"
-                            "5) Safety red flags\n"
-                            "Avoid patient-facing language. Do not fabricate measurements."
-                         },
-                    ],
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text":
-                            f"CASE CONTEXT (from session {session_id or 'n/a'}):\n{ctx_text}"
-                         },
-                        {"type": "input_text", "text":
-                            f"PHASE B – DOCTOR ANSWERS:\n{answers_text or 'No additional answers provided.'}"
-                         },
-                        {"type": "input_image", "image_url": data_url},
-                    ],
-                },
-            ],
-        )
+        t0 = time.perf_counter()
+        final_resp = client.responses.create(model="gpt-4o", input=input_b)
 
         text = final_resp.output_text or "No report generated."
+        _vision_save_report(image_id, text, meta, streamed=False,
+                            total_ms=round((time.perf_counter() - t0) * 1000, 1))
         return jsonify(phase="final", text=text, meta=meta), 200
 
     except Exception as e:
         return jsonify(error=str(e)), 500
+
+
+
+@app.post("/vision/analyze-stream")
+def vision_analyze_stream():
+    """
+    Streaming phase B: same JSON body as /vision/analyze finalize
+      { "image_id": "...", "answers": [...], "session_id": "..." }
+    -> text/plain report tokens as they arrive. The final text (with ttft_ms / total_ms) is saved and
+       served by GET /vision/report/<image_id>.
+    """
+    image_id, input_b, meta, err = _vision_phase_b_prepare(request.get_json(silent=True) or {})
+    if err:
+        return jsonify(error=err), 400
+
+    def generate():
+        t0 = time.perf_counter()
+        ttft_ms, error = None, None
+        parts = []
+        try:
+            stream = client.responses.create(model="gpt-4o", input=input_b, stream=True)
+            for event in stream:
+                if getattr(event, "type", "") != "response.output_text.delta":
+                    continue
+                delta = getattr(event, "delta", "") or ""
+                if not delta:
+                    continue
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - t0) * 1000, 1)
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            error = str(e)
+            log.warning(f"vision stream failed for {image_id}: {e}")
+            yield f"\n[Error: {str(e)}]"
+        finally:
+            total_ms = round((time.perf_counter() - t0) * 1000, 1)
+            log.info(f"vision report {image_id}: ttft={ttft_ms}ms total={total_ms}ms")
+            _vision_save_report(image_id, "".join(parts) or "No report generated.", meta,
+                                streamed=True, ttft_ms=ttft_ms, total_ms=total_ms,
+                                error=error)
+
+    resp = Response(stream_with_context(generate()), mimetype="text/plain; charset=utf-8")
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/vision/report/<image_id>")
+def vision_report(image_id):
+    """Last saved phase-B report for the study (text, meta, ttft_ms/total_ms)."""
+    rec = VISION_REPORTS.get(image_id)
+    if rec is None:
+        return jsonify(error="No report for this image_id."), 404
+    return jsonify(rec), 200
+
+
+@app.get("/vision/metrics")
+def vision_metrics():
+    """Upload/reuse counts and bytes sent for /vision/analyze studies."""
+    return jsonify(vision_files.stats()), 200
 # Try to use your project's prompt; fall back if not present
 
 SYSTEM_PROMPT = (
@@ -3537,7 +4595,7 @@ _maybe_init_vector_store()
 LAB_SESS: Dict[str, Dict[str, Any]] = {}  # {session_id: {"context": str, "approved": [{"name", "why", "priority"}]}}
 
 
-def _sess(session_id: str):
+def _lab_sess(session_id: str):
     st = LAB_SESS.get(session_id)
     if not st:
         st = {"context": "", "approved": []}
@@ -3573,13 +4631,14 @@ def _rag_snippets(query: str, k: int = 3):
         return []
 
 
-def _build_context_instructions(transcript: str, approved):
+def _build_context_instructions(transcript: str, approved, rag_block: Optional[str] = None):
     transcript = (transcript or "").strip()
     approved_names = (
         ", ".join(sorted({(a.get("name") or "").strip() for a in (approved or []) if a.get("name")}))
         or "(none)"
     )
-    rag_block = "\n".join(_rag_snippets(transcript)) or "• No high-confidence context retrieved."
+    if rag_block is None:
+        rag_block = _lab_rag_block(transcript)
     return (
         "\n---\n"
         "### Current Case Transcript (English)\n"
@@ -3597,6 +4656,101 @@ def _build_context_instructions(transcript: str, approved):
     )
 
 
+# ---------- Precomputed context instructions (kept off the SDP / suggest path) ----------
+# Retrieval (embedding + Qdrant search) is keyed by the context hash only; the rendered
+# block is keyed by (context hash, approved set) so an approval re-renders without re-querying.
+LAB_RAG_CACHE: Dict[str, str] = {}              # context_sha -> rendered "Retrieved Context" lines
+LAB_CTX_CACHE: Dict[tuple, str] = {}            # (context_sha, approved_key) -> instruction block
+LAB_CTX_PENDING: Dict[str, threading.Event] = {}  # context_sha -> set when retrieval finishes
+LAB_CTX_LOCK = threading.Lock()
+LAB_CTX_MAX = int(os.getenv("LAB_CTX_CACHE_MAX", "256"))
+LAB_CTX_WAIT_S = float(os.getenv("LAB_CTX_WAIT_S", "3"))
+LAB_CTX_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("LAB_CTX_WORKERS", "2")),
+                                  thread_name_prefix="lab-ctx")
+
+
+def _lab_ctx_sha(transcript: str) -> str:
+    return hashlib.sha256((transcript or "").strip().encode("utf-8")).hexdigest()
+
+
+def _lab_approved_key(approved) -> tuple:
+    return tuple(sorted({(a.get("name") or "").strip().lower() for a in (approved or []) if a.get("name")}))
+
+
+def _lab_rag_block(transcript: str) -> str:
+    return "\n".join(_rag_snippets(transcript)) or "• No high-confidence context retrieved."
+
+
+def _lab_cache_put(cache: dict, key, value):
+    with LAB_CTX_LOCK:
+        cache[key] = value
+        while len(cache) > LAB_CTX_MAX:
+            cache.pop(next(iter(cache)))
+
+
+def _lab_retrieve(sha: str, transcript: str, ev: threading.Event):
+    try:
+        _lab_cache_put(LAB_RAG_CACHE, sha, _lab_rag_block(transcript))
+    except Exception as e:
+        log.warning(f"lab-agent context precompute failed: {e}")
+    finally:
+        with LAB_CTX_LOCK:
+            LAB_CTX_PENDING.pop(sha, None)
+        ev.set()
+
+
+def _lab_ctx_warm(transcript: str):
+    """Kick off background retrieval for this context (no-op if cached or in flight)."""
+    sha = _lab_ctx_sha(transcript)
+    with LAB_CTX_LOCK:
+        if sha in LAB_RAG_CACHE or sha in LAB_CTX_PENDING:
+            return sha
+        ev = threading.Event()
+        LAB_CTX_PENDING[sha] = ev
+    LAB_CTX_POOL.submit(_lab_retrieve, sha, transcript, ev)
+    return sha
+
+
+def _lab_ctx_invalidate(st: dict):
+    """Drop the rendered block for the session's previous approved set."""
+    key = st.pop("ctx_key", None)
+    if key:
+        with LAB_CTX_LOCK:
+            LAB_CTX_CACHE.pop(key, None)
+
+
+def _cached_context_instructions(st: dict) -> str:
+    """
+    Return the instruction block for a lab session, reading the precomputed copy when
+    available. Waits briefly for an in-flight retrieval; falls back to inline retrieval.
+    """
+    transcript = st.get("context") or ""
+    approved = st.get("approved") or []
+    sha = _lab_ctx_sha(transcript)
+    key = (sha, _lab_approved_key(approved))
+
+    block = LAB_CTX_CACHE.get(key)
+    if block is not None:
+        return block
+
+    if st.get("ctx_key") and st["ctx_key"] != key:
+        _lab_ctx_invalidate(st)
+
+    rag_block = LAB_RAG_CACHE.get(sha)
+    if rag_block is None:
+        ev = LAB_CTX_PENDING.get(sha)
+        if ev is not None and ev.wait(LAB_CTX_WAIT_S):
+            rag_block = LAB_RAG_CACHE.get(sha)
+    if rag_block is None:
+        rag_block = _lab_rag_block(transcript)
+        _lab_cache_put(LAB_RAG_CACHE, sha, rag_block)
+
+    block = _build_context_instructions(transcript, approved, rag_block=rag_block)
+    _lab_cache_put(LAB_CTX_CACHE, key, block)
+    st["ctx_key"] = key
+    return block
+
+
 # ---------- Simple per-session event bus for SSE ----------
 EVENTS: Dict[str, "queue.Queue[dict]"] = {}  # session_id -> Queue
 
@@ -3628,8 +4782,11 @@ def lab_agent_set_context():
     data = request.get_json(silent=True) or {}
     session_id = data.get("session_id") or str(uuid4())
     context = (data.get("context") or "").strip()
-    st = _sess(session_id)
+    st = _lab_sess(session_id)
+    if st.get("context") != context:
+        _lab_ctx_invalidate(st)
     st["context"] = context
+    _lab_ctx_warm(context)
     return jsonify({"ok": True, "session_id": session_id, "approved_count": len(st["approved"])}), 200
 
 
@@ -3639,7 +4796,7 @@ def lab_agent_list():
     session_id = request.args.get("session_id") or ""
     if not session_id:
         return jsonify({"ok": False, "error": "Missing session_id"}), 400
-    st = _sess(session_id)
+    st = _lab_sess(session_id)
     approved = st.get("approved", []) or []
     return jsonify(
         {
@@ -3663,7 +4820,7 @@ def lab_agent_tool_bridge():
     if not session_id or not tool:
         return jsonify({"ok": False, "error": "Missing session_id or tool"}), 400
 
-    st = _sess(session_id)
+    st = _lab_sess(session_id)
 
     if tool in ("approve_lab", "add_lab_manual"):
         item = _normalize_row(args) or {}
@@ -3673,6 +4830,7 @@ def lab_agent_tool_bridge():
                 for x in st["approved"]
             ):
                 st["approved"].append(item)
+                _lab_ctx_invalidate(st)
 
             _emit(session_id, {"type": "approved", "item": item})
             return (
@@ -3744,7 +4902,7 @@ def lab_agent_approve():
     if not item or not item.get("name"):
         return jsonify({"applied": False, "error": "Missing item.name"}), 400
 
-    st = _sess(session_id)
+    st = _lab_sess(session_id)
     approved = st.setdefault("approved", [])
 
     name_low = item["name"].strip().lower()
@@ -3755,6 +4913,7 @@ def lab_agent_approve():
             slug = re.sub(r"[^a-z0-9\-]+", "-", name_low).strip("-") or "lab"
             item["id"] = f"{slug}-{int(time.time() * 1000)}"
         approved.append(item)
+        _lab_ctx_invalidate(st)
 
     return jsonify({"applied": True, "item": item, "session_id": session_id}), 200
 
@@ -3770,14 +4929,14 @@ def lab_agent_suggest_stream():
     if not session_id:
         return Response(_sse({"type": "text", "content": "Missing session_id"}), mimetype="text/event-stream")
 
-    st = _sess(session_id)
+    st = _lab_sess(session_id)
 
     user_prompt = (
         "Return STRICT JSON ONLY (no prose): an array of up to 8 objects with EXACT keys "
         'name, why, priority (priority must be one of "STAT", "High", "Routine"). Example: '
         '[{"name":"Serum cortisol (AM)","why":"rule-out adrenal insufficiency","priority":"High"}].\n\n'
         "Use the case below, and avoid duplicates of already-approved.\n"
-        + _build_context_instructions(st.get("context"), st.get("approved"))
+        + _cached_context_instructions(st)
     )
 
     import re, json, requests, os, time
@@ -3874,8 +5033,8 @@ def lab_agent_rtc_connect():
     if not session_id:
         session_id = "anon"
 
-    st = _sess(session_id)
-    merged_instructions = SYSTEM_PROMPT + _build_context_instructions(st.get("context"), st.get("approved"))
+    st = _lab_sess(session_id)
+    merged_instructions = SYSTEM_PROMPT + _cached_context_instructions(st)
 
     tools = [
         # -------------- Labs (existing) --------------
@@ -4365,6 +5524,93 @@ def generate_notes():
     except Exception:
         data = {"error": "Failed to parse notes"}
     return jsonify(data)
+# Local DRG master (codes, labels, principal ICD-10 -> DRG); see drg_master.py
+import drg_master
+
+
+def _drg_second_json(item: dict):
+    """second_opinion_json (dict) or second_opinion_text (JSON somewhere in the text) -> dict | None."""
+    second = item.get("second_opinion_json") or item.get("second_opinion_text")
+    second_json = _json_or_first_block(second) if isinstance(second, str) else second
+    return second_json if isinstance(second_json, dict) else None
+
+
+def _drg_status_counts(rows: list) -> dict:
+    out = {"validated": 0, "review": 0, "flagged": 0}
+    for r in rows or []:
+        st = str((r or {}).get("status") or "").strip().lower()
+        if st in out:
+            out[st] += 1
+    return out
+
+
+def _drg_principal_icd10(second_json: dict) -> str:
+    pd = second_json.get("primary_diagnosis") if isinstance(second_json, dict) else None
+    return str((pd or {}).get("icd10") or "").strip() if isinstance(pd, dict) else ""
+
+
+def _drg_rule_row(patient_id: str, second_json: dict):
+    """
+    (row, candidates): a VALIDATED row when the principal ICD-10 maps to exactly one DRG in the local
+    master (no model call needed); otherwise row=None and the candidate DRGs (possibly empty).
+    """
+    principal = _drg_principal_icd10(second_json)
+    cands = drg_master.candidates_for(principal) if principal else []
+    if len(cands) != 1:
+        return None, cands
+    c = cands[0]
+    return {
+        "patient_id": patient_id,
+        "drg_code": {"code": c["code"], "label": c["label"]},
+        "status": "VALIDATED",
+        "nphies": "Ready",
+        "actions": ["Submit"],
+        "reasons_md": [f"Principal diagnosis **{principal}** maps to a single DRG in the DRG master: "
+                       f"**{c['code']} {c['label']}**."],
+        "suggested_fixes_md": [],
+        "master_match": True,
+        "source": "rule",
+    }, cands
+
+
+def _drg_check_rows(rows: list) -> list:
+    """Normalize model rows against the DRG master; unknown codes can't stay VALIDATED."""
+    out = []
+    for r in rows or []:
+        if not isinstance(r, dict):
+            continue
+        r = dict(r)
+        r.setdefault("source", "llm")
+        if drg_master.loaded():
+            m = drg_master.resolve(r.get("drg_code") or {})
+            r["master_match"] = m is not None
+            if m:
+                r["drg_code"] = {"code": m["code"], "label": m["label"]}
+            else:
+                given = (r.get("drg_code") or {}).get("code") if isinstance(r.get("drg_code"), dict) else r.get("drg_code")
+                r["reasons_md"] = list(r.get("reasons_md") or []) + [
+                    f"DRG code **{given or 'n/a'}** was not found in the DRG master; verify the code."]
+                if str(r.get("status") or "").upper() == "VALIDATED":
+                    r["status"], r["nphies"], r["actions"] = "REVIEW", "Review", ["Optimize"]
+        out.append(r)
+    return out
+
+
+def _drg_validate_one(patient_id: str, second_json: dict, chat_history=None):
+    """One validation -> (rows, summary): rule-based when unambiguous, else RAG checked against the master."""
+    rule_row, candidates = _drg_rule_row(patient_id, second_json)
+    if rule_row:
+        rows = [rule_row]
+        return rows, _drg_status_counts(rows)
+    prompt = _build_drg_validation_prompt(second_json, patient_id, candidates)
+    # Use your existing LangChain RAG chain (retrieves from Qdrant)
+    resp = conversation_rag_chain.invoke({"chat_history": chat_history or [], "input": prompt})
+    raw = (resp.get("answer") or "").strip()
+    parsed = _json_or_first_block(raw) or {}
+    rows = _drg_check_rows(parsed.get("rows") or [])
+    return rows, _drg_status_counts(rows)
+
+
 @app.route("/drg/validate", methods=["POST", "OPTIONS"])
 def drg_validate():
     if request.method == "OPTIONS":
@@ -4384,17 +5630,8 @@ def drg_validate():
     if not isinstance(second_json, dict):
         return jsonify({"error": "Invalid second_opinion_json"}), 400
 
-    prompt = _build_drg_validation_prompt(second_json, patient_id)
-
     try:
-        # Use your existing LangChain RAG chain (retrieves from Qdrant)
-        resp = conversation_rag_chain.invoke(
-            {"chat_history": chat_sessions.get(session_id, []), "input": prompt}
-        )
-        raw = (resp.get("answer") or "").strip()
-        parsed = _json_or_first_block(raw) or {}
-        rows = parsed.get("rows") or []
-        summary = parsed.get("summary") or {"validated": 0, "review": 0, "flagged": 0}
+        rows, summary = _drg_validate_one(patient_id, second_json, chat_sessions.get(session_id, []))
         return jsonify({"rows": rows, "summary": summary, "session_id": session_id}), 200
     except Exception as e:
         return jsonify({"error": f"Server error: {str(e)}"}), 500
@@ -4445,19 +5682,49 @@ def drg_validate_stream():
     if not isinstance(second_json, dict):
         return jsonify({"error": "Invalid second_opinion_json"}), 400
 
-    prompt = _build_drg_validation_prompt(second_json, patient_id)
+    rule_row, candidates = _drg_rule_row(patient_id, second_json)
+    if rule_row:
+        # Unambiguous in the local DRG master: the whole answer is known, send it in one chunk
+        body = json.dumps({"rows": [rule_row], "summary": _drg_status_counts([rule_row])}, ensure_ascii=False)
+        resp = Response(body, mimetype="text/plain; charset=utf-8")
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+
+    prompt = _build_drg_validation_prompt(second_json, patient_id, candidates)
 
     def generate():
+        # Text before the JSON block streams through; the block itself is buffered so its rows can be
+        # checked against the DRG master (like /drg/validate) before the client sees them.
+        buf = []
         try:
             for chunk in conversation_rag_chain.stream({
                 "chat_history": chat_sessions.get(session_id, []),
                 "input": prompt
             }):
                 token = chunk.get("answer", "")
-                if token:
+                if not token:
+                    continue
+                if buf:
+                    buf.append(token)
+                elif "{" in token:
+                    head, _, tail = token.partition("{")
+                    if head:
+                        yield head
+                    buf.append("{" + tail)
+                else:
                     yield token
         except Exception as e:
+            yield "".join(buf)
             yield f"\n[Error: {str(e)}]"
+            return
+        raw = "".join(buf)
+        parsed = _json_or_first_block(raw)
+        if not isinstance(parsed, dict) or not isinstance(parsed.get("rows"), list):
+            yield raw  # not the expected shape: pass it on unchanged
+            return
+        parsed["rows"] = _drg_check_rows(parsed["rows"])
+        parsed["summary"] = _drg_status_counts(parsed["rows"])
+        yield json.dumps(parsed, ensure_ascii=False)
 
     resp = Response(stream_with_context(generate()), mimetype="text/plain; charset=utf-8")
     resp.headers["X-Accel-Buffering"] = "no"
@@ -4499,6 +5766,291 @@ def drg_fix_stream():
     return resp
 
 
+# ===== BATCH DRG VALIDATION (NDJSON) =====
+DRG_BATCH_WORKERS = int(os.getenv("DRG_BATCH_WORKERS", "8"))        # shared pool across batch requests
+DRG_BATCH_MAX_ITEMS = int(os.getenv("DRG_BATCH_MAX_ITEMS", "1000"))
+DRG_BATCH_ITEM_DEADLINE_S = float(os.getenv("DRG_BATCH_ITEM_DEADLINE_S", "90"))
+DRG_BATCH_POOL = ThreadPoolExecutor(max_workers=DRG_BATCH_WORKERS, thread_name_prefix="drg-batch")
+
+
+@app.route("/drg/validate-batch", methods=["POST", "OPTIONS"])
+def drg_validate_batch():
+    """
+    Body: { "items": [ {"patient_id": "...", "second_opinion_json": {...}} ... ],
+            "concurrency": 4, "deadline_s": 90 }
+    Response: application/x-ndjson, one line per item as it completes (completion order):
+      {"type":"row","index":i,"patient_id":..,"rows":[..],"summary":{..},"ms":..}
+      {"type":"error","index":i,"patient_id":..,"error":"..."}       (bad input, model error or deadline)
+    and a final {"type":"summary","items":n,"summary":{validated,review,flagged,errors,timeouts},"ms":..}.
+
+    At most `concurrency` items of this batch are in flight (capped by DRG_BATCH_WORKERS); an item still
+    running after `deadline_s` is reported as a timeout and its late result is discarded.
+    """
+    if request.method == "OPTIONS":
+        return make_response(("", 204))
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > DRG_BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items (max {DRG_BATCH_MAX_ITEMS})"}), 400
+    try:
+        concurrency = max(1, min(int(data.get("concurrency") or DRG_BATCH_WORKERS), DRG_BATCH_WORKERS))
+        deadline_s = max(1.0, float(data.get("deadline_s") or DRG_BATCH_ITEM_DEADLINE_S))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency/deadline_s must be numbers"}), 400
+
+    def _line(obj):
+        return json.dumps(obj, ensure_ascii=False) + "\n"
+
+    def generate():
+        t0 = time.perf_counter()
+        totals = {"validated": 0, "review": 0, "flagged": 0, "errors": 0, "timeouts": 0}
+        queue_ = []
+        for i, it in enumerate(items):
+            it = it if isinstance(it, dict) else {}
+            pid = str(it.get("patient_id") or "").strip()
+            second_json = _drg_second_json(it)
+            if not (pid and second_json):
+                totals["errors"] += 1
+                yield _line({"type": "error", "index": i, "patient_id": pid or None,
+                             "error": "Missing patient_id or invalid second opinion"})
+                continue
+            queue_.append((i, pid, second_json))
+
+        started = {}  # index -> monotonic start (set by the worker, so queueing time doesn't count)
+
+        def run(i, pid, second_json):
+            started[i] = time.monotonic()
+            return _drg_validate_one(pid, second_json)
+
+        inflight = {}
+        pos = 0
+        while pos < len(queue_) or inflight:
+            while pos < len(queue_) and len(inflight) < concurrency:
+                i, pid, sj = queue_[pos]
+                inflight[DRG_BATCH_POOL.submit(run, i, pid, sj)] = (i, pid)
+                pos += 1
+            done, _ = _futures_wait(list(inflight), timeout=1.0, return_when=FIRST_COMPLETED)
+            for fut in done:
+                i, pid = inflight.pop(fut)
+                ms = round((time.monotonic() - started.get(i, time.monotonic())) * 1000, 1)
+                try:
+                    rows, _summary = fut.result()
+                    counts = _drg_status_counts(rows)
+                    for k, v in counts.items():
+                        totals[k] += v
+                    yield _line({"type": "row", "index": i, "patient_id": pid, "rows": rows,
+                                 "summary": counts, "ms": ms})
+                except Exception as e:
+                    totals["errors"] += 1
+                    yield _line({"type": "error", "index": i, "patient_id": pid, "error": str(e), "ms": ms})
+            now = time.monotonic()
+            for fut, (i, pid) in list(inflight.items()):
+                if i in started and now - started[i] > deadline_s:
+                    inflight.pop(fut)
+                    fut.cancel()  # no-op once running; the result is simply ignored
+                    totals["timeouts"] += 1
+                    yield _line({"type": "error", "index": i, "patient_id": pid,
+                                 "error": f"Deadline exceeded ({deadline_s:g}s)", "timeout": True})
+
+        yield _line({"type": "summary", "items": len(items), "summary": totals,
+                     "ms": round((time.perf_counter() - t0) * 1000, 1)})
+
+    resp = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/drg/master-stats")
+def drg_master_stats():
+    return jsonify(drg_master.stats()), 200
+
+
+# ===================== Offline jobs over the provider Batch API (DRG / notes / ICD-10) =====================
+# Overnight re-validation and regeneration: prompts are packed into one batch file, polled in the background
+# (batch_jobs.py) and each result is written back to SESSION_STORE[session_id]. BATCH_FAKE=1 runs against the
+# local fake batch server (batch_fake.py) instead of the provider.
+import batch_jobs
+import batch_fake
+
+BATCH_MODEL = os.getenv("BATCH_MODEL", "gpt-4o")
+BATCH_DRG_CONTEXT_K = int(os.getenv("BATCH_DRG_CONTEXT_K", "4"))   # DRG master excerpts packed per prompt
+BATCH_NOTES_MAX_CHARS = 20000
+BATCH_ICD10_TOP_K = int(os.getenv("BATCH_ICD10_TOP_K", "8"))
+_BATCH_FAKE_CLIENT = batch_fake.FakeBatchClient() if batch_jobs.BATCH_FAKE else None
+
+BATCH_ICD10_SYSTEM = (
+    "You are an ICD-10 coding assistant. From the encounter transcript, suggest the ICD-10-CM codes "
+    "that the documentation supports. Return STRICT JSON ONLY. "
+    "Schema: {\"results\":[{\"code\":\"string\",\"label\":\"string\"}]}. "
+    f"Return up to {BATCH_ICD10_TOP_K} high-confidence codes, most specific first; no commentary."
+)
+
+
+def _batch_client():
+    return _BATCH_FAKE_CLIENT or client
+
+
+def _batch_write(session_id: str, key: str, value, job_id: str):
+    SESSION_STORE[session_id][key] = value
+    SESSION_STORE[session_id].setdefault("batch", {})[key] = {"job_id": job_id, "at": time.time()}
+
+
+def _batch_session_ids(d: dict) -> list:
+    """Requested session_ids, or every session with a transcript."""
+    ids = d.get("session_ids")
+    if isinstance(ids, list):
+        return [str(x) for x in ids if str(x) in SESSION_STORE]
+    return [sid for sid, st in list(SESSION_STORE.items()) if st.get("transcript")]
+
+
+def _batch_drg_context(second_json: dict) -> str:
+    """Retrieval happens at pack time (batch lines can't call the retriever)."""
+    pd = second_json.get("primary_diagnosis") or {}
+    query = " ".join(str(x) for x in (pd.get("name"), pd.get("icd10")) if x) if isinstance(pd, dict) else ""
+    if not query or BATCH_DRG_CONTEXT_K <= 0:
+        return ""
+    try:
+        docs = vector_store.similarity_search(f"DRG for {query}", k=BATCH_DRG_CONTEXT_K)
+        return "\n\n".join((getattr(doc, "page_content", "") or "")[:1500] for doc in docs)
+    except Exception as e:
+        log.warning(f"batch DRG context retrieval failed: {e}")
+        return ""
+
+
+def _batch_drg_plan(d: dict, job_id: str):
+    """(requests, on_result, immediate): rule-resolved items are written now and never sent."""
+    reqs, targets, immediate = [], {}, 0
+    for i, item in enumerate(d.get("items") or []):
+        item = item if isinstance(item, dict) else {}
+        pid = str(item.get("patient_id") or "").strip()
+        second_json = _drg_second_json(item)
+        if not pid or second_json is None:
+            continue
+        sid = str(item.get("session_id") or pid)
+        rule_row, candidates = _drg_rule_row(pid, second_json)
+        if rule_row:
+            _batch_write(sid, "drg_validation", {"rows": [rule_row], "summary": _drg_status_counts([rule_row])}, "rule")
+            immediate += 1
+            continue
+        context = _batch_drg_context(second_json)
+        prompt = _build_drg_validation_prompt(second_json, pid, candidates)
+        if context:
+            prompt += f"\n\nDRG master excerpts:\n{context}"
+        cid = f"drg:{i}"
+        targets[cid] = sid
+        reqs.append(batch_jobs.chat_request(cid, BATCH_MODEL, [
+            {"role": "system", "content": "You validate DRG assignments. Return STRICT JSON ONLY."},
+            {"role": "user", "content": prompt},
+        ], temperature=0))
+
+    def on_result(cid, content, error):
+        if error:
+            raise RuntimeError(error)
+        rows = _drg_check_rows((_json_or_first_block(content) or {}).get("rows") or [])
+        _batch_write(targets[cid], "drg_validation", {"rows": rows, "summary": _drg_status_counts(rows)}, job_id)
+    return reqs, on_result, immediate
+
+
+def _batch_notes_plan(d: dict, job_id: str):
+    reqs, targets = [], {}
+    for i, sid in enumerate(_batch_session_ids(d)):
+        transcript = " ".join(SESSION_STORE[sid]["transcript"]).strip()
+        if not transcript:
+            continue
+        cid = f"notes:{i}"
+        targets[cid] = sid
+        reqs.append(batch_jobs.chat_request(cid, BATCH_MODEL, [
+            {"role": "system", "content": NOTES_SYSTEM},
+            {"role": "user", "content": f"Full transcript:\n{transcript[:BATCH_NOTES_MAX_CHARS]}"},
+        ]))
+
+    def on_result(cid, content, error):
+        if error:
+            raise RuntimeError(error)
+        notes = _extract_json_dict(content)
+        if not isinstance(notes, dict):
+            raise ValueError("Failed to parse notes")
+        _batch_write(targets[cid], "notes", notes, job_id)
+    return reqs, on_result, 0
+
+
+def _batch_icd10_plan(d: dict, job_id: str):
+    reqs, targets = [], {}
+    for i, sid in enumerate(_batch_session_ids(d)):
+        transcript = " ".join(SESSION_STORE[sid]["transcript"]).strip()
+        if not transcript:
+            continue
+        cid = f"icd10:{i}"
+        targets[cid] = sid
+        reqs.append(batch_jobs.chat_request(cid, BATCH_MODEL, [
+            {"role": "system", "content": BATCH_ICD10_SYSTEM},
+            {"role": "user", "content": f"Transcript:\n{transcript[:BATCH_NOTES_MAX_CHARS]}"},
+        ], temperature=0))
+
+    def on_result(cid, content, error):
+        if error:
+            raise RuntimeError(error)
+        obj = _extract_json_dict(content) or {}
+        rows = []
+        for it in obj.get("results") or []:
+            if not isinstance(it, dict):
+                continue
+            code = icd10_index.dotted(str(it.get("code") or "").strip())
+            label = str(it.get("label") or "").strip()
+            if code and label:
+                rows.append({"code": code, "label": label})
+        _batch_write(targets[cid], "icd10_suggestions", _dedupe_by_code(rows)[:BATCH_ICD10_TOP_K], job_id)
+    return reqs, on_result, 0
+
+
+BATCH_PLANS = {"drg": _batch_drg_plan, "notes": _batch_notes_plan, "icd10": _batch_icd10_plan}
+
+
+@app.post("/batch/jobs")
+def batch_jobs_submit():
+    """
+    Body: { "kind": "drg" | "notes" | "icd10",
+            "items": [ {"patient_id", "second_opinion_json", "session_id"?} ... ]   (drg)
+            "session_ids": ["..."] }                                                (notes/icd10; default: all)
+    Returns 202 with the job (poll GET /batch/jobs/<job_id>). Results land in SESSION_STORE[session_id]
+    under "drg_validation", "notes" or "icd10_suggestions".
+    """
+    d = request.get_json(silent=True) or {}
+    kind = str(d.get("kind") or "").strip().lower()
+    plan = BATCH_PLANS.get(kind)
+    if plan is None:
+        return jsonify({"error": f"kind must be one of {sorted(BATCH_PLANS)}"}), 400
+    job_id = batch_jobs.new_job_id()  # known to on_result before the scheduler can finish the job
+    reqs, on_result, immediate = plan(d, job_id)
+    if not reqs:
+        return jsonify({"job": None, "immediate": immediate, "message": "Nothing to submit"}), 200
+    try:
+        job = batch_jobs.submit(_batch_client(), kind, reqs, on_result, meta={"immediate": immediate},
+                                poll_interval_s=1.0 if _BATCH_FAKE_CLIENT else None, job_id=job_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log.exception("batch submit failed")
+        return jsonify({"error": f"Batch submit failed: {e}"}), 502
+    return jsonify({"job": job, "immediate": immediate}), 202
+
+
+@app.get("/batch/jobs")
+def batch_jobs_list():
+    return jsonify({"jobs": batch_jobs.list_jobs()}), 200
+
+
+@app.get("/batch/jobs/<job_id>")
+def batch_jobs_status(job_id):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job), 200
+
+
 # Defensive access to existing globals (won't overwrite if already defined)
 try:
     chat_sessions
@@ -5089,6 +6641,10 @@ def _norm_icd_doc(doc) -> dict:
     if meta: out["metadata"] = meta
     return out
 
+# Local ICD-10 index, built once at import (see icd10_index.py)
+import icd10_index
+ICD10_MIN_COVERAGE = float(os.getenv("ICD10_MIN_COVERAGE", "0.6"))  # share of query words the top hit must match
+
 def _dedupe_by_code(rows: list[dict]) -> list[dict]:
     seen = set()
     deduped = []
@@ -5116,6 +6672,18 @@ def clinical_notes_icd10_search():
     if not query:
         return _corsify(jsonify({"ok": False, "error": "Missing 'query'"})), 400
 
+    # 0) In-process index (code prefix + BM25); remote paths only when local recall is poor
+    local = icd10_index.search(query, top_k)
+    if local["results"] and local["coverage"] >= ICD10_MIN_COVERAGE:
+        return _corsify(jsonify({
+            "ok": True,
+            "via": "local",
+            "query": query,
+            "results": local["results"],
+            "coverage": local["coverage"],
+            "ms": local["ms"],
+        })), 200
+
     # 1) Prefer an explicit ICD-10 retriever if you wired it when booting the app
     #    e.g., ICD10_RETRIEVER = vectorstore.as_retriever(search_type="mmr", k=8)
     retriever = None
@@ -5192,15 +6760,110 @@ def clinical_notes_icd10_search():
             except Exception:
                 pass
 
+        if not results and local["results"]:
+            results, via = local["results"], "local"
+
         return _corsify(jsonify({
             "ok": True,
             "via": via,
             "query": query,
-            "results": results
+            "results": results,
+            "coverage": local["coverage"],
         })), 200
 
     except Exception as e:
         return _corsify(jsonify({"ok": False, "error": f"ICD-10 search failed: {str(e)}"})), 500
+
+# ---- ICD-10 typeahead (local index only; narrows the previous prefix's candidates per session) ----
+ICD10_AC_MAX_RESULTS = int(os.getenv("ICD10_AC_MAX_RESULTS", "20"))
+ICD10_AC_SESSIONS_MAX = int(os.getenv("ICD10_AC_SESSIONS_MAX", "2000"))
+ICD10_AC_STATE: "OrderedDict[str, dict]" = OrderedDict()  # session_id -> {seq, query, candidates}
+ICD10_AC_LOCK = threading.Lock()
+
+
+def _icd10_ac_begin(session_id: str, seq):
+    """
+    Register request `seq` for the session. Returns (state_snapshot, superseded).
+    A request older than one already seen for the session is superseded (the client moved on).
+    """
+    with ICD10_AC_LOCK:
+        st = ICD10_AC_STATE.get(session_id)
+        if st is None:
+            st = ICD10_AC_STATE[session_id] = {"seq": -1, "query": None, "candidates": None}
+            while len(ICD10_AC_STATE) > ICD10_AC_SESSIONS_MAX:
+                ICD10_AC_STATE.popitem(last=False)
+        ICD10_AC_STATE.move_to_end(session_id)
+        if seq is not None:
+            if seq < st["seq"]:
+                return dict(st), True
+            st["seq"] = seq
+        return dict(st), False
+
+
+def _icd10_ac_commit(session_id: str, seq, query: str, candidates):
+    with ICD10_AC_LOCK:
+        st = ICD10_AC_STATE.get(session_id)
+        if st is not None and (seq is None or seq >= st["seq"]):
+            st["query"], st["candidates"] = query, candidates
+
+
+@app.route("/api/clinical-notes/icd10-autocomplete", methods=["GET", "OPTIONS"])
+def clinical_notes_icd10_autocomplete():
+    """
+    Query: ?q=pneumonia%20lo&session_id=...&seq=17&limit=8
+    Returns: { ok, query, seq, results:[{code,label,score}], coverage, narrowed, ms }  (never calls a model)
+
+    - seq: client-side counter per keystroke; a response for an older seq than one already seen is
+      { ok, stale: true } with no results, so the picker can drop it (the client aborts it anyway).
+    - When q extends the session's previous query and its candidates provably hold every match, only
+      they are re-ranked; results are identical to a fresh search (narrowed only reports the shortcut).
+    - ETag per (index version, query, limit); If-None-Match answers 304.
+    """
+    if request.method == "OPTIONS":
+        return _cors_preflight()
+
+    query = request.args.get("q") or ""
+    session_id = (request.args.get("session_id") or "").strip()
+    try:
+        seq = int(request.args["seq"]) if request.args.get("seq") not in (None, "") else None
+    except ValueError:
+        seq = None
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 8), ICD10_AC_MAX_RESULTS))
+    except ValueError:
+        limit = 8
+    if not query.strip():
+        return _corsify(jsonify({"ok": True, "query": query, "seq": seq, "results": []})), 200
+
+    norm_q = re.sub(r"\s+", " ", query.lower()).lstrip()
+    etag = hashlib.sha1(f"{icd10_index.INDEX.version}|{norm_q}|{limit}".encode("utf-8")).hexdigest()[:20]
+
+    state, superseded = _icd10_ac_begin(session_id, seq) if session_id else ({}, False)
+    if superseded:
+        return _corsify(jsonify({"ok": True, "stale": True, "query": query, "seq": seq, "results": []})), 200
+
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        prev_q, prev_c = state.get("query"), state.get("candidates")
+        narrow = prev_c is not None and prev_q and norm_q.startswith(prev_q) and norm_q != prev_q
+        # the index only narrows when the candidates cover every match, so the body is the same either way
+        out = icd10_index.autocomplete(norm_q, limit, prev_c if narrow else None)
+        if session_id:
+            _icd10_ac_commit(session_id, seq, norm_q, out["candidates"])
+        resp = jsonify({
+            "ok": True,
+            "query": query,
+            "seq": seq,
+            "results": out["results"],
+            "coverage": out["coverage"],
+            "narrowed": out["narrowed"],
+            "ms": out["ms"],
+        })
+    resp.headers["ETag"] = f'"{etag}"'
+    resp.headers["Cache-Control"] = "private, max-age=300"
+    return _corsify(resp), resp.status_code
+
 # =======================
 # Share / Compose & Send
 # =======================
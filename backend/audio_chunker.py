@@ -0,0 +1,179 @@
+# audio_chunker.py — split long recordings at silences for parallel transcription, then stitch the text
+#
+# Decoding (from bytes or a file path): WAV with the stdlib `wave` module, downmixed and resampled to 16 kHz
+# so a chunk stays well under whisper's upload limit; every other container through the ffmpeg binary when
+# present (path or stdin -> 16 kHz mono s16le on stdout; a temp file only for containers ffmpeg can't read
+# from a pipe). Without ffmpeg, non-WAV uploads are not split and /transcribe falls back to one whisper call.
+import os, io, re, wave, shutil, tempfile, subprocess, logging
+
+import numpy as np
+
+# ENV:
+#   FFMPEG_BIN=ffmpeg
+#   TRANSCRIBE_CHUNK_S=120        (target chunk length)
+#   TRANSCRIBE_CHUNK_MAX_S=180    (hard cut when no silence is found)
+#   TRANSCRIBE_OVERLAP_S=1.0      (audio repeated at each boundary; duplicated words are stitched away)
+#   TRANSCRIBE_STITCH_MIN_WORDS=2 (shortest repeat treated as overlap; a single shared word is kept)
+#   TRANSCRIBE_SILENCE_DBFS=-40   (frames quieter than this count as silence)
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+TRANSCRIBE_CHUNK_S = float(os.getenv("TRANSCRIBE_CHUNK_S", "120"))
+TRANSCRIBE_CHUNK_MAX_S = float(os.getenv("TRANSCRIBE_CHUNK_MAX_S", "180"))
+TRANSCRIBE_OVERLAP_S = float(os.getenv("TRANSCRIBE_OVERLAP_S", "1.0"))
+TRANSCRIBE_SILENCE_DBFS = float(os.getenv("TRANSCRIBE_SILENCE_DBFS", "-40"))
+TRANSCRIBE_STITCH_MIN_WORDS = int(os.getenv("TRANSCRIBE_STITCH_MIN_WORDS", "2"))
+
+SAMPLE_RATE = 16000
+_FRAME_S = 0.03
+_PIPE_UNSAFE = {"m4a", "mp4"}  # moov atom may sit at the end; ffmpeg needs a seekable input
+
+log = logging.getLogger("audio-chunker")
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which(FFMPEG_BIN) is not None
+
+
+def _resample(pcm: np.ndarray, sr: int) -> np.ndarray:
+    """int16 mono at SAMPLE_RATE: box-filter decimation for integer ratios (48k, 32k), else linear interpolation."""
+    if sr == SAMPLE_RATE:
+        return pcm
+    if sr > SAMPLE_RATE and sr % SAMPLE_RATE == 0:
+        k = sr // SAMPLE_RATE
+        return pcm[: len(pcm) // k * k].reshape(-1, k).mean(axis=1).astype(np.int16)
+    n = int(round(len(pcm) * SAMPLE_RATE / sr))
+    x = np.linspace(0, len(pcm) - 1, num=n)
+    return np.interp(x, np.arange(len(pcm)), pcm.astype(np.float32)).astype(np.int16)
+
+
+def _decode_wav(src):
+    with wave.open(src if isinstance(src, str) else io.BytesIO(src), "rb") as w:
+        sr, ch, width = w.getframerate(), w.getnchannels(), w.getsampwidth()
+        raw = w.readframes(w.getnframes())
+    if width != 2:
+        return None
+    pcm = np.frombuffer(raw, dtype="<i2")
+    if ch > 1:
+        pcm = pcm.reshape(-1, ch).mean(axis=1).astype(np.int16)
+    return _resample(pcm, sr), SAMPLE_RATE
+
+
+def _decode_ffmpeg(src, ext: str):
+    cmd = [FFMPEG_BIN, "-nostdin", "-hide_banner", "-loglevel", "error"]
+    out_args = ["-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"]
+    tmp = None
+    try:
+        if isinstance(src, str):
+            proc = subprocess.run(cmd + ["-i", src] + out_args, capture_output=True, timeout=900)
+        elif ext in _PIPE_UNSAFE:
+            fd, tmp = tempfile.mkstemp(suffix=f".{ext}")
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(src)
+            proc = subprocess.run(cmd + ["-i", tmp] + out_args, capture_output=True, timeout=300)
+        else:
+            proc = subprocess.run(cmd + ["-i", "pipe:0"] + out_args, input=src, capture_output=True, timeout=300)
+    finally:
+        if tmp:
+            os.remove(tmp)
+    if proc.returncode != 0:
+        log.warning(f"ffmpeg decode failed ({ext}): {proc.stderr.decode('utf-8', 'ignore')[:200]}")
+        return None
+    return np.frombuffer(proc.stdout, dtype="<i2"), SAMPLE_RATE
+
+
+def decode(src, ext: str):
+    """
+    (int16 mono samples, 16000) from upload bytes or a file path; None when it can't be decoded here.
+    """
+    ext = (ext or "").lower()
+    try:
+        if ext == "wav":
+            got = _decode_wav(src)
+            if got is not None:
+                return got
+        if ffmpeg_available():
+            return _decode_ffmpeg(src, ext)
+    except Exception as e:
+        log.warning(f"audio decode failed ({ext}): {e}")
+    return None
+
+
+def _frame_dbfs(pcm: np.ndarray, sr: int) -> np.ndarray:
+    n = max(1, int(sr * _FRAME_S))
+    frames = pcm[: len(pcm) // n * n].astype(np.float32).reshape(-1, n)
+    rms = np.sqrt((frames ** 2).mean(axis=1)) / 32768.0
+    return 20 * np.log10(np.maximum(rms, 1e-9))
+
+
+def split_points(pcm: np.ndarray, sr: int, target_s: float = None, max_s: float = None,
+                 overlap_s: float = None) -> list:
+    """
+    [(start, end)] sample ranges. Each cut lands on the quietest frame between 0.75 * target_s and
+    max_s into the chunk (preferring frames under TRANSCRIBE_SILENCE_DBFS); the next chunk starts
+    overlap_s before the cut.
+    """
+    target_s = target_s or TRANSCRIBE_CHUNK_S
+    max_s = max(max_s or TRANSCRIBE_CHUNK_MAX_S, target_s)
+    overlap = int((TRANSCRIBE_OVERLAP_S if overlap_s is None else overlap_s) * sr)
+    total = len(pcm)
+    if total <= int(max_s * sr):
+        return [(0, total)]
+    db = _frame_dbfs(pcm, sr)
+    hop = max(1, int(sr * _FRAME_S))
+    out, start = [], 0
+    while total - start > int(max_s * sr):
+        lo = (start + int(0.75 * target_s * sr)) // hop
+        hi = min(len(db), (start + int(max_s * sr)) // hop)
+        window = db[lo:hi]
+        quiet = np.flatnonzero(window < TRANSCRIBE_SILENCE_DBFS)
+        if quiet.size:
+            # the silent frame closest to the target length
+            k = quiet[np.argmin(np.abs(quiet + lo - (start + target_s * sr) / hop))]
+        else:
+            k = int(np.argmin(window))
+        cut = (lo + int(k)) * hop
+        out.append((start, cut))
+        start = max(cut - overlap, start + 1)
+    out.append((start, total))
+    return out
+
+
+def wav_bytes(pcm: np.ndarray, sr: int) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sr)
+        w.writeframes(pcm.astype("<i2").tobytes())
+    return buf.getvalue()
+
+
+_WORD_RX = re.compile(r"[^\w']+")
+
+
+def _norm(word: str) -> str:
+    return _WORD_RX.sub("", word.lower())
+
+
+def stitch(texts: list, max_overlap_words: int = None, min_overlap_words: int = None) -> str:
+    """
+    Join chunk transcripts, dropping the words the overlap made the next chunk repeat. Only a repeat of
+    min_overlap_words..max_overlap_words words counts (by default 2 up to what TRANSCRIBE_OVERLAP_S of
+    fast speech can hold): a single shared word at a boundary ("...said no." / "No, he...") is real speech.
+    """
+    if max_overlap_words is None:
+        max_overlap_words = max(2, int(round(TRANSCRIBE_OVERLAP_S * 4)) + 1)
+    min_n = max(1, TRANSCRIBE_STITCH_MIN_WORDS if min_overlap_words is None else min_overlap_words)
+    out: list = []
+    for text in texts:
+        words = (text or "").split()
+        if not words:
+            continue
+        best = 0
+        tail = [_norm(w) for w in out[-max_overlap_words:]]
+        head = [_norm(w) for w in words[:max_overlap_words]]
+        for n in range(min(len(tail), len(head)), min_n - 1, -1):
+            if tail[-n:] == head[:n] and any(head[:n]):
+                best = n
+                break
+        out.extend(words[best:])
+    return " ".join(out)
@@ -0,0 +1,143 @@
+# batch_fake.py — local stand-in for the provider Batch API (files + batches), for tests and dry runs
+#
+#   python batch_fake.py --items 50 --delay 1
+#
+# FakeBatchClient exposes the subset of the OpenAI client that batch_jobs uses:
+#   files.create(file=(name, bytes), purpose) / files.content(file_id).text
+#   batches.create(input_file_id, endpoint, completion_window, metadata) / batches.retrieve(batch_id)
+# A batch stays "in_progress" for `delay_s`, then every input line is answered by `responder(body)`
+# (a string, or an exception -> error line) and written to output/error files in the provider's format.
+import json, time, uuid, threading, argparse
+from types import SimpleNamespace
+
+
+def echo_responder(body: dict) -> str:
+    """Default answer: a JSON object that echoes the model and the last user message length."""
+    msgs = body.get("messages") or []
+    last = (msgs[-1].get("content") if msgs else "") or ""
+    return json.dumps({"fake": True, "model": body.get("model"), "input_chars": len(last)})
+
+
+class _Files:
+    def __init__(self, owner):
+        self._o = owner
+
+    def create(self, file, purpose="batch"):
+        name, data = file if isinstance(file, tuple) else (getattr(file, "name", "upload.jsonl"), file.read())
+        data = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        fid = f"file-{uuid.uuid4().hex[:16]}"
+        with self._o._lock:
+            self._o._files[fid] = data
+        return SimpleNamespace(id=fid, filename=name, purpose=purpose, bytes=len(data))
+
+    def content(self, file_id):
+        with self._o._lock:
+            data = self._o._files[file_id]
+        return SimpleNamespace(text=data.decode("utf-8"), content=data)
+
+
+class _Batches:
+    def __init__(self, owner):
+        self._o = owner
+
+    def create(self, input_file_id, endpoint, completion_window="24h", metadata=None):
+        with self._o._lock:
+            if input_file_id not in self._o._files:
+                raise ValueError(f"Unknown input file {input_file_id}")
+            bid = f"batch_{uuid.uuid4().hex[:16]}"
+            self._o._batches[bid] = {
+                "id": bid, "input_file_id": input_file_id, "endpoint": endpoint,
+                "completion_window": completion_window, "metadata": metadata or {},
+                "status": "validating", "created_at": time.time(),
+                "output_file_id": None, "error_file_id": None, "counts": (0, 0, 0),
+            }
+        self._o.created += 1
+        return self.retrieve(bid)
+
+    def retrieve(self, batch_id):
+        o = self._o
+        with o._lock:
+            b = o._batches[batch_id]
+            if b["status"] not in ("completed", "failed"):
+                if time.time() - b["created_at"] >= o.delay_s:
+                    o._run(b)
+                else:
+                    b["status"] = "in_progress"
+            total, done, failed = b["counts"]
+            return SimpleNamespace(
+                id=b["id"], status=b["status"], metadata=b["metadata"],
+                output_file_id=b["output_file_id"], error_file_id=b["error_file_id"],
+                request_counts=SimpleNamespace(total=total, completed=done, failed=failed),
+            )
+
+
+class FakeBatchClient:
+    def __init__(self, responder=None, delay_s: float = 1.0):
+        self.responder = responder or echo_responder
+        self.delay_s = delay_s
+        self.created = 0
+        self._lock = threading.Lock()
+        self._files: dict = {}
+        self._batches: dict = {}
+        self.files = _Files(self)
+        self.batches = _Batches(self)
+
+    def _run(self, b: dict):
+        """Answer every line of the input file (called under the lock)."""
+        try:
+            lines = [json.loads(x) for x in self._files[b["input_file_id"]].decode("utf-8").splitlines() if x.strip()]
+        except ValueError:
+            b["status"] = "failed"
+            return
+        ok, bad = [], []
+        for req in lines:
+            rid = f"req_{uuid.uuid4().hex[:12]}"
+            try:
+                content = self.responder(req.get("body") or {})
+                ok.append({"id": rid, "custom_id": req.get("custom_id"), "error": None, "response": {
+                    "status_code": 200, "request_id": rid,
+                    "body": {"object": "chat.completion", "model": (req.get("body") or {}).get("model"),
+                             "choices": [{"index": 0, "finish_reason": "stop",
+                                          "message": {"role": "assistant", "content": content}}]},
+                }})
+            except Exception as e:
+                bad.append({"id": rid, "custom_id": req.get("custom_id"), "response": {
+                    "status_code": 500, "request_id": rid, "body": {"error": {"message": str(e)}}}, "error": None})
+        for key, rows in (("output_file_id", ok), ("error_file_id", bad)):
+            if rows:
+                fid = f"file-{uuid.uuid4().hex[:16]}"
+                self._files[fid] = ("\n".join(json.dumps(r) for r in rows) + "\n").encode("utf-8")
+                b[key] = fid
+        b["counts"] = (len(lines), len(ok), len(bad))
+        b["status"] = "completed"
+
+
+def _main():
+    import batch_jobs
+
+    ap = argparse.ArgumentParser(description="Run a batch job end to end against the fake batch server")
+    ap.add_argument("--items", type=int, default=20)
+    ap.add_argument("--delay", type=float, default=1.0)
+    ap.add_argument("--fail-every", type=int, default=7, help="every Nth request returns an error (0 = never)")
+    args = ap.parse_args()
+
+    def responder(body):
+        n = int(body["messages"][-1]["content"].split("#")[-1])
+        if args.fail_every and n % args.fail_every == 0:
+            raise RuntimeError("simulated provider error")
+        return json.dumps({"item": n})
+
+    results = {}
+    reqs = [batch_jobs.chat_request(f"demo:{i}", "gpt-4o-mini", [{"role": "user", "content": f"item #{i}"}])
+            for i in range(1, args.items + 1)]
+    job = batch_jobs.submit(FakeBatchClient(responder, args.delay), "demo", reqs,
+                            lambda cid, content, err: results.__setitem__(cid, err or content),
+                            poll_interval_s=0.2)
+    while not (batch_jobs.get(job["job_id"]) or {}).get("finished_at"):
+        time.sleep(0.1)
+    print(json.dumps(batch_jobs.get(job["job_id"]), indent=2, default=str))
+    print(json.dumps(dict(list(results.items())[:8]), indent=2))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,255 @@
+# batch_jobs.py — offline jobs over the provider Batch API: JSONL upload -> batch -> poll -> apply results
+#
+# Callers build one chat-completions request per item (chat_request) and a callback that writes each result
+# back where it belongs; submit() uploads the file and creates the batch. One scheduler thread polls every
+# active job on its own interval; finished batches are downloaded and applied on a small pool.
+# Works with the OpenAI client or batch_fake.FakeBatchClient (same .files / .batches surface).
+import os, json, time, uuid, threading, logging
+from concurrent.futures import ThreadPoolExecutor
+
+# ENV:
+#   BATCH_ENDPOINT=/v1/chat/completions
+#   BATCH_COMPLETION_WINDOW=24h
+#   BATCH_POLL_INTERVAL_S=60      (seconds between status checks)
+#   BATCH_MAX_REQUESTS=50000      (per batch file; provider limit)
+#   BATCH_POLL_MAX_ERRORS=5       (consecutive failed status checks before a job is marked failed)
+#   BATCH_APPLY_WORKERS=2         (finished batches downloaded/applied concurrently)
+#   BATCH_JOBS_KEEP=200           (finished jobs kept in the registry)
+#   BATCH_FAKE=0                  (1 = run against the local fake batch server, see batch_fake.py)
+BATCH_ENDPOINT = os.getenv("BATCH_ENDPOINT", "/v1/chat/completions")
+BATCH_COMPLETION_WINDOW = os.getenv("BATCH_COMPLETION_WINDOW", "24h")
+BATCH_POLL_INTERVAL_S = float(os.getenv("BATCH_POLL_INTERVAL_S", "60"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+BATCH_POLL_MAX_ERRORS = int(os.getenv("BATCH_POLL_MAX_ERRORS", "5"))
+BATCH_APPLY_WORKERS = int(os.getenv("BATCH_APPLY_WORKERS", "2"))
+BATCH_JOBS_KEEP = int(os.getenv("BATCH_JOBS_KEEP", "200"))
+BATCH_FAKE = os.getenv("BATCH_FAKE", "0").lower() in ("1", "true", "yes")
+
+log = logging.getLogger("batch-jobs")
+
+TERMINAL = ("completed", "failed", "expired", "cancelled")
+
+_LOCK = threading.Lock()
+_JOBS: dict = {}       # job_id -> job dict (see submit)
+_APPLY_POOL = ThreadPoolExecutor(max_workers=BATCH_APPLY_WORKERS, thread_name_prefix="batch-apply")
+_WAKE = threading.Event()  # set by submit() so a new job is polled on schedule
+_SCHEDULER = None
+
+
+def chat_request(custom_id: str, model: str, messages: list, json_mode: bool = True, **params) -> dict:
+    """One line of the batch input file (chat completions)."""
+    body = {"model": model, "messages": messages, **params}
+    if json_mode:
+        body["response_format"] = {"type": "json_object"}
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def to_jsonl(lines: list) -> bytes:
+    return ("\n".join(json.dumps(x, ensure_ascii=False) for x in lines) + "\n").encode("utf-8")
+
+
+def parse_output(text: str) -> dict:
+    """Batch output/error file -> {custom_id: {"content": str|None, "error": str|None}}."""
+    out = {}
+    for line in (text or "").splitlines():
+        if not line.strip():
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        cid = rec.get("custom_id")
+        if not cid:
+            continue
+        resp = rec.get("response") or {}
+        err = rec.get("error")
+        content = None
+        if not err and resp.get("status_code") == 200:
+            try:
+                content = resp["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                err = "Malformed response body"
+        elif not err:
+            err = ((resp.get("body") or {}).get("error") or {}).get("message") or f"HTTP {resp.get('status_code')}"
+        if isinstance(err, dict):
+            err = err.get("message") or json.dumps(err)
+        out[cid] = {"content": content, "error": err}
+    return out
+
+
+def _file_text(client, file_id: str) -> str:
+    res = client.files.content(file_id)
+    text = getattr(res, "text", None)
+    if callable(text):
+        text = text()
+    if text is None:
+        text = res.read().decode("utf-8") if hasattr(res, "read") else str(res)
+    return text
+
+
+def _public(job: dict) -> dict:
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+
+def _update(job_id: str, **fields):
+    with _LOCK:
+        job = _JOBS.get(job_id)
+        if job is not None:
+            job.update(fields)
+            job["updated_at"] = time.time()
+
+
+def _apply(job: dict, client, batch) -> None:
+    results = {}
+    for fid in (getattr(batch, "output_file_id", None), getattr(batch, "error_file_id", None)):
+        if fid:
+            results.update(parse_output(_file_text(client, fid)))
+    applied = failed = 0
+    on_result = job["_on_result"]
+    for cid in job["_custom_ids"]:
+        res = results.get(cid) or {"content": None, "error": "No result returned"}
+        try:
+            on_result(cid, res["content"], res["error"])
+        except Exception as e:
+            log.warning(f"batch {job['job_id']}: applying {cid} failed: {e}")
+            res = {"error": str(e)}
+        if res.get("error"):
+            failed += 1
+        else:
+            applied += 1
+    _update(job["job_id"], applied=applied, failed=failed)
+
+
+def _finish(job: dict, client, batch):
+    try:
+        _apply(job, client, batch)
+    except Exception as e:
+        log.warning(f"batch {job['job_id']}: result download failed: {e}")
+        _update(job["job_id"], error=str(e))
+    _update(job["job_id"], finished_at=time.time())
+    _prune()
+
+
+def _poll_once(job: dict):
+    """One status check; hands a finished batch to the apply pool."""
+    job_id = job["job_id"]
+    try:
+        batch = job["_client"].batches.retrieve(job["batch_id"])
+    except Exception as e:
+        errors = job["_errors"] + 1
+        log.warning(f"batch {job_id}: status check failed ({errors}/{BATCH_POLL_MAX_ERRORS}): {e}")
+        if errors >= BATCH_POLL_MAX_ERRORS:
+            _update(job_id, _errors=errors, _next_poll=None, status="failed", finished_at=time.time(),
+                    error=f"Status check failed {errors} times in a row: {e}")
+            _prune()
+        else:
+            _update(job_id, _errors=errors, _next_poll=time.time() + job["_interval_s"])
+        return
+    counts = getattr(batch, "request_counts", None)
+    _update(job_id, _errors=0, status=batch.status, request_counts={
+        "total": getattr(counts, "total", None),
+        "completed": getattr(counts, "completed", None),
+        "failed": getattr(counts, "failed", None),
+    } if counts is not None else None)
+    if batch.status in TERMINAL:
+        _update(job_id, _next_poll=None)
+        _APPLY_POOL.submit(_finish, job, job["_client"], batch)
+    else:
+        _update(job_id, _next_poll=time.time() + job["_interval_s"])
+
+
+def _scheduler():
+    """Single loop over every active job: poll the ones that are due, then sleep until the next one is."""
+    while True:
+        _WAKE.clear()
+        now = time.time()
+        with _LOCK:
+            due = [j for j in _JOBS.values() if j.get("_next_poll") is not None and j["_next_poll"] <= now]
+        for job in due:
+            try:
+                _poll_once(job)
+            except Exception as e:  # never let one job stop the loop
+                log.warning(f"batch {job['job_id']}: poll failed: {e}")
+                _update(job["job_id"], _next_poll=time.time() + job["_interval_s"])
+        with _LOCK:
+            upcoming = [j["_next_poll"] for j in _JOBS.values() if j.get("_next_poll") is not None]
+        _WAKE.wait(max(0.0, min(upcoming) - time.time()) if upcoming else None)
+
+
+def _ensure_scheduler():
+    global _SCHEDULER
+    with _LOCK:
+        if _SCHEDULER is None or not _SCHEDULER.is_alive():
+            _SCHEDULER = threading.Thread(target=_scheduler, name="batch-scheduler", daemon=True)
+            _SCHEDULER.start()
+
+
+def _prune():
+    with _LOCK:
+        done = sorted((j for j in _JOBS.values() if j.get("finished_at")), key=lambda j: j["finished_at"])
+        for j in done[:max(0, len(done) - BATCH_JOBS_KEEP)]:
+            _JOBS.pop(j["job_id"], None)
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def submit(client, kind: str, requests: list, on_result, meta: dict | None = None,
+           poll_interval_s: float | None = None, job_id: str | None = None) -> dict:
+    """
+    Upload `requests` (chat_request lines) as one batch; the scheduler thread polls it in the background.
+    on_result(custom_id, content, error) is called once per request when the batch ends
+    (content is the raw message text; error is a string or None). Pass a `job_id` from new_job_id()
+    when on_result needs it: the scheduler may finish the job before submit() returns.
+    Raises ValueError on empty/oversized input; provider errors propagate.
+    """
+    if not requests:
+        raise ValueError("No requests to submit")
+    if len(requests) > BATCH_MAX_REQUESTS:
+        raise ValueError(f"Too many requests ({len(requests)} > {BATCH_MAX_REQUESTS})")
+    job_id = job_id or new_job_id()
+    f = client.files.create(file=(f"{kind}-{job_id}.jsonl", to_jsonl(requests)), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=f.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"kind": kind, "job_id": job_id},
+    )
+    job = {
+        "job_id": job_id,
+        "kind": kind,
+        "batch_id": batch.id,
+        "input_file_id": f.id,
+        "status": batch.status,
+        "requests": len(requests),
+        "request_counts": None,
+        "applied": 0,
+        "failed": 0,
+        "meta": meta or {},
+        "created_at": time.time(),
+        "updated_at": time.time(),
+        "finished_at": None,
+        "_on_result": on_result,
+        "_custom_ids": [r["custom_id"] for r in requests],
+        "_client": client,
+        "_interval_s": BATCH_POLL_INTERVAL_S if poll_interval_s is None else poll_interval_s,
+        "_next_poll": time.time(),
+        "_errors": 0,
+    }
+    with _LOCK:
+        _JOBS[job_id] = job
+    _ensure_scheduler()
+    _WAKE.set()
+    return _public(job)
+
+
+def get(job_id: str):
+    with _LOCK:
+        job = _JOBS.get(job_id)
+        return _public(job) if job else None
+
+
+def list_jobs() -> list:
+    with _LOCK:
+        return [_public(j) for j in sorted(_JOBS.values(), key=lambda j: j["created_at"], reverse=True)]
@@ -0,0 +1,106 @@
+# drg_master.py — local DRG master table: code lookup/normalization + principal ICD-10 -> DRG candidates
+#
+# ENV:
+#   DRG_MASTER_CSV=/data/drg_master.csv   (columns: code,label[,mdc,type,weight,principal_icd10];
+#                                          principal_icd10 = ';'-separated ICD-10 codes or prefixes;
+#                                          default: data/drg_master.csv next to this file)
+import os, re, csv, logging
+
+DRG_MASTER_CSV = os.getenv(
+    "DRG_MASTER_CSV", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "drg_master.csv")
+)
+
+log = logging.getLogger("drg-master")
+
+_CODE_TOKEN_RX = re.compile(r"\b([A-Z]?\d{2,3}[A-Z]?)\b")
+_PREFIX_WORDS_RX = re.compile(r"^\s*(?:MS[-\s]?DRG|AR[-\s]?DRG|APR[-\s]?DRG|DRG)\s*[:#\-]?\s*", re.I)
+_LABEL_KEY_RX = re.compile(r"[^a-z0-9]+")
+
+_BY_CODE: dict = {}        # normalized code -> row
+_BY_LABEL: dict = {}       # normalized label -> code
+_BY_ICD: dict = {}         # dotless ICD-10 code/prefix -> tuple(codes)
+
+
+def normalize_code(raw) -> str:
+    """'MS-DRG 291', 'DRG: 64', '291 - Heart failure ...' -> '291' / '064'. Empty string if no code."""
+    t = _PREFIX_WORDS_RX.sub("", str(raw or "").strip().upper())
+    m = _CODE_TOKEN_RX.search(t)
+    if not m:
+        return ""
+    c = m.group(1)
+    return c.zfill(3) if c.isdigit() else c
+
+
+def _label_key(label: str) -> str:
+    return _LABEL_KEY_RX.sub(" ", (label or "").lower()).strip()
+
+
+def _icd_key(code: str) -> str:
+    return (code or "").replace(".", "").strip().upper()
+
+
+def _load():
+    try:
+        with open(DRG_MASTER_CSV, "r", encoding="utf-8-sig", newline="") as fh:
+            rows = list(csv.DictReader(fh))
+    except OSError as e:
+        log.warning(f"DRG master unavailable ({DRG_MASTER_CSV}): {e}")
+        return
+    by_icd = {}
+    for r in rows:
+        code = normalize_code(r.get("code"))
+        label = (r.get("label") or "").strip()
+        if not code or not label:
+            continue
+        try:
+            weight = float(r["weight"]) if r.get("weight") else None
+        except ValueError:
+            weight = None
+        row = {"code": code, "label": label, "mdc": (r.get("mdc") or "").strip() or None,
+               "type": (r.get("type") or "").strip() or None, "weight": weight}
+        _BY_CODE[code] = row
+        _BY_LABEL.setdefault(_label_key(label), code)
+        for p in (r.get("principal_icd10") or "").split(";"):
+            if p.strip():
+                by_icd.setdefault(_icd_key(p), []).append(code)
+    _BY_ICD.update({k: tuple(v) for k, v in by_icd.items()})
+    log.info(f"DRG master: {len(_BY_CODE)} codes, {len(_BY_ICD)} principal ICD-10 keys")
+
+
+def get(code):
+    """Master row for a (raw) DRG code, or None."""
+    return _BY_CODE.get(normalize_code(code))
+
+
+def resolve(drg: dict):
+    """
+    Match a model-produced {"code","label"} against the master: by code first, then by exact label.
+    Returns the master row or None.
+    """
+    drg = drg if isinstance(drg, dict) else {"code": drg}
+    row = get(drg.get("code"))
+    if row is None and drg.get("label"):
+        code = _BY_LABEL.get(_label_key(drg["label"]))
+        row = _BY_CODE.get(code) if code else None
+    return row
+
+
+def candidates_for(icd10: str) -> list:
+    """DRG rows whose principal-diagnosis list covers `icd10` (longest matching prefix wins)."""
+    key = _icd_key(icd10)
+    for n in range(len(key), 2, -1):
+        codes = _BY_ICD.get(key[:n])
+        if codes:
+            return [_BY_CODE[c] for c in codes]
+    return []
+
+
+def loaded() -> bool:
+    return bool(_BY_CODE)
+
+
+def stats() -> dict:
+    return {"codes": len(_BY_CODE), "icd10_keys": len(_BY_ICD), "path": DRG_MASTER_CSV}
+
+
+_load()
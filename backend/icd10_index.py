@@ -0,0 +1,297 @@
+# icd10_index.py — in-process ICD-10 search: code-prefix lookup + BM25 over label tokens
+#
+# Built once at import from a bundled code file. Under `gunicorn --preload` the master builds it
+# and every worker shares the (never mutated) structures copy-on-write.
+#
+# ENV:
+#   ICD10_CODES_PATH=/data/icd10cm_codes_2025.txt  (CMS code-descriptions file or code<TAB>label;
+#                                                  default: data/icd10cm_common.tsv next to this file)
+import os, re, sys, math, time, bisect, hashlib, logging
+from collections import defaultdict
+
+ICD10_CODES_PATH = os.getenv(
+    "ICD10_CODES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "icd10cm_common.tsv")
+)
+BM25_K1 = 1.2
+BM25_B = 0.75
+PREFIX_EXPANSIONS = 30  # vocabulary terms a partial last word may expand to
+
+log = logging.getLogger("icd10-index")
+
+_CODE_QUERY_RX = re.compile(r"^[A-TV-Z][0-9][0-9A-Z]?(?:\.?[0-9A-Z]{0,4})?$", re.I)
+_CMS_LINE_RX = re.compile(r"^([A-Z][0-9][0-9A-Z]{1,5})\s+(.+)$")
+_WORD_RX = re.compile(r"[a-z0-9]+")
+_STOP = {"of", "and", "or", "the", "with", "without", "in", "to", "by", "for", "due", "unspecified", "other",
+         "a", "an", "as", "not", "nos", "on", "at"}
+
+# Clinical shorthand -> label words (expanded at query time only)
+SYNONYMS = {
+    "htn": "hypertension", "dm": "diabetes mellitus", "t2dm": "type 2 diabetes mellitus",
+    "t1dm": "type 1 diabetes mellitus", "mi": "myocardial infarction", "ami": "acute myocardial infarction",
+    "stemi": "st elevation myocardial infarction", "nstemi": "non st elevation myocardial infarction",
+    "cad": "atherosclerotic heart disease coronary", "chf": "heart failure congestive", "hf": "heart failure",
+    "afib": "atrial fibrillation", "af": "atrial fibrillation", "copd": "chronic obstructive pulmonary disease",
+    "uti": "urinary tract infection", "uri": "upper respiratory infection", "gerd": "gastro esophageal reflux disease",
+    "ckd": "chronic kidney disease", "aki": "acute kidney failure", "esrd": "end stage renal disease",
+    "dvt": "deep veins thrombosis embolism", "pe": "pulmonary embolism", "tia": "transient ischemic attack",
+    "cva": "cerebral infarction", "stroke": "cerebral infarction", "bph": "benign prostatic hyperplasia",
+    "ibs": "irritable bowel syndrome", "oa": "osteoarthritis", "ra": "rheumatoid arthritis",
+    "sle": "systemic lupus erythematosus", "osa": "obstructive sleep apnea", "adhd": "attention deficit hyperactivity",
+    "ptsd": "post traumatic stress disorder", "gad": "generalized anxiety disorder", "mdd": "major depressive disorder",
+    "sob": "shortness of breath", "lbp": "low back pain", "nash": "nonalcoholic steatohepatitis",
+    "pcos": "polycystic ovarian syndrome", "ards": "acute respiratory distress syndrome", "covid": "covid 19",
+    "flu": "influenza", "heart attack": "myocardial infarction", "high blood pressure": "hypertension",
+    "sugar": "diabetes", "kidney stone": "calculus kidney",
+}
+_PHRASES = sorted((k for k in SYNONYMS if " " in k), key=len, reverse=True)
+
+
+def norm_code(code: str) -> str:
+    """'e11.9' / 'E119' -> 'E119' (dotless, upper) for prefix comparisons."""
+    return (code or "").replace(".", "").strip().upper()
+
+
+def dotted(code: str) -> str:
+    c = norm_code(code)
+    return c if len(c) <= 3 else f"{c[:3]}.{c[3:]}"
+
+
+def _stem(w: str) -> str:
+    if len(w) > 4 and w.endswith("ies"):
+        return w[:-3] + "y"
+    if len(w) > 3 and w.endswith("s") and not w.endswith(("ss", "us", "is")):
+        return w[:-1]
+    return w
+
+
+def tokenize(text: str) -> list:
+    return [_stem(w) for w in _WORD_RX.findall((text or "").lower()) if w not in _STOP]
+
+
+class Icd10Index:
+    """Read-only after build: sorted dotless codes for prefix ranges, postings for BM25."""
+
+    def __init__(self, rows):
+        rows = sorted({norm_code(c): (c, l) for c, l in rows if c and l}.items())
+        self.keys = [k for k, _ in rows]                  # sorted dotless codes (prefix ranges via bisect)
+        self.codes = [dotted(k) for k in self.keys]
+        self.labels = [l for _, (_, l) in rows]
+        postings = defaultdict(list)                      # term -> [(doc, tf)]
+        self.doc_len = []
+        self.doc_terms = []                               # doc -> stemmed label terms (for narrowed scoring)
+        for doc, label in enumerate(self.labels):
+            toks = [sys.intern(t) for t in tokenize(label)]
+            self.doc_len.append(len(toks) or 1)
+            self.doc_terms.append(tuple(toks))
+            tf = defaultdict(int)
+            for t in toks:
+                tf[t] += 1
+            for t, n in tf.items():
+                postings[t].append((doc, n))
+        self.postings = dict(postings)
+        self.vocab = sorted(self.postings)
+        n = len(self.labels) or 1
+        self.avg_len = sum(self.doc_len) / n if self.doc_len else 1.0
+        self.idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self.postings.items()}
+        self.version = hashlib.sha1("\n".join(f"{c}\t{l}" for c, l in zip(self.keys, self.labels)).encode("utf-8")).hexdigest()[:16]
+
+    def __len__(self):
+        return len(self.codes)
+
+    # ---- code prefix ----
+    def prefix(self, q: str, k: int):
+        p = norm_code(q)
+        lo = bisect.bisect_left(self.keys, p)
+        hi = bisect.bisect_left(self.keys, p + "\x7f")
+        # shortest (least specific) codes first, then code order
+        docs = sorted(range(lo, hi), key=lambda d: (len(self.keys[d]), self.keys[d]))[:k]
+        return [{"code": self.codes[d], "label": self.labels[d], "score": 1.0} for d in docs]
+
+    def _expand_prefix(self, part: str):
+        """Vocabulary terms starting with `part` (at most PREFIX_EXPANSIONS) and whether that is all of them."""
+        lo = bisect.bisect_left(self.vocab, part)
+        out = []
+        for t in self.vocab[lo:lo + PREFIX_EXPANSIONS + 1]:
+            if not t.startswith(part):
+                break
+            out.append(t)
+        return out[:PREFIX_EXPANSIONS], len(out) <= PREFIX_EXPANSIONS
+
+    # ---- BM25 over labels ----
+    def _query_groups(self, q: str):
+        """
+        One term group per query word (word stem + shorthand expansion); multi-word shorthand is one word.
+        Returns (groups, complete) where complete=False means the last word's prefix expansion was capped.
+        """
+        text = " " + " ".join(_WORD_RX.findall((q or "").lower())) + " "
+        for phrase in _PHRASES:
+            if f" {phrase} " in text:
+                text = text.replace(f" {phrase} ", f" {phrase.replace(' ', '_')} ")
+        words = text.split()
+        groups = []
+        for w in words:
+            if w in _STOP:
+                continue
+            g = tokenize(w.replace("_", " ")) if "_" in w else [_stem(w)]
+            g += tokenize(SYNONYMS.get(w.replace("_", " "), ""))
+            groups.append(list(dict.fromkeys(g)))
+        # typeahead: a partial last word (no trailing space) also matches every vocabulary term it
+        # prefixes, even when it is itself a term ("c" still grows into "chronic")
+        complete = True
+        if groups and words and words[-1] not in _STOP and "_" not in words[-1] and not (q or "").endswith(" "):
+            expanded, complete = self._expand_prefix(words[-1])
+            groups[-1] = list(dict.fromkeys(groups[-1] + expanded))
+        return groups, complete
+
+    def _bm25_term(self, t: str, tf: int, doc: int) -> float:
+        denom = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[doc] / self.avg_len)
+        return self.idf[t] * tf * (BM25_K1 + 1) / denom
+
+    def _score(self, groups, within=None):
+        """(scores, matched) per doc; `within` restricts scoring to a candidate set (typeahead narrowing)."""
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        if within is None:
+            for group in groups:
+                hit_docs = set()
+                for t in group:
+                    if t not in self.idf:
+                        continue
+                    for doc, tf in self.postings[t]:
+                        scores[doc] += self._bm25_term(t, tf, doc)
+                        hit_docs.add(doc)
+                for doc in hit_docs:
+                    matched[doc] += 1
+            return scores, matched
+        # same group/term order as the postings walk above, so narrowed scores are bit-identical
+        for doc in within:
+            terms = self.doc_terms[doc]
+            for group in groups:
+                hit = False
+                for t in group:
+                    if t in terms:
+                        scores[doc] += self._bm25_term(t, terms.count(t), doc)
+                        hit = True
+                if hit:
+                    matched[doc] += 1
+        return scores, matched
+
+    def _rank(self, scores, matched, k):
+        return sorted(scores, key=lambda d: (-matched[d], -scores[d], len(self.keys[d]), d))[:k]
+
+    def _rows(self, docs, scores):
+        return [{"code": self.codes[d], "label": self.labels[d], "score": round(scores[d], 4)} for d in docs]
+
+    def bm25(self, q: str, k: int):
+        """(rows, coverage): coverage = share of query words matched by the best hit's label."""
+        groups, _ = self._query_groups(q)
+        if not groups:
+            return [], 0.0
+        scores, matched = self._score(groups)
+        if not scores:
+            return [], 0.0
+        # documents matching more query words first, BM25 within
+        top = self._rank(scores, matched, k)
+        return self._rows(top, scores), round(matched[top[0]] / len(groups), 3)
+
+    @staticmethod
+    def _narrows(groups, within) -> bool:
+        """
+        True when every doc matching all of `groups` is in `within`'s docs: each of the earlier query's
+        groups is kept (same position) with a subset of its terms; extra trailing groups only filter more.
+        """
+        prev = within["groups"]
+        return len(groups) >= len(prev) and all(set(g) <= p for g, p in zip(groups, prev))
+
+    def autocomplete(self, q: str, k: int = 8, within=None):
+        """
+        Typeahead search. Returns {"results", "candidates", "coverage", "mode", "narrowed", "ms"}.
+        `candidates` is {"docs", "groups"}: the doc ids matching every query word and the term groups
+        they were matched on (None when that set is empty, the last word's expansion was capped, or the
+        query is a code). A longer query typed after this one can pass it back as `within`; it is only
+        used when it provably contains every full match, and results are the same as without it.
+        """
+        t0 = time.perf_counter()
+        q = (q or "").strip() if not (q or "").endswith(" ") else (q or "").lstrip()
+        if _CODE_QUERY_RX.match(q.strip()):
+            rows = self.prefix(q.strip(), k)
+            if rows:
+                return {"results": rows, "candidates": None, "coverage": 1.0, "mode": "code", "narrowed": False,
+                        "ms": round((time.perf_counter() - t0) * 1000, 3)}
+        groups, complete = self._query_groups(q)
+        if not groups:
+            return {"results": [], "candidates": None, "coverage": 0.0, "mode": "text", "narrowed": False, "ms": 0.0}
+        narrowed = within is not None and self._narrows(groups, within)
+        scores, matched = self._score(groups, within["docs"] if narrowed else None)
+        full = [d for d, m in matched.items() if m == len(groups)]
+        if narrowed and len(full) < k:
+            # fewer than k full matches: the top k would include partial matches outside the candidates
+            narrowed = False
+            scores, matched = self._score(groups)
+            full = [d for d, m in matched.items() if m == len(groups)]
+        top = self._rank(scores, matched, k)
+        candidates = None
+        if full and complete:
+            candidates = {"docs": full, "groups": tuple(frozenset(g) for g in groups)}
+        return {
+            "results": self._rows(top, scores),
+            "candidates": candidates,
+            "coverage": round(matched[top[0]] / len(groups), 3) if top else 0.0,
+            "mode": "text",
+            "narrowed": narrowed,
+            "ms": round((time.perf_counter() - t0) * 1000, 3),
+        }
+
+    def search(self, q: str, k: int = 8):
+        """
+        Returns {"results": [...], "coverage": 0..1, "mode": "code"|"text", "ms": float}.
+        Code-shaped queries ("E11", "e11.6") use the prefix range; everything else is BM25.
+        """
+        t0 = time.perf_counter()
+        q = (q or "").strip()
+        if _CODE_QUERY_RX.match(q):
+            rows = self.prefix(q, k)
+            if rows:
+                return {"results": rows, "coverage": 1.0, "mode": "code",
+                        "ms": round((time.perf_counter() - t0) * 1000, 3)}
+        rows, coverage = self.bm25(q, k)
+        return {"results": rows, "coverage": coverage, "mode": "text",
+                "ms": round((time.perf_counter() - t0) * 1000, 3)}
+
+
+def load_rows(path: str):
+    """Yield (code, label) from a code<TAB>label file or a CMS icd10cm_codes_YYYY.txt file."""
+    with open(path, "r", encoding="utf-8", errors="replace") as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if "\t" in line:
+                code, label = line.split("\t", 1)
+                yield code.strip(), label.strip()
+                continue
+            m = _CMS_LINE_RX.match(line)
+            if m:
+                yield dotted(m.group(1)), m.group(2).strip()
+
+
+def _build() -> Icd10Index:
+    t0 = time.perf_counter()
+    try:
+        idx = Icd10Index(load_rows(ICD10_CODES_PATH))
+    except OSError as e:
+        log.warning(f"ICD-10 code file unavailable ({ICD10_CODES_PATH}): {e}")
+        idx = Icd10Index([])
+    log.info(f"ICD-10 index: {len(idx)} codes, {len(idx.vocab)} terms in {(time.perf_counter() - t0) * 1000:.0f} ms")
+    return idx
+
+
+INDEX = _build()
+
+
+def search(q: str, k: int = 8):
+    return INDEX.search(q, k)
+
+
+def autocomplete(q: str, k: int = 8, within=None):
+    return INDEX.autocomplete(q, k, within)
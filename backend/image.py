@@ -1,4 +1,5 @@
-import os, json, base64, logging, uuid
+import os, json, base64, logging, uuid, time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 from flask import Flask, request, jsonify
 from flask_cors import CORS
@@ -7,6 +8,10 @@ from google.protobuf import json_format
 from google.protobuf.struct_pb2 import Value
 import requests
 from dotenv import load_dotenv
+import medimg_batch
+import medimg_fetch
+import medimg_chat
+from medimg_fetch import ImageTooLarge
 
 # ============== Env & logging ==============
 load_dotenv()
@@ -18,7 +23,12 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("medgemma-backend")
 
 # ============== Vertex client ==============
-client = aiplatform.gapic.PredictionServiceClient(
+# MEDIMG_FAKE=1 swaps in the local fake (medimg_fake.py) for tests and benchmarks
+if os.environ.get("MEDIMG_FAKE", "0").lower() in ("1", "true", "yes"):
+    from medimg_fake import FakePredictionServiceClient as _PredictionClient
+else:
+    _PredictionClient = aiplatform.gapic.PredictionServiceClient
+client = _PredictionClient(
     client_options={"api_endpoint": f"{LOCATION}-aiplatform.googleapis.com"}
 )
 endpoint_path = client.endpoint_path(PROJECT_ID, LOCATION, ENDPOINT_ID)
@@ -38,6 +48,10 @@ CORS(app, resources={
 })
 # In-memory sessions: { session_id: {image_b64, mime, modality, body_region, report_json, history:[...] } }
 SESSIONS: Dict[str, Dict] = {}
+STUDY_MAX_IMAGES = int(os.environ.get("MEDIMG_STUDY_MAX_IMAGES", "12"))
+# Study image_urls are fetched concurrently (bounded by the per-host keep-alive pool)
+FETCH_POOL = ThreadPoolExecutor(max_workers=max(1, min(STUDY_MAX_IMAGES, medimg_fetch.MEDIMG_FETCH_POOL)),
+                                thread_name_prefix="medimg-fetch")
 
 # ============== Prompt templates ===========
 BASE_SCHEMA = {
@@ -58,6 +72,16 @@ Rules:
 - No clinical advice, no markdown, no extra text—JSON only.
 """
 
+SYSTEM_STUDY = """You are a medical imaging report assistant for {modality}, combining the per-view reports of ONE study
+({views}) into a single study-level report.
+Return ONLY valid minified JSON using this schema exactly:
+{schema}
+Rules:
+- Reconcile findings across views; say which view shows each finding.
+- Do not add findings absent from every view report.
+- No clinical advice, no markdown, no extra text—JSON only.
+"""
+
 SYSTEM_CHAT = """You are a medical imaging assistant continuing a discussion about ONE image and a prior auto-generated report.
 Answer the user's follow-up question directly and concisely. Reference findings/impression when helpful.
 Do NOT provide clinical advice or treatment plans. If unsure, say so."""
@@ -69,20 +93,36 @@ def system_report_prompt(modality:str)->str:
     )
 
 def image_to_b64_from_url(url: str) -> str:
-    r = requests.get(url, timeout=30)
-    r.raise_for_status()
-    return base64.b64encode(r.content).decode("utf-8")
+    # pooled session, streamed under the byte cap, cached by content hash (medimg_fetch.py)
+    return medimg_fetch.fetch(url)["b64"]
 
 def image_to_b64_from_fs(fs) -> str:
     return base64.b64encode(fs.read()).decode("utf-8")
 
+def _to_value(instance: Dict) -> Value:
+    return json_format.Parse(json.dumps(instance), Value())
+
 def predict(instance: Dict) -> str:
-    value = json_format.Parse(json.dumps(instance), Value())
-    resp = client.predict(endpoint=endpoint_path, instances=[value])
-    pred = resp.predictions[0]
-    if isinstance(pred, dict) and "content" in pred:
-        return pred["content"]
-    return pred if isinstance(pred, str) else json.dumps(pred)
+    resp = client.predict(endpoint=endpoint_path, instances=[_to_value(instance)])
+    return medimg_batch.prediction_text(resp.predictions[0])
+
+def predict_many(instances: List[Dict]) -> Dict:
+    """Batched predict (MEDIMG_MAX_BATCH per call, calls in parallel); items keep input order."""
+    return medimg_batch.predict_many(client, endpoint_path, instances, to_value=_to_value)
+
+def _mime_from_url(url: str, default: str = "image/png") -> str:
+    url_l = url.lower()
+    return "image/jpeg" if url_l.endswith(".jpg") or url_l.endswith(".jpeg") else default
+
+def image_from_url(url: str):
+    """(b64, mime): mime from the response Content-Type when it is an image, else the URL extension."""
+    got = medimg_fetch.fetch(url)
+    return got["b64"], got["mime"] or _mime_from_url(url)
+
+def report_prompt(modality: str, body_region: str, notes: str, view: str = "") -> str:
+    clin = f"Clinical notes: {notes}" if notes else "Clinical notes: (none)"
+    view_line = f"\nView: {view}" if view else ""
+    return f"{system_report_prompt(modality)}\n{clin}\nRegion: {body_region}{view_line}\nJSON only."
 
 def parse_json_or_wrap(text: str):
     try:
@@ -105,6 +145,10 @@ def build_gen_instance(prompt:str, img_b64:str, mime:str, max_t=1200, temp=0.2,
 def health():
     return jsonify({"status":"ok","project":PROJECT_ID,"region":LOCATION,"endpoint_id":ENDPOINT_ID})
 
+@app.get("/api/medimg/fetch-stats")
+def fetch_stats():
+    return jsonify(medimg_fetch.stats())
+
 @app.post("/api/medimg/analyze")
 def analyze():
     """
@@ -128,15 +172,10 @@ def analyze():
             url = body.get("image_url")
             if not url:
                 return jsonify({"error":"Provide multipart 'image' file or JSON {'image_url': ...}"}), 400
-            url_l = url.lower()
-            if url_l.endswith(".jpg") or url_l.endswith(".jpeg"): mime = "image/jpeg"
-            img_b64 = image_to_b64_from_url(url)
+            img_b64, mime = image_from_url(url)
 
         # Build report prompt
-        sys_prompt = system_report_prompt(modality)
-        clin = f"Clinical notes: {notes}" if notes else "Clinical notes: (none)"
-        full_prompt = f"{sys_prompt}\n{clin}\nRegion: {body_region}\nJSON only."
-        instance = build_gen_instance(full_prompt, img_b64, mime)
+        instance = build_gen_instance(report_prompt(modality, body_region, notes), img_b64, mime)
 
         text = predict(instance)
         report = parse_json_or_wrap(text)
@@ -161,6 +200,8 @@ def analyze():
                 "modelVersion": "google/medgemma-4b-it",
             }
         })
+    except ImageTooLarge as e:
+        return jsonify({"error":"Image too large","details":str(e)}), 413
     except requests.HTTPError as e:
         log.exception("Image fetch failed")
         return jsonify({"error":"Failed to fetch image_url","details":str(e)}), 400
@@ -168,11 +209,114 @@ def analyze():
         log.exception("Analyze failed")
         return jsonify({"error":"Internal error","details":str(e)}), 500
 
+@app.post("/api/medimg/analyze-study")
+def analyze_study():
+    """
+    Multi-image study (PA + lateral, dermoscopy series, ...): every view is reported through batched
+    predict calls, then the per-view reports are combined into one study report.
+    multipart/form-data:
+      - images (file, repeated), optional: views (repeated or comma-separated), modality, body_region, notes
+    or JSON:
+      - image_urls (list), optional: views (list), modality, body_region, notes
+    """
+    try:
+        t0 = time.perf_counter()
+        body = request.get_json(silent=True) or {}
+        form = request.form
+        modality = (form.get("modality") or body.get("modality") or "radiology").lower()
+        body_region = (form.get("body_region") or body.get("body_region") or "chest").lower()
+        notes = (form.get("notes") or body.get("notes") or "").strip()
+
+        images = []  # [(b64, mime)]
+        files = request.files.getlist("images") or request.files.getlist("image")
+        if files:
+            for fs in files:
+                images.append((image_to_b64_from_fs(fs), fs.mimetype or "image/png"))
+            views = form.getlist("views")
+        else:
+            urls = body.get("image_urls") or []
+            if not isinstance(urls, list) or not urls:
+                return jsonify({"error":"Provide multipart 'images' files or JSON {'image_urls': [...]}"}), 400
+            if len(urls) > STUDY_MAX_IMAGES:
+                return jsonify({"error":f"At most {STUDY_MAX_IMAGES} images per study"}), 400
+            images = list(FETCH_POOL.map(image_from_url, urls))  # input order; first error is raised
+            views = body.get("views") or []
+        if len(images) > STUDY_MAX_IMAGES:
+            return jsonify({"error":f"At most {STUDY_MAX_IMAGES} images per study"}), 400
+        if len(views) == 1 and isinstance(views[0], str) and "," in views[0]:
+            views = [v.strip() for v in views[0].split(",")]
+        views = [str(views[i]).strip() if i < len(views) and views[i] else f"image {i + 1}" for i in range(len(images))]
+
+        # One instance per view; packed into batched predict calls
+        instances = [build_gen_instance(report_prompt(modality, body_region, notes, view), b64, mime)
+                     for (b64, mime), view in zip(images, views)]
+        batch = predict_many(instances)
+        results = []
+        for i, item in enumerate(batch["items"]):
+            row = {"index": i, "view": views[i]}
+            if item["error"]:
+                row["error"] = item["error"]
+            else:
+                row["result"] = parse_json_or_wrap(item["text"])
+            results.append(row)
+        ok = [r for r in results if "result" in r]
+        if not ok:
+            return jsonify({"error":"All predictions failed","results":results}), 502
+
+        # Study-level report from the per-view reports (text only; the images were already read)
+        combined, calls = ok[0]["result"], batch["calls"]
+        if len(ok) > 1:
+            per_view = "\n".join(f"[{r['view']}] {json.dumps(r['result'], separators=(',',':'))}" for r in ok)
+            prompt = SYSTEM_STUDY.format(modality=modality, views=", ".join(r["view"] for r in ok),
+                                         schema=json.dumps(BASE_SCHEMA, separators=(",",":")))
+            prompt += f"\nRegion: {body_region}\nPer-view reports:\n{per_view}\nJSON only."
+            combined = parse_json_or_wrap(predict({"prompt": prompt, "maxTokens": 1200,
+                                                   "temperature": 0.2, "topP": 0.95}))
+            calls += 1
+
+        # Session: chat follows up on the first successfully read view with the study report as context
+        primary = ok[0]["index"]
+        sid = uuid.uuid4().hex
+        SESSIONS[sid] = {
+            "image_b64": images[primary][0],
+            "mime": images[primary][1],
+            "modality": modality,
+            "body_region": body_region,
+            "report_json": combined,
+            "study": [{"view": r["view"], "report_json": r.get("result")} for r in results],
+            "history": []
+        }
+
+        return jsonify({
+            "session_id": sid,
+            "results": results,
+            "combined": combined,
+            "meta": {
+                "modality": modality,
+                "bodyRegion": body_region,
+                "modelVersion": "google/medgemma-4b-it",
+                "images": len(images),
+                "predictCalls": calls,
+                "batchSize": medimg_batch.MEDIMG_MAX_BATCH,
+                "ms": round((time.perf_counter() - t0) * 1000, 1),
+            }
+        })
+    except ImageTooLarge as e:
+        return jsonify({"error":"Image too large","details":str(e)}), 413
+    except requests.HTTPError as e:
+        log.exception("Image fetch failed")
+        return jsonify({"error":"Failed to fetch image_url","details":str(e)}), 400
+    except Exception as e:
+        log.exception("Study analyze failed")
+        return jsonify({"error":"Internal error","details":str(e)}), 500
+
 @app.post("/api/medimg/chat")
 def chat():
     """
-    JSON: { session_id: string, text: string }
+    JSON: { session_id: string, text: string, mode?: "compact" | "full" }
     Uses stored image + prior report and minimal chat history to answer follow-up questions.
+    compact (default, MEDIMG_CHAT_MODE): cached report JSON, token-budgeted history, thumbnail image.
+    full: the original prompt (last six history lines, original image).
     """
     try:
         body = request.get_json(force=True)
@@ -185,29 +329,19 @@ def chat():
             return jsonify({"error":"Unknown session_id"}), 404
 
         # Compose a single-turn prompt that includes prior context (since Basic endpoint is stateless).
-        context = json.dumps(sess["report_json"], separators=(",",":"))
-        history_lines = []
-        for m in sess["history"][-6:]:  # keep last 3 Q/A pairs
-            history_lines.append(f"{m['role'].capitalize()}: {m['text']}")
-        history_text = "\n".join(history_lines)
-
-        prompt = (
-            f"{SYSTEM_CHAT}\n\n"
-            f"Modality: {sess['modality']}; Region: {sess['body_region']}\n"
-            f"Prior structured report JSON:\n{context}\n\n"
-            f"{history_text}\n"
-            f"User: {user_text}\nAssistant:"
-        )
-
-        instance = build_gen_instance(prompt, sess["image_b64"], sess["mime"],
+        built = medimg_chat.build_prompt(sess, user_text, SYSTEM_CHAT, (body.get("mode") or "").lower() or None)
+        instance = build_gen_instance(built["prompt"], built["image_b64"], built["mime"],
                                       max_t=800, temp=0.2, top_p=0.95)
+        t0 = time.perf_counter()
         text = predict(instance)
+        meta = dict(built["meta"], request_bytes=len(json.dumps(instance)),
+                    ms=round((time.perf_counter() - t0) * 1000, 1))
 
         # Record history
         sess["history"].append({"role":"user","text":user_text})
         sess["history"].append({"role":"assistant","text":text})
 
-        return jsonify({"session_id": sid, "answer": text})
+        return jsonify({"session_id": sid, "answer": text, "meta": meta})
     except Exception as e:
         log.exception("Chat failed")
         return jsonify({"error":"Internal error","details":str(e)}), 500
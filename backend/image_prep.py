@@ -0,0 +1,117 @@
+# image_prep.py — downscale / re-encode uploads to fit OCR and vision payload budgets (PyMuPDF only)
+import os, logging
+
+# ENV:
+#   OCR_PROVIDER_LIMIT_MB=1          (OCR profile byte budget follows the provider plan)
+#   IMG_OCR_MAX_DIM=2600             (longest side for OCR; keeps small print legible)
+#   IMG_VISION_MAX_DIM=2048          (longest side for vision; gpt-4o tiles beyond this anyway)
+#   IMG_VISION_MAX_BYTES=1500000
+#   IMG_VISION_SHORT_SIDE=768        (gpt-4o high detail reads at most 768px on the short side; 0 = off)
+#   MEDIMG_THUMB_MAX_DIM=896         (MedGemma chat follow-up thumbnail)
+#   MEDIMG_THUMB_MAX_BYTES=300000
+log = logging.getLogger("image-prep")
+
+PROFILES = {
+    # OCR: grayscale JPEG, generous resolution, must fit under the provider plan limit
+    "ocr": {
+        "max_dim": int(os.getenv("IMG_OCR_MAX_DIM", "2600")),
+        "max_bytes": int(int(os.getenv("OCR_PROVIDER_LIMIT_MB", "1")) * 1024 * 1024 * 0.95),
+        "quality": 88,
+        "min_quality": 55,
+        "grayscale": True,
+        "short_side": 0,
+    },
+    # Vision: colour matters (dermoscopy, wounds, fundus); smaller budget to cut upload time/latency
+    "vision": {
+        "max_dim": int(os.getenv("IMG_VISION_MAX_DIM", "2048")),
+        "max_bytes": int(os.getenv("IMG_VISION_MAX_BYTES", "1500000")),
+        "quality": 85,
+        "min_quality": 60,
+        "grayscale": False,
+        "short_side": int(os.getenv("IMG_VISION_SHORT_SIDE", "768")),
+    },
+    # Follow-up thumbnail for the MedGemma chat: its image encoder works at 896x896, so more is wasted
+    "medimg_thumb": {
+        "max_dim": int(os.getenv("MEDIMG_THUMB_MAX_DIM", "896")),
+        "max_bytes": int(os.getenv("MEDIMG_THUMB_MAX_BYTES", "300000")),
+        "quality": 85,
+        "min_quality": 60,
+        "grayscale": False,
+        "short_side": 0,
+    },
+}
+
+
+def _report(data: bytes, out: bytes, mimetype: str, out_mime: str, src_dims, out_dims, changed: bool, profile: str):
+    return {
+        "profile": profile,
+        "changed": changed,
+        "bytes_before": len(data),
+        "bytes_after": len(out),
+        "dims_before": list(src_dims) if src_dims else None,
+        "dims_after": list(out_dims) if out_dims else None,
+        "mimetype_before": mimetype,
+        "mimetype_after": out_mime,
+    }
+
+
+def prepare_image(data: bytes, mimetype: str = "image/png", profile: str = "ocr", **overrides):
+    """
+    Normalize EXIF orientation, downscale to the profile's max dimension (and, when the profile sets
+    short_side, to the smallest size the model still reads at full resolution) and re-encode as JPEG
+    until the result fits the byte budget. Returns (bytes, mimetype, report).
+
+    Images already inside the budget (and not rotated by EXIF) are returned untouched.
+    Unreadable input is returned untouched with report["changed"] = False.
+    """
+    prof = dict(PROFILES[profile], **overrides)
+    try:
+        import fitz  # PyMuPDF
+    except ImportError:
+        return data, mimetype, _report(data, data, mimetype, mimetype, None, None, False, profile)
+
+    try:
+        raw = fitz.Pixmap(data)  # stored pixel grid (before EXIF orientation)
+        raw_w, raw_h = raw.width, raw.height
+        subtype = (mimetype or "image/png").split("/")[-1].replace("jpeg", "jpg")
+        doc = fitz.open(stream=data, filetype=subtype)
+    except Exception as e:
+        log.warning(f"image_prep: unreadable image ({mimetype}): {e}")
+        return data, mimetype, _report(data, data, mimetype, mimetype, None, None, False, profile)
+
+    with doc:
+        page = doc[0]
+        pt_w, pt_h = page.rect.width, page.rect.height
+        # image documents render with EXIF orientation applied; a swapped aspect means "rotated"
+        rotated = (raw_w > raw_h) != (pt_w > pt_h) and raw_w != raw_h
+        src_dims = (raw_h, raw_w) if rotated else (raw_w, raw_h)
+        long_px, short_px = max(src_dims), min(src_dims)
+        max_dim = prof["max_dim"]
+        if prof.get("short_side") and short_px > prof["short_side"]:
+            # pixels beyond short_side on the short edge are discarded by the model's own resize
+            max_dim = min(max_dim, max(prof["short_side"], round(long_px * prof["short_side"] / short_px)))
+
+        if len(data) <= prof["max_bytes"] and long_px <= max_dim and not rotated:
+            return data, mimetype, _report(data, data, mimetype, mimetype, src_dims, src_dims, False, profile)
+
+        native_zoom = long_px / max(pt_w, pt_h)
+        target = min(long_px, max_dim)
+        colorspace = fitz.csGRAY if prof["grayscale"] else fitz.csRGB
+        out, out_dims = data, src_dims
+
+        # Shrink until the JPEG fits: step quality down first, then dimensions.
+        for _ in range(6):
+            zoom = native_zoom * (target / long_px)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+            out_dims = (pix.width, pix.height)
+            q = prof["quality"]
+            while True:
+                out = pix.tobytes("jpg", jpg_quality=q)
+                if len(out) <= prof["max_bytes"] or q <= prof["min_quality"]:
+                    break
+                q = max(prof["min_quality"], q - 10)
+            if len(out) <= prof["max_bytes"]:
+                break
+            target = int(target * 0.8)
+
+    return out, "image/jpeg", _report(data, out, mimetype, "image/jpeg", src_dims, out_dims, True, profile)
@@ -0,0 +1,99 @@
+# interaction_store.py — persistent drug-pair interaction findings keyed by the sorted generic pair
+#
+# Findings come from the drug RAG retriever (see _pair_finding in app.py); a regimen is then assembled
+# from cached pairs so only new pairs cost a retrieval + model call.
+import os, json, time, tempfile, threading, logging
+
+# ENV:
+#   MED_INTERACTIONS_PATH=/var/lib/med_interactions.json  (default <tmp>/med_interactions.json; empty = memory only)
+#   MED_INTERACTIONS_TTL_S=2592000                         (finding lifetime; default 30 days)
+MED_INTERACTIONS_PATH = os.getenv("MED_INTERACTIONS_PATH", os.path.join(tempfile.gettempdir(), "med_interactions.json"))
+MED_INTERACTIONS_TTL_S = int(os.getenv("MED_INTERACTIONS_TTL_S", str(30 * 24 * 3600)))
+
+log = logging.getLogger("interaction-store")
+
+SEVERITIES = ("none", "minor", "moderate", "major", "contraindicated")
+
+_LOCK = threading.Lock()
+_PAIRS: dict = {}      # "a|b" -> {"pair": [a, b], "severity", "mechanism", "effect", "management", "stored_at"}
+_STATS = {"lookups": 0, "hits": 0, "misses": 0, "writes": 0}
+_DIRTY = False
+
+
+def pair_key(a: str, b: str) -> str:
+    x, y = sorted(((a or "").strip().lower(), (b or "").strip().lower()))
+    return f"{x}|{y}"
+
+
+def _load():
+    if not MED_INTERACTIONS_PATH or not os.path.exists(MED_INTERACTIONS_PATH):
+        return
+    try:
+        with open(MED_INTERACTIONS_PATH, "r", encoding="utf-8") as fh:
+            doc = json.load(fh)
+        _PAIRS.update({k: v for k, v in (doc.get("pairs") or {}).items()
+                       if isinstance(v, dict) and v.get("severity") in SEVERITIES})
+    except Exception as e:
+        log.warning(f"interaction store load failed ({MED_INTERACTIONS_PATH}): {e}")
+
+
+def get(a: str, b: str):
+    """Cached finding for the pair (either order), or None when missing/expired."""
+    key = pair_key(a, b)
+    now = time.time()
+    with _LOCK:
+        _STATS["lookups"] += 1
+        hit = _PAIRS.get(key)
+        if hit and now - hit.get("stored_at", 0) <= MED_INTERACTIONS_TTL_S:
+            _STATS["hits"] += 1
+            return dict(hit)
+        _STATS["misses"] += 1
+        return None
+
+
+def put(a: str, b: str, finding: dict):
+    """Store a finding and return the stored row; None (nothing stored) when severity is not in SEVERITIES."""
+    global _DIRTY
+    row = dict(finding or {})
+    if row.get("severity") not in SEVERITIES:
+        return None
+    key = pair_key(a, b)
+    row["pair"] = key.split("|")
+    row["stored_at"] = time.time()
+    with _LOCK:
+        _PAIRS[key] = row
+        _STATS["writes"] += 1
+        _DIRTY = True
+    return dict(row)
+
+
+def save():
+    """Write the store to MED_INTERACTIONS_PATH atomically (no-op when nothing changed)."""
+    global _DIRTY
+    if not MED_INTERACTIONS_PATH:
+        return
+    with _LOCK:
+        if not _DIRTY:
+            return
+        snapshot = dict(_PAIRS)
+        _DIRTY = False
+    try:
+        folder = os.path.dirname(MED_INTERACTIONS_PATH) or "."
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump({"version": 1, "pairs": snapshot}, fh, ensure_ascii=False)
+        os.replace(tmp, MED_INTERACTIONS_PATH)
+    except Exception as e:
+        log.warning(f"interaction store write failed ({MED_INTERACTIONS_PATH}): {e}")
+
+
+def stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+        out["pairs"] = len(_PAIRS)
+    out["hit_rate"] = round(out["hits"] / out["lookups"], 4) if out["lookups"] else 0.0
+    return out
+
+
+_load()
@@ -0,0 +1,75 @@
+# labs_parse_check.py — regression lines for the deterministic lab parser in app.py (no model calls)
+#
+#   python labs_parse_check.py
+#
+# Each case is one printout line and what _local_parse_labs should make of it: a parsed row
+# (name, value, unit, low, high) or None for a header/ID row that must be ignored.
+# REPORT_CASES run a whole text through _finalize_lab_rows (default ranges + classification) and
+# list the (name, unit, low, high, status) of every row /labs/parse returns.
+import sys
+
+CASES = [
+    # header rows: the leading label is a header word, or no number-plus-unit value
+    ("Patient Name: John Doe   MRN: 123456", None),
+    ("Date: 12/05/2024", None),
+    ("Age 45 Y", None),
+    ("Collected 12/03/2024 08:15 Received 12/03/2024 09:00", None),
+    ("Referring Physician Dr. Ali 0501234", None),
+    ("Lab No: 4452", None),
+    ("Page 1 of 2", None),
+    # analytes whose names contain a header word
+    ("Prothrombin Time 14.2 sec 11.0-13.5", ("Prothrombin Time", 14.2, "sec", 11.0, 13.5)),
+    ("aPTT (activated partial thromboplastin time) 40 s 25-35",
+     ("aPTT (activated partial thromboplastin time)", 40.0, "s", 25.0, 35.0)),
+    ("Sex Hormone Binding Globulin 30 nmol/L 18-54", ("Sex Hormone Binding Globulin", 30.0, "nmol/L", 18.0, 54.0)),
+    # ordinary rows
+    ("Hemoglobin: 13,5 g/dL (13.0-17.0)", ("Hemoglobin", 13.5, "g/dL", 13.0, 17.0)),
+    ("WBC 11.2 H 10^3/uL 4.0 - 10.0", ("WBC", 11.2, "10^3/uL", 4.0, 10.0)),
+    ("Potassium 5.9mmol/L 3.5-5.1", ("Potassium", 5.9, "mmol/L", 3.5, 5.1)),
+    # a high/low flag glued to the value is not the unit
+    ("Potassium 5.6H mmol/L 3.5-5.1", ("Potassium", 5.6, "mmol/L", 3.5, 5.1)),
+    ("Sodium 128L mmol/L 135-145", ("Sodium", 128.0, "mmol/L", 135.0, 145.0)),
+    # number-suffixed tumour markers are their own analytes, not calcium
+    ("CA 125 20 U/mL", ("CA 125", 20.0, "U/mL", None, None)),
+    ("CA 27.29 12 U/mL <38", ("CA 27.29", 12.0, "U/mL", 0.0, 38.0)),
+    ("CA 19-9 41 U/mL 0-37", ("CA 19-9", 41.0, "U/mL", 0.0, 37.0)),
+    ("Calcium 9.1 mg/dL 8.6-10.3", ("Calcium", 9.1, "mg/dL", 8.6, 10.3)),
+]
+
+REPORT_CASES = [
+    # no unit printed: hemoglobin 12.1 is on the g/dL scale, so it gets the catalog unit and range
+    ("Hemoglobin 12.1\nPotassium 6.2 mmol/L",
+     [("Hemoglobin", "g/dL", 13.0, 17.0, "abnormal"), ("Potassium", "mmol/L", 3.5, 5.1, "abnormal")]),
+    # no unit and nowhere near the catalog scale: kept, unclassified
+    ("Glucose 6.1", [("Glucose", "", None, None, None)]),
+]
+
+
+def main() -> int:
+    from app import _local_parse_labs, _finalize_lab_rows
+
+    failed = 0
+    for line, want in CASES:
+        rows, _, report = _local_parse_labs(line)
+        got = None
+        if rows:
+            r = rows[0]
+            got = (r["name"], r["value"], r["unit"], r["low"], r["high"])
+        elif not report["ignored"]:
+            got = "not ignored"
+        ok = got == want
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {line!r}" + ("" if ok else f"\n     want {want}\n     got  {got}"))
+    for text, want in REPORT_CASES:
+        rows, _, _ = _local_parse_labs(text)
+        got = [(r["name"], r["unit"], r["low"], r["high"], r["status"]) for r in _finalize_lab_rows(rows, set(), "local")]
+        ok = got == want
+        failed += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {text!r}" + ("" if ok else f"\n     want {want}\n     got  {got}"))
+    total = len(CASES) + len(REPORT_CASES)
+    print(f"{total - failed}/{total} passed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# med_bench.py — medication line parser microbenchmark: token trie (med_parser.parse_line) vs legacy NAME_FIRST_RX
+#
+#   python med_bench.py --lines 20000 --seed 7
+#
+# Generates synthetic medication lines in the formats seen in discharge letters / med lists and reports
+# lines per second plus field recall (strength, form, route, frequency, prn) for both parsers.
+import sys, json, time, random, argparse
+
+import med_parser
+
+_NAMES = sorted(set(med_parser.GENERICS)) + [b.title() for b in med_parser.BRANDS] + ["Vitamin D3", "Fish oil", "Zinc"]
+_FORMS = ["tablet", "tab", "capsule", "cap", "syrup", "injection", "patch", "cream", "inhaler", None]
+_ROUTES = ["PO", "oral", "by mouth", "IV", "SC", "topical", "inhalation", None]
+_FREQS = ["once daily", "BID", "tid", "qid", "q8h", "every 12 hours", "qhs", "qAM", None]
+_UNITS = ["mg", "mcg", "g", "units", "ml", "IU"]
+
+
+def _make_line(rng: random.Random):
+    name = rng.choice(_NAMES)
+    truth = {"strength": None, "form": None, "route": None, "frequency": None, "prn": False}
+    parts = [name]
+    if rng.random() < 0.9:
+        n = rng.choice(["5", "10", "20", "40", "81", "500", "875", "0.5", "1000"])
+        u = rng.choice(_UNITS)
+        parts.append(f"{n}{u}" if rng.random() < 0.4 else f"{n} {u}")
+        truth["strength"] = n
+    for key, choices in (("form", _FORMS), ("route", _ROUTES), ("frequency", _FREQS)):
+        v = rng.choice(choices)
+        if v:
+            parts.append(v)
+            truth[key] = v
+    if rng.random() < 0.15:
+        parts.append(rng.choice(["prn", "PRN"]))
+        truth["prn"] = True
+    # common real-world shuffles: "Tab. X ..." and trailing instructions
+    if truth["form"] and rng.random() < 0.25:
+        parts.remove(truth["form"])
+        parts.insert(0, truth["form"].title() + ".")
+    if rng.random() < 0.2:
+        parts.append(rng.choice(["with food", "after meals", "for 7 days"]))
+    sep = rng.choice([" ", ", "])
+    return sep.join(parts), truth
+
+
+def _legacy(line: str):
+    m = med_parser.NAME_FIRST_RX.search(line or "")
+    if not m:
+        return None
+    d = m.groupdict()
+    return {
+        "strength": d.get("strength"), "form": d.get("form"), "route": d.get("route"),
+        "frequency": d.get("frequency"), "prn": (d.get("prn") or "").lower() == "prn",
+    }
+
+
+def _score(parse, data):
+    fields = ("strength", "form", "route", "frequency", "prn")
+    hits = {f: 0 for f in fields}
+    totals = {f: 0 for f in fields}
+    t0 = time.perf_counter()
+    results = [parse(line) for line, _ in data]
+    elapsed = time.perf_counter() - t0
+    for (_, truth), got in zip(data, results):
+        got = got or {}
+        for f in fields:
+            if truth[f]:
+                totals[f] += 1
+                if str(got.get(f) or "").lower() == str(truth[f]).lower():
+                    hits[f] += 1
+    return {
+        "lines_per_s": round(len(data) / elapsed),
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "recall": {f: round(hits[f] / totals[f], 3) if totals[f] else None for f in fields},
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="medication parser microbenchmark")
+    ap.add_argument("--lines", type=int, default=20000)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    data = [_make_line(rng) for _ in range(args.lines)]
+    print(json.dumps({
+        "lines": len(data),
+        "lexicon_phrases": med_parser.LEXICON.size,
+        "legacy_regex": _score(_legacy, data),
+        "token_trie": _score(med_parser.parse_line, data),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+# med_index.py — learned medication name -> generic index for /meds/map (memory + JSON file)
+#
+# Seeded from the med_parser lexicon (generics map to themselves, brands to their INN) and
+# extended with every successful RAG mapping, so recurring brand names resolve without a model call.
+import os, re, json, tempfile, threading, logging, unicodedata
+
+import med_parser
+
+# ENV:
+#   MED_INDEX_PATH=/var/lib/med_index.json   (default <tmp>/med_index.json; empty string = memory only)
+MED_INDEX_PATH = os.getenv("MED_INDEX_PATH", os.path.join(tempfile.gettempdir(), "med_index.json"))
+
+log = logging.getLogger("med-index")
+
+_LOCK = threading.Lock()
+_INDEX: dict = {}      # key -> {"generic", "form", "route", "source", "hits"}
+_STATS = {"lookups": 0, "hits": 0, "misses": 0, "learned": 0}
+_DIRTY = False
+_NON_KEY_RX = re.compile(r"[^a-z0-9]+")
+
+
+def name_key(name: str) -> str:
+    """Normalized lookup key: accents stripped, lowercase, punctuation/whitespace collapsed."""
+    x = unicodedata.normalize("NFKD", name or "").encode("ascii", "ignore").decode("ascii")
+    return _NON_KEY_RX.sub(" ", x.lower()).strip()
+
+
+def _seed():
+    for g in med_parser.GENERICS:
+        _INDEX.setdefault(name_key(g), {"generic": g, "form": None, "route": None, "source": "lexicon", "hits": 0})
+    for b, g in med_parser.BRANDS.items():
+        _INDEX.setdefault(name_key(b), {"generic": g, "form": None, "route": None, "source": "lexicon", "hits": 0})
+
+
+def _load():
+    _seed()
+    if not MED_INDEX_PATH or not os.path.exists(MED_INDEX_PATH):
+        return
+    try:
+        with open(MED_INDEX_PATH, "r", encoding="utf-8") as fh:
+            doc = json.load(fh)
+        for k, v in (doc.get("entries") or {}).items():
+            if isinstance(v, dict) and v.get("generic"):
+                _INDEX[k] = v
+    except Exception as e:
+        log.warning(f"med index load failed ({MED_INDEX_PATH}): {e}")
+
+
+def save():
+    """Write learned entries to MED_INDEX_PATH atomically (no-op when nothing changed)."""
+    global _DIRTY
+    if not MED_INDEX_PATH:
+        return
+    with _LOCK:
+        if not _DIRTY:
+            return
+        learned = {k: v for k, v in _INDEX.items() if v.get("source") != "lexicon"}
+        _DIRTY = False
+    try:
+        folder = os.path.dirname(MED_INDEX_PATH) or "."
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump({"version": 1, "entries": learned}, fh, ensure_ascii=False)
+        os.replace(tmp, MED_INDEX_PATH)
+    except Exception as e:
+        log.warning(f"med index write failed ({MED_INDEX_PATH}): {e}")
+
+
+def lookup(name: str):
+    """Entry for a medication name (copy), or None. Counts toward the hit rate."""
+    key = name_key(name)
+    with _LOCK:
+        _STATS["lookups"] += 1
+        hit = _INDEX.get(key) if key else None
+        if hit is None:
+            _STATS["misses"] += 1
+            return None
+        _STATS["hits"] += 1
+        hit["hits"] = hit.get("hits", 0) + 1
+        return dict(hit)
+
+
+def learn(name: str, generic: str, form: str = None, route: str = None) -> bool:
+    """Record a mapping produced by the model. Lexicon entries are never overwritten."""
+    global _DIRTY
+    key = name_key(name)
+    generic = (generic or "").strip().lower()
+    if not key or not generic:
+        return False
+    with _LOCK:
+        cur = _INDEX.get(key)
+        if cur and cur.get("source") == "lexicon":
+            return False
+        if cur and cur.get("generic") == generic:
+            return False
+        _INDEX[key] = {"generic": generic, "form": form, "route": route, "source": "learned", "hits": 0}
+        _STATS["learned"] += 1
+        _DIRTY = True
+    return True
+
+
+def stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+        out["entries"] = len(_INDEX)
+        out["learned_entries"] = sum(1 for v in _INDEX.values() if v.get("source") == "learned")
+    out["hit_rate"] = round(out["hits"] / out["lookups"], 4) if out["lookups"] else 0.0
+    return out
+
+
+_load()
@@ -0,0 +1,332 @@
+# med_parser.py — tokenizing medication-line parser backed by a token trie (no regex backtracking)
+#
+# One pass over the tokens of a line; at each position the trie returns the longest known phrase
+# (generic, brand, form, route, frequency, PRN). Strength is "<number> <unit>" (glued or spaced).
+# Everything is built once at import. Benchmark against the legacy regex: python med_bench.py
+import re
+
+# ---------- Vocabulary ----------
+GENERICS = [
+    # cardiovascular
+    "amlodipine", "nifedipine", "diltiazem", "verapamil", "lisinopril", "enalapril", "ramipril", "perindopril",
+    "captopril", "losartan", "valsartan", "irbesartan", "candesartan", "telmisartan", "olmesartan",
+    "metoprolol", "atenolol", "bisoprolol", "carvedilol", "propranolol", "nebivolol", "labetalol",
+    "hydrochlorothiazide", "chlorthalidone", "indapamide", "furosemide", "bumetanide", "torsemide",
+    "spironolactone", "eplerenone", "hydralazine", "isosorbide mononitrate", "isosorbide dinitrate",
+    "nitroglycerin", "digoxin", "amiodarone", "sacubitril", "ivabradine", "clonidine", "doxazosin",
+    "atorvastatin", "rosuvastatin", "simvastatin", "pravastatin", "ezetimibe", "fenofibrate",
+    "aspirin", "clopidogrel", "ticagrelor", "prasugrel", "warfarin", "apixaban", "rivaroxaban",
+    "dabigatran", "edoxaban", "heparin", "enoxaparin",
+    # endocrine
+    "metformin", "gliclazide", "glimepiride", "glipizide", "sitagliptin", "linagliptin", "vildagliptin",
+    "empagliflozin", "dapagliflozin", "canagliflozin", "pioglitazone", "liraglutide", "semaglutide",
+    "dulaglutide", "insulin glargine", "insulin detemir", "insulin degludec", "insulin aspart",
+    "insulin lispro", "insulin", "levothyroxine", "methimazole", "carbimazole", "propylthiouracil",
+    "prednisolone", "prednisone", "hydrocortisone", "dexamethasone", "methylprednisolone",
+    "alendronate", "calcitriol", "cholecalciferol", "colecalciferol",
+    # GI
+    "omeprazole", "esomeprazole", "pantoprazole", "lansoprazole", "rabeprazole", "famotidine",
+    "ranitidine", "ondansetron", "metoclopramide", "domperidone", "loperamide", "lactulose",
+    "bisacodyl", "senna", "mesalamine", "hyoscine butylbromide",
+    # anti-infectives
+    "amoxicillin", "amoxicillin clavulanate", "ampicillin", "piperacillin tazobactam", "cefuroxime",
+    "ceftriaxone", "cefixime", "cephalexin", "cefalexin", "azithromycin", "clarithromycin",
+    "erythromycin", "doxycycline", "ciprofloxacin", "levofloxacin", "moxifloxacin",
+    "trimethoprim sulfamethoxazole", "nitrofurantoin", "metronidazole", "clindamycin", "vancomycin",
+    "linezolid", "meropenem", "gentamicin", "fluconazole", "acyclovir", "valacyclovir", "oseltamivir",
+    # neuro / psych
+    "sertraline", "fluoxetine", "escitalopram", "citalopram", "paroxetine", "venlafaxine", "duloxetine",
+    "mirtazapine", "amitriptyline", "bupropion", "trazodone", "quetiapine", "olanzapine", "risperidone",
+    "aripiprazole", "haloperidol", "lithium", "lorazepam", "diazepam", "alprazolam", "clonazepam",
+    "zolpidem", "melatonin", "levetiracetam", "valproate", "sodium valproate", "carbamazepine",
+    "lamotrigine", "phenytoin", "topiramate", "gabapentin", "pregabalin", "donepezil", "memantine",
+    "levodopa carbidopa", "sumatriptan",
+    # analgesics
+    "paracetamol", "acetaminophen", "ibuprofen", "naproxen", "diclofenac", "celecoxib", "meloxicam",
+    "tramadol", "codeine", "morphine", "oxycodone", "hydromorphone", "fentanyl", "colchicine",
+    "allopurinol", "febuxostat",
+    # respiratory / allergy
+    "salbutamol", "albuterol", "ipratropium", "tiotropium", "budesonide", "fluticasone",
+    "budesonide formoterol", "fluticasone salmeterol", "montelukast", "cetirizine", "loratadine",
+    "fexofenadine", "diphenhydramine",
+    # urology / misc
+    "tamsulosin", "finasteride", "sildenafil", "tadalafil", "oxybutynin", "folic acid", "ferrous sulfate",
+    "cyanocobalamin", "potassium chloride", "calcium carbonate", "magnesium oxide", "methotrexate",
+    "hydroxychloroquine", "tacrolimus", "mycophenolate", "epoetin alfa",
+]
+
+# brand (lowercase) -> generic INN
+BRANDS = {
+    "lipitor": "atorvastatin", "crestor": "rosuvastatin", "zocor": "simvastatin", "zetia": "ezetimibe",
+    "norvasc": "amlodipine", "zestril": "lisinopril", "prinivil": "lisinopril", "cozaar": "losartan",
+    "diovan": "valsartan", "micardis": "telmisartan", "lopressor": "metoprolol", "toprol": "metoprolol",
+    "toprol xl": "metoprolol", "concor": "bisoprolol", "coreg": "carvedilol", "lasix": "furosemide",
+    "aldactone": "spironolactone", "lanoxin": "digoxin", "cordarone": "amiodarone",
+    "entresto": "sacubitril valsartan", "plavix": "clopidogrel", "brilinta": "ticagrelor",
+    "coumadin": "warfarin", "eliquis": "apixaban", "xarelto": "rivaroxaban", "pradaxa": "dabigatran",
+    "lovenox": "enoxaparin", "clexane": "enoxaparin", "aspirin protect": "aspirin", "ecotrin": "aspirin",
+    "glucophage": "metformin", "diamicron": "gliclazide", "amaryl": "glimepiride", "januvia": "sitagliptin",
+    "janumet": "sitagliptin metformin", "galvus": "vildagliptin", "trajenta": "linagliptin",
+    "jardiance": "empagliflozin", "forxiga": "dapagliflozin", "farxiga": "dapagliflozin",
+    "invokana": "canagliflozin", "victoza": "liraglutide", "ozempic": "semaglutide", "rybelsus": "semaglutide",
+    "wegovy": "semaglutide", "trulicity": "dulaglutide", "lantus": "insulin glargine",
+    "toujeo": "insulin glargine", "levemir": "insulin detemir", "tresiba": "insulin degludec",
+    "novorapid": "insulin aspart", "novolog": "insulin aspart", "humalog": "insulin lispro",
+    "synthroid": "levothyroxine", "eltroxin": "levothyroxine", "euthyrox": "levothyroxine",
+    "tapazole": "methimazole", "fosamax": "alendronate",
+    "prilosec": "omeprazole", "losec": "omeprazole", "nexium": "esomeprazole", "protonix": "pantoprazole",
+    "controloc": "pantoprazole", "prevacid": "lansoprazole", "pepcid": "famotidine", "zantac": "ranitidine",
+    "zofran": "ondansetron", "reglan": "metoclopramide", "motilium": "domperidone", "imodium": "loperamide",
+    "buscopan": "hyoscine butylbromide", "augmentin": "amoxicillin clavulanate",
+    "zithromax": "azithromycin", "zithro": "azithromycin", "klacid": "clarithromycin",
+    "cipro": "ciprofloxacin", "ciprobay": "ciprofloxacin", "levaquin": "levofloxacin", "tavanic": "levofloxacin",
+    "avelox": "moxifloxacin", "bactrim": "trimethoprim sulfamethoxazole", "septrin": "trimethoprim sulfamethoxazole",
+    "macrobid": "nitrofurantoin", "flagyl": "metronidazole", "rocephin": "ceftriaxone", "zinnat": "cefuroxime",
+    "keflex": "cephalexin", "tazocin": "piperacillin tazobactam", "diflucan": "fluconazole",
+    "zovirax": "acyclovir", "valtrex": "valacyclovir", "tamiflu": "oseltamivir",
+    "zoloft": "sertraline", "lustral": "sertraline", "prozac": "fluoxetine", "lexapro": "escitalopram",
+    "cipralex": "escitalopram", "celexa": "citalopram", "paxil": "paroxetine", "seroxat": "paroxetine",
+    "effexor": "venlafaxine", "cymbalta": "duloxetine", "remeron": "mirtazapine", "wellbutrin": "bupropion",
+    "seroquel": "quetiapine", "zyprexa": "olanzapine", "risperdal": "risperidone", "abilify": "aripiprazole",
+    "ativan": "lorazepam", "valium": "diazepam", "xanax": "alprazolam", "rivotril": "clonazepam",
+    "klonopin": "clonazepam", "ambien": "zolpidem", "stilnox": "zolpidem", "keppra": "levetiracetam",
+    "depakote": "valproate", "depakine": "valproate", "tegretol": "carbamazepine", "lamictal": "lamotrigine",
+    "dilantin": "phenytoin", "topamax": "topiramate", "neurontin": "gabapentin", "lyrica": "pregabalin",
+    "aricept": "donepezil", "sinemet": "levodopa carbidopa", "imitrex": "sumatriptan",
+    "panadol": "paracetamol", "tylenol": "acetaminophen", "adol": "paracetamol", "advil": "ibuprofen",
+    "motrin": "ibuprofen", "brufen": "ibuprofen", "aleve": "naproxen", "voltaren": "diclofenac",
+    "cataflam": "diclofenac", "celebrex": "celecoxib", "mobic": "meloxicam", "ultram": "tramadol",
+    "tramal": "tramadol", "oxycontin": "oxycodone", "zyloprim": "allopurinol", "zyloric": "allopurinol",
+    "uloric": "febuxostat", "ventolin": "salbutamol", "proair": "albuterol", "atrovent": "ipratropium",
+    "spiriva": "tiotropium", "pulmicort": "budesonide", "flixotide": "fluticasone", "flovent": "fluticasone",
+    "symbicort": "budesonide formoterol", "seretide": "fluticasone salmeterol", "advair": "fluticasone salmeterol",
+    "singulair": "montelukast", "zyrtec": "cetirizine", "claritin": "loratadine", "clarityne": "loratadine",
+    "allegra": "fexofenadine", "telfast": "fexofenadine", "benadryl": "diphenhydramine",
+    "flomax": "tamsulosin", "proscar": "finasteride", "viagra": "sildenafil", "cialis": "tadalafil",
+    "plaquenil": "hydroxychloroquine", "prograf": "tacrolimus", "cellcept": "mycophenolate",
+}
+
+# surface phrase -> canonical value
+FORMS = {
+    "tablet": "tablet", "tablets": "tablet", "tab": "tablet", "tabs": "tablet",
+    "capsule": "capsule", "capsules": "capsule", "cap": "capsule", "caps": "capsule",
+    "syrup": "syrup", "solution": "solution", "soln": "solution", "suspension": "suspension", "susp": "suspension",
+    "patch": "patch", "injection": "injection", "inj": "injection", "cream": "cream", "ointment": "ointment",
+    "oint": "ointment", "gel": "gel", "drops": "drops", "drop": "drops", "spray": "spray", "inhaler": "inhaler",
+    "nebule": "nebule", "nebules": "nebule", "suppository": "suppository", "sachet": "sachet", "lozenge": "lozenge",
+    "pen": "pen", "vial": "vial", "ampoule": "ampoule", "amp": "ampoule",
+    "er tablet": "tablet", "xr tablet": "tablet", "sr tablet": "tablet", "film coated tablet": "tablet",
+}
+ROUTES = {
+    "po": "oral", "oral": "oral", "orally": "oral", "by mouth": "oral", "per os": "oral",
+    "iv": "intravenous", "intravenous": "intravenous", "im": "intramuscular", "intramuscular": "intramuscular",
+    "sc": "subcutaneous", "sq": "subcutaneous", "subcut": "subcutaneous", "subcutaneous": "subcutaneous",
+    "sl": "sublingual", "sublingual": "sublingual", "topical": "topical", "topically": "topical",
+    "inhalation": "inhalation", "inhaled": "inhalation", "ophthalmic": "ophthalmic", "otic": "otic",
+    "nasal": "nasal", "intranasal": "nasal", "rectal": "rectal", "pr": "rectal", "vaginal": "vaginal",
+    "transdermal": "transdermal",
+}
+FREQUENCIES = {
+    "once daily": "once daily", "once a day": "once daily", "daily": "once daily", "od": "once daily",
+    "qd": "once daily", "every day": "once daily", "twice daily": "twice daily", "twice a day": "twice daily",
+    "bid": "twice daily", "bd": "twice daily", "three times daily": "three times daily",
+    "three times a day": "three times daily", "tid": "three times daily", "tds": "three times daily",
+    "four times daily": "four times daily", "four times a day": "four times daily", "qid": "four times daily",
+    "qds": "four times daily", "qhs": "at bedtime", "hs": "at bedtime", "at bedtime": "at bedtime",
+    "at night": "at night", "nocte": "at night", "qam": "every morning", "in the morning": "every morning",
+    "mane": "every morning", "qpm": "every evening", "weekly": "weekly", "once weekly": "weekly",
+    "once a week": "weekly", "monthly": "monthly", "stat": "once", "qod": "every other day",
+    "every other day": "every other day",
+}
+PRN = {"prn": "prn", "as needed": "prn", "when needed": "prn", "as required": "prn", "if needed": "prn"}
+
+STRENGTH_UNITS = {
+    "mg": "mg", "mcg": "mcg", "ug": "mcg", "µg": "mcg", "g": "g", "gm": "g", "iu": "iu", "u": "units",
+    "unit": "units", "units": "units", "ml": "ml", "meq": "meq", "mmol": "mmol", "%": "%",
+}
+
+# ---------- Tokenizer ----------
+# glued strengths ("500mg"), words (with internal - or ', "q8h"), decimals, percent;
+# spans are kept so the name keeps its original casing
+_TOKEN_RX = re.compile(r"\d+(?:\.\d+)?[A-Za-zµ%]+|[A-Za-zµ]+(?:['\-][A-Za-z]+)*\d*[A-Za-z]*|\d+(?:\.\d+)?|%")
+_GLUED_STRENGTH_RX = re.compile(r"^(\d+(?:\.\d+)?)([a-zµ%]+)$")
+_QH_RX = re.compile(r"^q(\d{1,2})(?:h|hr|hrs)$")
+_NUM_RX = re.compile(r"^\d+(?:\.\d+)?$")
+_HOUR_WORDS = {"h", "hr", "hrs", "hour", "hours"}
+_LEADING_BULLET_RX = re.compile(r"^\s*(?:[\-\*•]|\d+[.)])\s*")
+
+
+def _tokens(line: str):
+    """[(lower, start, end)] with '500mg' split into ('500', 'mg')."""
+    out = []
+    for m in _TOKEN_RX.finditer(line):
+        tok = m.group(0).lower()
+        g = _GLUED_STRENGTH_RX.match(tok)
+        if g and g.group(2) in STRENGTH_UNITS:
+            cut = m.start() + len(g.group(1))
+            out.append((g.group(1), m.start(), cut))
+            out.append((g.group(2), cut, m.end()))
+        else:
+            out.append((tok, m.start(), m.end()))
+    return out
+
+
+# ---------- Token trie (longest match from a position) ----------
+class TokenTrie:
+    __slots__ = ("root", "size")
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, phrase: str, kind: str, value: str):
+        node = self.root
+        for tok in phrase.lower().replace("-", " ").split():
+            node = node.setdefault(tok, {})
+        if None not in node:  # first registration wins (generic names before brands)
+            node[None] = (kind, value)
+            self.size += 1
+
+    def longest(self, toks: list, i: int):
+        """(kind, value, n_tokens) for the longest phrase starting at toks[i], or None."""
+        node, best, j = self.root, None, i
+        while j < len(toks):
+            node = node.get(toks[j])
+            if node is None:
+                break
+            j += 1
+            if None in node:
+                best = (*node[None], j - i)
+        return best
+
+
+def _build_trie() -> TokenTrie:
+    t = TokenTrie()
+    for g in GENERICS:
+        t.add(g, "drug", g)
+    for b, g in BRANDS.items():
+        t.add(b, "drug", g)
+    for table, kind in ((FORMS, "form"), (ROUTES, "route"), (FREQUENCIES, "frequency"), (PRN, "prn")):
+        for surface, canon in table.items():
+            t.add(surface, kind, canon)
+    return t
+
+
+LEXICON = _build_trie()
+
+
+def _token_words(toks):
+    """Token list for trie lookups ('-' split like the trie does)."""
+    words, owners = [], []
+    for k, (tok, _, _) in enumerate(toks):
+        for part in tok.split("-"):
+            if part:
+                words.append(part)
+                owners.append(k)
+    return words, owners
+
+
+def parse_line(line: str):
+    """
+    Parse one medication line into {name, generic, strength, unit, form, route, frequency, prn, raw}.
+    `generic` is the INN when the name is a known generic/brand, else None. Returns None if no name.
+    Form/route/frequency keep the text as written (e.g. "tab", "BID"), like the legacy regex.
+    """
+    raw = (line or "").strip()
+    text = _LEADING_BULLET_RX.sub("", raw)
+    toks = _tokens(text)
+    if not toks:
+        return None
+    words, owners = _token_words(toks)
+
+    found = {}
+    name_span = None       # (start_char, end_char) of a known drug name
+    attrs = []             # (start_char, end_char) of every recognised non-name token run
+    strength = unit = None
+
+    i = 0
+    while i < len(words):
+        w = words[i]
+        start = toks[owners[i]][1]
+        # strength: number + unit
+        if _NUM_RX.match(w):
+            if strength is None and i + 1 < len(words) and words[i + 1] in STRENGTH_UNITS:
+                u_tok = toks[owners[i + 1]]
+                strength, unit = w, text[u_tok[1]:u_tok[2]]
+                attrs.append((start, toks[owners[i + 1]][2]))
+                i += 2
+                continue
+            # "every 8 hours" is handled at "every"; stray numbers end a free-text name
+            attrs.append((start, toks[owners[i]][2]))
+            i += 1
+            continue
+        if w == "every" and i + 2 < len(words) and _NUM_RX.match(words[i + 1]) and words[i + 2] in _HOUR_WORDS:
+            found.setdefault("frequency", text[start:toks[owners[i + 2]][2]])
+            attrs.append((start, toks[owners[i + 2]][2]))
+            i += 3
+            continue
+        if _QH_RX.match(w):
+            found.setdefault("frequency", text[start:toks[owners[i]][2]])
+            attrs.append((start, toks[owners[i]][2]))
+            i += 1
+            continue
+        hit = LEXICON.longest(words, i)
+        if hit:
+            kind, value, n = hit
+            end = toks[owners[i + n - 1]][2]
+            if kind == "drug":
+                if "generic" not in found:
+                    found["generic"] = value
+                    name_span = (start, end)
+            else:
+                found.setdefault(kind, text[start:end])
+                attrs.append((start, end))
+            i += n
+            continue
+        i += 1
+
+    if name_span is None:
+        # unknown drug: the first free-text run between recognised attributes ("Tab. Vitamin D3 1000 IU")
+        name, prev = None, 0
+        for a_start, a_end in attrs + [(len(text), len(text))]:
+            gap = text[prev:a_start].strip(" ,;:.-")
+            if gap and gap[0].isalpha():
+                name = re.sub(r"\s+", " ", gap)
+                break
+            prev = a_end
+        if name is None:
+            return None
+    else:
+        name = text[name_span[0]:name_span[1]]
+
+    return {
+        "name": name,
+        "generic": found.get("generic"),
+        "strength": strength,
+        "unit": unit,
+        "form": found.get("form"),
+        "route": found.get("route"),
+        "frequency": found.get("frequency"),
+        "prn": "prn" in found,
+        "raw": raw,
+    }
+
+
+# ---------- Legacy regex (kept for the benchmark / comparison only) ----------
+STRENGTH_RX = r"(?P<strength>\d+(?:\.\d+)?)(?:\s*)(?P<unit>mg|mcg|g|iu|units|ml)\b"
+FREQ_WORDS   = r"(once daily|twice daily|three times daily|every\s*\d+\s*(?:h|hr|hrs|hours)|bid|tid|qid|q\d+h|qhs|qam|qpm|prn)"
+FORM_WORDS   = r"(tablet|tab|capsule|cap|syrup|solution|suspension|patch|injection|cream|ointment|drops|spray)"
+ROUTE_WORDS  = r"(po|oral|by mouth|iv|im|sc|subcut|subcutaneous|topical|inhalation|ophthalmic|otic|nasal|rectal|vaginal)"
+
+NAME_FIRST_RX = re.compile(
+    rf"""
+    ^\s*
+    (?P<name>[A-Za-z][A-Za-z0-9\-\s']+)
+    (?:[,;\s]+{STRENGTH_RX})?
+    (?:[,;\s]+(?P<form>{FORM_WORDS}))?
+    (?:[,;\s]+(?P<route>{ROUTE_WORDS}))?
+    (?:[,;\s]+(?P<frequency>{FREQ_WORDS}))?
+    (?:[,;\s]+(?P<prn>prn))?
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
@@ -0,0 +1,60 @@
+# medimg_batch.py — batched Vertex predict for multi-image studies (image.py /api/medimg/analyze-study)
+#
+# Instances are packed MEDIMG_MAX_BATCH per predict call (the endpoint's batch limit) and the calls run
+# in parallel on a bounded pool, so an N-view study costs ceil(N / batch) concurrent round trips
+# instead of N sequential ones.
+import os, json, logging
+from concurrent.futures import ThreadPoolExecutor
+
+# ENV:
+#   MEDIMG_MAX_BATCH=4     (instances per predict call; 1 = one image per call)
+#   MEDIMG_PARALLEL=4      (predict calls in flight across all studies)
+MEDIMG_MAX_BATCH = max(1, int(os.getenv("MEDIMG_MAX_BATCH", "4")))
+MEDIMG_PARALLEL = max(1, int(os.getenv("MEDIMG_PARALLEL", "4")))
+
+log = logging.getLogger("medimg-batch")
+
+PREDICT_POOL = ThreadPoolExecutor(max_workers=MEDIMG_PARALLEL, thread_name_prefix="medimg-predict")
+
+
+def prediction_text(pred) -> str:
+    """Vertex prediction -> text (chat endpoints return {"content": ...}; others a string or object)."""
+    if isinstance(pred, dict) and "content" in pred:
+        return pred["content"]
+    if hasattr(pred, "get") and not isinstance(pred, str) and pred.get("content") is not None:
+        return pred.get("content")
+    return pred if isinstance(pred, str) else json.dumps(dict(pred) if hasattr(pred, "items") else pred)
+
+
+def chunks(items: list, size: int) -> list:
+    return [(i, items[i:i + size]) for i in range(0, len(items), size)]
+
+
+def predict_many(client, endpoint: str, instances: list, to_value=lambda x: x,
+                 max_batch: int = None, pool: ThreadPoolExecutor = None) -> dict:
+    """
+    Run `instances` through client.predict in chunks of `max_batch`, chunks in parallel.
+    Returns {"items": [{"text", "error"}] in input order, "calls": n}. A failed chunk marks only its items.
+    """
+    size = max(1, max_batch or MEDIMG_MAX_BATCH)
+    pool = pool or PREDICT_POOL
+
+    def call(chunk):
+        resp = client.predict(endpoint=endpoint, instances=[to_value(x) for x in chunk])
+        return [prediction_text(p) for p in resp.predictions]
+
+    parts = chunks(instances, size)
+    futures = [(pool.submit(call, c), start, len(c)) for start, c in parts]
+    out = [None] * len(instances)
+    for fut, start, n in futures:
+        try:
+            texts = fut.result()
+            if len(texts) != n:
+                raise ValueError(f"Expected {n} predictions, got {len(texts)}")
+            for k, t in enumerate(texts):
+                out[start + k] = {"text": t, "error": None}
+        except Exception as e:
+            log.warning(f"predict chunk at {start} ({n} instances) failed: {e}")
+            for k in range(n):
+                out[start + k] = {"text": None, "error": str(e)}
+    return {"items": out, "calls": len(parts)}
@@ -0,0 +1,134 @@
+# medimg_chat.py — follow-up prompts for image.py /api/medimg/chat
+#
+# "full" replays the legacy prompt: the report is re-serialized, the last six history lines are replayed
+# verbatim and the original image is resent on every turn.
+# "compact" serializes the report once per session, packs history newest-first into a token budget
+# (latest turn clipped to ~800 characters, older turns to their question and the answer's first sentence)
+# and sends a thumbnail at the model's native image size instead of the original.
+import os, re, json, base64, logging
+
+import image_prep
+
+# ENV:
+#   MEDIMG_CHAT_MODE=compact              (compact | full; a request may pass "mode")
+#   MEDIMG_CHAT_HISTORY_TOKENS=300        (history budget in the compact prompt)
+MEDIMG_CHAT_MODE = os.getenv("MEDIMG_CHAT_MODE", "compact").lower()
+MEDIMG_CHAT_HISTORY_TOKENS = int(os.getenv("MEDIMG_CHAT_HISTORY_TOKENS", "300"))
+
+MODES = ("compact", "full")
+
+log = logging.getLogger("medimg-chat")
+
+_SENTENCE_RX = re.compile(r"(?<=[.!?])\s+")
+
+
+def est_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token); only used for budgeting."""
+    return (len(text or "") + 3) // 4
+
+
+def report_text(sess: dict) -> str:
+    """Minified report JSON, serialized once per session."""
+    if sess.get("report_text") is None:
+        sess["report_text"] = json.dumps(sess["report_json"], separators=(",", ":"))
+    return sess["report_text"]
+
+
+def _clip(text: str, n: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= n else text[:n - 1].rstrip() + "…"
+
+
+def _first_sentence(text: str, n: int = 240) -> str:
+    return _clip(_SENTENCE_RX.split(" ".join((text or "").split()), 1)[0], n)
+
+
+def history_block(history: list, budget_tokens: int = None) -> tuple:
+    """
+    (text, tokens, turns) for the prompt: Q/A pairs newest first until the budget is spent,
+    the latest pair near-verbatim and older pairs compressed. Emitted oldest first.
+    """
+    budget = MEDIMG_CHAT_HISTORY_TOKENS if budget_tokens is None else budget_tokens
+    pairs = []
+    for i in range(0, len(history) - 1, 2):
+        if history[i].get("role") == "user" and history[i + 1].get("role") == "assistant":
+            pairs.append((history[i]["text"], history[i + 1]["text"]))
+    lines, used = [], 0
+    for k, (q, a) in enumerate(reversed(pairs)):
+        if k == 0:
+            block = f"User: {_clip(q, 400)}\nAssistant: {_clip(a, 800)}"
+        else:
+            block = f"User: {_clip(q, 200)}\nAssistant: {_first_sentence(a)}"
+        cost = est_tokens(block)
+        if used + cost > budget:
+            if k == 0:  # always keep something of the latest turn
+                block = f"User: {_clip(q, 200)}\nAssistant: {_first_sentence(a)}"
+                cost = est_tokens(block)
+                lines.append(block)
+                used += cost
+            break
+        lines.append(block)
+        used += cost
+    lines.reverse()
+    turns = len(lines)
+    if turns < len(pairs):
+        lines.insert(0, f"(earlier: {len(pairs) - turns} turns omitted)")
+    return "\n".join(lines), used, turns
+
+
+def thumbnail(sess: dict) -> tuple:
+    """(b64, mime) downscaled for follow-ups; made once per session. The original is kept when it is
+    already smaller (or cannot be decoded)."""
+    if sess.get("thumb_b64") is None:
+        try:
+            data = base64.b64decode(sess["image_b64"])
+            out, mime, rep = image_prep.prepare_image(data, sess["mime"], "medimg_thumb")
+            if rep.get("changed") and len(out) < len(data):
+                sess["thumb_b64"], sess["thumb_mime"] = base64.b64encode(out).decode("ascii"), mime
+            else:
+                sess["thumb_b64"], sess["thumb_mime"] = sess["image_b64"], sess["mime"]
+        except Exception as e:
+            log.warning(f"thumbnail failed, using the original image: {e}")
+            sess["thumb_b64"], sess["thumb_mime"] = sess["image_b64"], sess["mime"]
+    return sess["thumb_b64"], sess["thumb_mime"]
+
+
+def build_prompt(sess: dict, user_text: str, system_chat: str, mode: str = None) -> dict:
+    """{"prompt", "image_b64", "mime", "meta"} for one follow-up turn."""
+    mode = mode if mode in MODES else MEDIMG_CHAT_MODE
+    header = f"{system_chat}\n\nModality: {sess['modality']}; Region: {sess['body_region']}\n"
+    if mode == "full":
+        context = json.dumps(sess["report_json"], separators=(",", ":"))
+        history_lines = []
+        for m in sess["history"][-6:]:  # keep last 3 Q/A pairs
+            history_lines.append(f"{m['role'].capitalize()}: {m['text']}")
+        history_text = "\n".join(history_lines)
+        prompt = (
+            f"{header}"
+            f"Prior structured report JSON:\n{context}\n\n"
+            f"{history_text}\n"
+            f"User: {user_text}\nAssistant:"
+        )
+        img_b64, mime = sess["image_b64"], sess["mime"]
+        history_tokens = est_tokens(history_text)
+    else:
+        history_text, history_tokens, _ = history_block(sess["history"])
+        prompt = (
+            f"{header}"
+            f"Prior structured report JSON:\n{report_text(sess)}\n\n"
+            + (f"Conversation so far:\n{history_text}\n\n" if history_text else "")
+            + f"User: {user_text}\nAssistant:"
+        )
+        img_b64, mime = thumbnail(sess)
+    return {
+        "prompt": prompt,
+        "image_b64": img_b64,
+        "mime": mime,
+        "meta": {
+            "mode": mode,
+            "history_tokens": history_tokens,
+            "prompt_tokens_est": est_tokens(prompt),
+            "image_b64_bytes": len(img_b64),
+            "image": "original" if img_b64 is sess["image_b64"] else "thumbnail",
+        },
+    }
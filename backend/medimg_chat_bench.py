@@ -0,0 +1,99 @@
+# medimg_chat_bench.py — request size and latency per /api/medimg/chat turn: "full" vs "compact" prompts
+#
+#   python medimg_chat_bench.py --turns 8 --dim 2048 --latency 0.4 --per-kb 0.002
+#
+# Builds a session around a synthetic image (PyMuPDF), then asks the same follow-up questions in both modes
+# through medimg_chat.build_prompt against the fake Vertex client (medimg_fake.py), whose latency grows with
+# the serialized request size. Reports bytes sent, estimated prompt tokens and wall time per turn.
+import json, time, base64, argparse
+
+import medimg_chat
+from medimg_fake import FakePredictionServiceClient
+
+_QUESTIONS = [
+    "Is the opacity more likely consolidation or atelectasis?",
+    "Any sign of pleural effusion on this view?",
+    "How confident is the impression about the cardiac silhouette?",
+    "Would a lateral view change the assessment?",
+    "Are there any lines or tubes visible?",
+    "Summarize the key findings in one sentence.",
+    "What limits the interpretation of this image?",
+    "Is there any bony abnormality?",
+]
+
+
+def _image(dim: int, seed: int) -> bytes:
+    """Radiograph-like PNG: smooth grayscale anatomy-ish gradients plus sensor noise."""
+    import numpy as np
+    import fitz  # PyMuPDF
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:dim, 0:dim] / dim
+    base = 90 + 80 * np.exp(-((xx - 0.3) ** 2 + (yy - 0.5) ** 2) / 0.05) + 80 * np.exp(-((xx - 0.7) ** 2 + (yy - 0.5) ** 2) / 0.05)
+    base += 25 * np.sin(yy * 40) * (np.abs(xx - 0.5) > 0.08)  # ribs
+    gray = np.clip(base + rng.normal(0, 6, base.shape), 0, 255).astype(np.uint8)
+    rgb = np.repeat(gray[:, :, None], 3, axis=2)
+    pix = fitz.Pixmap(fitz.csRGB, dim, dim, rgb.tobytes(), False)
+    return pix.tobytes("png")
+
+
+def _session(img: bytes) -> dict:
+    return {
+        "image_b64": base64.b64encode(img).decode("ascii"), "mime": "image/png",
+        "modality": "radiology", "body_region": "chest", "history": [],
+        "report_json": {
+            "indication": "cough", "technique": "PA chest radiograph",
+            "findings": [{"system": "thorax", "detail": "right lower zone opacity"}] * 4,
+            "impression": [{"statement": "possible right lower lobe pneumonia", "priority": "medium"}],
+            "follow_up": [{"recommendation": "follow-up radiograph in 6 weeks", "urgency_hours": 1008}],
+            "limitations": "single view",
+        },
+    }
+
+
+def _answer(i: int) -> str:
+    return (f"Answer {i}: the right lower zone opacity is most consistent with consolidation. "
+            + "Air bronchograms are suggested but not definite, and the costophrenic angle is preserved. " * 8).strip()
+
+
+def run(mode: str, img: bytes, turns: int, client) -> list:
+    sess, rows = _session(img), []
+    for i in range(turns):
+        q = _QUESTIONS[i % len(_QUESTIONS)]
+        built = medimg_chat.build_prompt(sess, q, "SYSTEM_CHAT", mode)
+        instance = {"prompt": built["prompt"], "images": [{"mimeType": built["mime"],
+                                                          "bytesBase64Encoded": built["image_b64"]}],
+                    "maxTokens": 800, "temperature": 0.2, "topP": 0.95}
+        t0 = time.perf_counter()
+        client.predict(endpoint="bench", instances=[instance])
+        rows.append((len(json.dumps(instance)), built["meta"]["prompt_tokens_est"], time.perf_counter() - t0))
+        sess["history"] += [{"role": "user", "text": q}, {"role": "assistant", "text": _answer(i)}]
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-turn request size / latency for /api/medimg/chat modes")
+    ap.add_argument("--turns", type=int, default=8)
+    ap.add_argument("--dim", type=int, default=2048)
+    ap.add_argument("--latency", type=float, default=0.4)
+    ap.add_argument("--per-kb", type=float, default=0.002)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    img = _image(args.dim, args.seed)
+    client = FakePredictionServiceClient(latency_s=args.latency, per_instance_s=0, per_kb_s=args.per_kb)
+    print(f"image {args.dim}x{args.dim} png, {len(img) / 1024:.0f} KB; "
+          f"fake latency {args.latency}s + {args.per_kb}s/KB")
+    results = {m: run(m, img, args.turns, client) for m in medimg_chat.MODES}
+    print(f"{'turn':>4} | {'full KB':>8} {'tok':>6} {'ms':>7} | {'compact KB':>10} {'tok':>6} {'ms':>7}")
+    for i in range(args.turns):
+        f, c = results["full"][i], results["compact"][i]
+        print(f"{i + 1:>4} | {f[0] / 1024:8.1f} {f[1]:6d} {f[2] * 1000:7.0f} | "
+              f"{c[0] / 1024:10.1f} {c[1]:6d} {c[2] * 1000:7.0f}")
+    for m in medimg_chat.MODES:
+        rows = results[m]
+        print(f"{m:>8}: mean {sum(r[0] for r in rows) / len(rows) / 1024:.1f} KB/turn, "
+              f"{sum(r[2] for r in rows) / len(rows) * 1000:.0f} ms/turn")
+
+
+if __name__ == "__main__":
+    main()
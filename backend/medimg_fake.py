@@ -0,0 +1,104 @@
+# medimg_fake.py — local stand-in for aiplatform.gapic.PredictionServiceClient (tests / benchmarks)
+#
+#   python medimg_fake.py --images 6 --batch 4 --latency 0.8
+#
+# image.py uses it when MEDIMG_FAKE=1. Each predict call sleeps latency_s + per_instance_s * len(instances)
+# + per_kb_s * request KB (a fixed round trip, per-image generation and upload/prefill cost) and answers
+# every instance with a report-shaped JSON.
+# The benchmark compares one-image-per-call sequential prediction with medimg_batch.predict_many.
+import os, json, time, threading, argparse
+from types import SimpleNamespace
+
+import medimg_batch
+
+# ENV:
+#   MEDIMG_FAKE_LATENCY_S=0.8        (per call)
+#   MEDIMG_FAKE_PER_IMAGE_S=0.15     (per instance in the call)
+#   MEDIMG_FAKE_MAX_BATCH=0          (reject larger calls like a limited endpoint; 0 = unlimited)
+#   MEDIMG_FAKE_PER_KB_S=0           (per KB of serialized instances)
+MEDIMG_FAKE_LATENCY_S = float(os.getenv("MEDIMG_FAKE_LATENCY_S", "0.8"))
+MEDIMG_FAKE_PER_IMAGE_S = float(os.getenv("MEDIMG_FAKE_PER_IMAGE_S", "0.15"))
+MEDIMG_FAKE_MAX_BATCH = int(os.getenv("MEDIMG_FAKE_MAX_BATCH", "0"))
+MEDIMG_FAKE_PER_KB_S = float(os.getenv("MEDIMG_FAKE_PER_KB_S", "0"))
+
+
+def default_responder(index: int, instance) -> str:
+    return json.dumps({
+        "indication": "", "technique": f"fake view {index + 1}",
+        "findings": [{"system": "other", "detail": f"no acute finding (fake {index + 1})"}],
+        "impression": [{"statement": "No acute abnormality (fake).", "priority": "low"}],
+        "follow_up": [], "limitations": "Synthetic response from FakePredictionServiceClient.",
+    }, separators=(",", ":"))
+
+
+def _size(instance) -> int:
+    """Serialized size of a dict or protobuf Value instance."""
+    if hasattr(instance, "ByteSize"):
+        return instance.ByteSize()
+    return len(json.dumps(instance))
+
+
+class FakePredictionServiceClient:
+    def __init__(self, client_options=None, latency_s=None, per_instance_s=None, max_batch=None, responder=None,
+                 per_kb_s=None):
+        self.latency_s = MEDIMG_FAKE_LATENCY_S if latency_s is None else latency_s
+        self.per_instance_s = MEDIMG_FAKE_PER_IMAGE_S if per_instance_s is None else per_instance_s
+        self.per_kb_s = MEDIMG_FAKE_PER_KB_S if per_kb_s is None else per_kb_s
+        self.max_batch = MEDIMG_FAKE_MAX_BATCH if max_batch is None else max_batch
+        self.responder = responder or default_responder
+        self.calls = 0
+        self.instances = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_path(project, location, endpoint):
+        return f"projects/{project}/locations/{location}/endpoints/{endpoint}"
+
+    def predict(self, endpoint, instances):
+        instances = list(instances)
+        if self.max_batch and len(instances) > self.max_batch:
+            raise ValueError(f"Batch of {len(instances)} exceeds endpoint limit {self.max_batch}")
+        size = sum(_size(x) for x in instances)
+        with self._lock:
+            self.calls += 1
+            self.instances += len(instances)
+            self.bytes += size
+            base = self.instances - len(instances)
+        time.sleep(self.latency_s + self.per_instance_s * len(instances) + self.per_kb_s * size / 1024)
+        return SimpleNamespace(predictions=[{"content": self.responder(base + i, x)} for i, x in enumerate(instances)])
+
+
+def _main():
+    ap = argparse.ArgumentParser(description="Sequential vs batched predict against the fake Vertex client")
+    ap.add_argument("--images", type=int, default=6)
+    ap.add_argument("--batch", type=int, default=medimg_batch.MEDIMG_MAX_BATCH)
+    ap.add_argument("--latency", type=float, default=MEDIMG_FAKE_LATENCY_S)
+    ap.add_argument("--per-image", type=float, default=MEDIMG_FAKE_PER_IMAGE_S)
+    args = ap.parse_args()
+
+    instances = [{"prompt": f"view {i}", "images": []} for i in range(args.images)]
+    endpoint = FakePredictionServiceClient.endpoint_path("p", "l", "e")
+    rows = []
+
+    fake = FakePredictionServiceClient(latency_s=args.latency, per_instance_s=args.per_image)
+    t0 = time.perf_counter()
+    for x in instances:
+        fake.predict(endpoint=endpoint, instances=[x])
+    rows.append(("sequential", fake.calls, time.perf_counter() - t0))
+
+    for label, size in (("parallel x1", 1), (f"batched x{args.batch}", args.batch)):
+        fake = FakePredictionServiceClient(latency_s=args.latency, per_instance_s=args.per_image)
+        t0 = time.perf_counter()
+        res = medimg_batch.predict_many(fake, endpoint, instances, max_batch=size)
+        assert all(r["error"] is None for r in res["items"])
+        rows.append((label, res["calls"], time.perf_counter() - t0))
+
+    print(f"{args.images} images, latency {args.latency}s + {args.per_image}s/image, "
+          f"pool {medimg_batch.MEDIMG_PARALLEL}")
+    for label, calls, dt in rows:
+        print(f"  {label:<14} calls={calls:<3} wall={dt:6.2f}s")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,147 @@
+# medimg_fetch.py — pooled, size-capped image fetch with incremental base64 and a content-hash cache
+#
+# One shared requests.Session (keep-alive connection pool) for every image URL. Bodies are streamed:
+# the byte cap is enforced while reading, and base64 + SHA-256 are computed chunk by chunk, so the raw
+# body is never held in memory as a whole.
+# Cache: URL -> (sha256, etag, last_modified, fetched_at); sha256 -> base64. A fresh URL is served without
+# any request, a stale one is revalidated with If-None-Match / If-Modified-Since (304 = no body), and
+# identical bytes behind different URLs share one base64 string.
+import os, time, base64, hashlib, threading, logging
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ENV:
+#   MEDIMG_FETCH_MAX_BYTES=20000000   (per image; larger bodies are rejected mid-stream)
+#   MEDIMG_FETCH_TIMEOUT_S=30
+#   MEDIMG_FETCH_POOL=8               (keep-alive connections per host)
+#   MEDIMG_FETCH_TTL_S=300            (serve from cache without revalidating)
+#   MEDIMG_FETCH_CACHE_MB=128         (base64 bytes kept across all cached images)
+MEDIMG_FETCH_MAX_BYTES = int(os.getenv("MEDIMG_FETCH_MAX_BYTES", str(20 * 1000 * 1000)))
+MEDIMG_FETCH_TIMEOUT_S = float(os.getenv("MEDIMG_FETCH_TIMEOUT_S", "30"))
+MEDIMG_FETCH_POOL = int(os.getenv("MEDIMG_FETCH_POOL", "8"))
+MEDIMG_FETCH_TTL_S = float(os.getenv("MEDIMG_FETCH_TTL_S", "300"))
+MEDIMG_FETCH_CACHE_BYTES = int(float(os.getenv("MEDIMG_FETCH_CACHE_MB", "128")) * 1024 * 1024)
+
+log = logging.getLogger("medimg-fetch")
+
+_CHUNK = 3 * 64 * 1024  # multiple of 3: each chunk base64-encodes without padding
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+_SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=MEDIMG_FETCH_POOL, pool_maxsize=MEDIMG_FETCH_POOL)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+
+_LOCK = threading.Lock()
+_URLS: "OrderedDict[str, dict]" = OrderedDict()      # url -> {"sha256", "mime", "etag", "last_modified", "fetched_at"}
+_BLOBS: "OrderedDict[str, tuple]" = OrderedDict()    # sha256 -> (b64, raw_bytes)
+_BLOB_BYTES = 0
+_STATS = {"requests": 0, "fresh_hits": 0, "revalidated": 0, "downloads": 0, "dedup_hits": 0,
+          "bytes_downloaded": 0, "rejected_too_large": 0}
+
+
+def _stream_b64(resp, max_bytes: int):
+    """(b64, sha256, n_bytes) from a streamed response; raises ImageTooLarge past max_bytes."""
+    declared = resp.headers.get("Content-Length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise ImageTooLarge(f"Image is {int(declared)} bytes (limit {max_bytes})")
+    h = hashlib.sha256()
+    parts, carry, n = [], b"", 0
+    for chunk in resp.iter_content(chunk_size=_CHUNK):
+        if not chunk:
+            continue
+        n += len(chunk)
+        if n > max_bytes:
+            raise ImageTooLarge(f"Image exceeds {max_bytes} bytes")
+        h.update(chunk)
+        buf = carry + chunk
+        cut = len(buf) - len(buf) % 3
+        parts.append(base64.b64encode(buf[:cut]))
+        carry = buf[cut:]
+    parts.append(base64.b64encode(carry))
+    return b"".join(parts).decode("ascii"), h.hexdigest(), n
+
+
+def _blob_put(sha: str, b64: str, n: int):
+    global _BLOB_BYTES
+    if sha in _BLOBS:
+        _BLOBS.move_to_end(sha)
+        return
+    _BLOBS[sha] = (b64, n)
+    _BLOB_BYTES += len(b64)
+    while _BLOB_BYTES > MEDIMG_FETCH_CACHE_BYTES and len(_BLOBS) > 1:
+        _, (old, _) = _BLOBS.popitem(last=False)
+        _BLOB_BYTES -= len(old)
+
+
+def fetch(url: str, max_bytes: int = None) -> dict:
+    """
+    {"b64", "mime", "sha256", "bytes", "source": "cache" | "revalidated" | "download"}.
+    Raises requests.HTTPError for bad statuses and ImageTooLarge past the byte cap.
+    """
+    max_bytes = max_bytes or MEDIMG_FETCH_MAX_BYTES
+    now = time.time()
+    with _LOCK:
+        _STATS["requests"] += 1
+        meta = _URLS.get(url)
+        blob = _BLOBS.get(meta["sha256"]) if meta else None
+        if meta and blob and now - meta["fetched_at"] <= MEDIMG_FETCH_TTL_S:
+            _URLS.move_to_end(url)
+            _BLOBS.move_to_end(meta["sha256"])
+            _STATS["fresh_hits"] += 1
+            return {"b64": blob[0], "mime": meta["mime"], "sha256": meta["sha256"], "bytes": blob[1], "source": "cache"}
+
+    headers = {}
+    if meta and blob:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with _SESSION.get(url, headers=headers, stream=True, timeout=MEDIMG_FETCH_TIMEOUT_S) as r:
+        if r.status_code == 304 and meta and blob:
+            with _LOCK:
+                meta["fetched_at"] = now
+                _URLS.move_to_end(url)
+                _STATS["revalidated"] += 1
+            return {"b64": blob[0], "mime": meta["mime"], "sha256": meta["sha256"], "bytes": blob[1],
+                    "source": "revalidated"}
+        r.raise_for_status()
+        try:
+            b64, sha, n = _stream_b64(r, max_bytes)
+        except ImageTooLarge:
+            with _LOCK:
+                _STATS["rejected_too_large"] += 1
+            raise
+        mime = (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+    with _LOCK:
+        _STATS["downloads"] += 1
+        _STATS["bytes_downloaded"] += n
+        if sha in _BLOBS:
+            _STATS["dedup_hits"] += 1
+            b64 = _BLOBS[sha][0]  # share the existing string
+        _blob_put(sha, b64, n)
+        _URLS[url] = {"sha256": sha, "mime": mime if mime.startswith("image/") else None,
+                      "etag": etag, "last_modified": last_modified, "fetched_at": now}
+        _URLS.move_to_end(url)
+        while len(_URLS) > 4 * max(1, len(_BLOBS)) + 64:
+            _URLS.popitem(last=False)
+        out_mime = _URLS[url]["mime"]
+    return {"b64": b64, "mime": out_mime, "sha256": sha, "bytes": n, "source": "download"}
+
+
+def stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+        out["cached_urls"] = len(_URLS)
+        out["cached_images"] = len(_BLOBS)
+        out["cached_b64_bytes"] = _BLOB_BYTES
+    return out
@@ -0,0 +1,81 @@
+# ocr_bench.py — offline OCR throughput benchmark (fake provider, no network / API key)
+#
+#   python ocr_bench.py --docs 40 --pages 8 --scanned 0.5 --clients 4 --latency 0.2
+#
+# Builds synthetic PDFs (a mix of text-layer and "scanned" blank pages) and pushes them
+# through ocr_engine.run() exactly as /api/ocr does, then prints latency + engine metrics.
+import os, sys, json, time, argparse, statistics
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("OCR_CACHE_DIR", "")  # memory-only cache unless the caller overrides it
+
+
+def _make_pdf(doc_no: int, pages: int, scanned_frac: float) -> bytes:
+    import fitz
+    doc = fitz.open()
+    n_scanned = int(round(pages * scanned_frac))
+    for i in range(pages):
+        page = doc.new_page()
+        if i >= n_scanned:
+            page.insert_text(
+                (72, 72),
+                f"Document {doc_no} page {i + 1}\nHemoglobin 13.2 g/dL (13.0-17.0)\nWBC 6.1 10^3/uL (4.0-10.0)",
+            )
+        else:
+            page.draw_rect(fitz.Rect(72, 72, 300, 300), color=(0, 0, 0), fill=(doc_no % 7 / 7, 0.5, 0.5))
+    return doc.tobytes()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline OCR throughput benchmark against the fake provider")
+    ap.add_argument("--docs", type=int, default=20)
+    ap.add_argument("--pages", type=int, default=6)
+    ap.add_argument("--scanned", type=float, default=0.5, help="fraction of pages without a text layer")
+    ap.add_argument("--clients", type=int, default=4, help="concurrent requests")
+    ap.add_argument("--latency", type=float, default=0.1, help="fake provider seconds per page")
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    ap.add_argument("--repeat", action="store_true", help="upload every document twice (cache hits)")
+    args = ap.parse_args()
+
+    import ocr_engine
+    ocr_engine.set_provider(ocr_engine.FakeProvider(latency_s=args.latency, fail_rate=args.fail_rate))
+
+    docs = [_make_pdf(i, args.pages, args.scanned) for i in range(args.docs)]
+    if args.repeat:
+        docs = docs + docs
+    opts = {"language": "eng", "overlay": "false", "engine": "2"}
+
+    def one(i_data):
+        i, data = i_data
+        t0 = time.time()
+        try:
+            ocr_engine.run(data, f"bench_{i}.pdf", "pdf", "application/pdf", opts)
+            ok = True
+        except ocr_engine.OcrFailure:
+            ok = False
+        return time.time() - t0, ok
+
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(one, enumerate(docs)))
+    wall = time.time() - t0
+
+    lat = sorted(r[0] for r in results)
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+    total_pages = len(docs) * args.pages
+    print(json.dumps({
+        "docs": len(docs),
+        "pages": total_pages,
+        "failed": sum(1 for r in results if not r[1]),
+        "wall_s": round(wall, 3),
+        "docs_per_s": round(len(docs) / wall, 2),
+        "pages_per_s": round(total_pages / wall, 2),
+        "latency_p50_s": round(statistics.median(lat), 3),
+        "latency_p95_s": round(p95, 3),
+        "serial_provider_estimate_s": round(len(docs) * args.pages * args.scanned * args.latency, 3),
+        "engine": ocr_engine.metrics(),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# ocr_cache.py — content-hash cache for OCR.Space results (memory + disk, with TTL)
+import os, json, time, hashlib, tempfile, threading, logging
+from collections import OrderedDict
+
+# ENV:
+#   OCR_CACHE_DIR=/var/cache/ocr       (disk tier; default <tmp>/ocr_cache, empty string disables)
+#   OCR_CACHE_TTL_S=604800             (entry lifetime; default 7 days)
+#   OCR_CACHE_MEM_ITEMS=256            (in-process LRU size)
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ocr_cache"))
+OCR_CACHE_TTL_S = int(os.getenv("OCR_CACHE_TTL_S", str(7 * 24 * 3600)))
+OCR_CACHE_MEM_ITEMS = int(os.getenv("OCR_CACHE_MEM_ITEMS", "256"))
+
+log = logging.getLogger("ocr-cache")
+
+_MEM: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (stored_at, result_json)
+_LOCK = threading.Lock()
+_STATS = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+
+
+def cache_key(data: bytes, **options) -> str:
+    """
+    SHA-256 over the file bytes plus every provider option that changes the output
+    (language, engine, isTable, overlay, scale, detectOrientation...). None values are dropped.
+    """
+    h = hashlib.sha256(data or b"")
+    opts = {k: str(v).strip().lower() for k, v in options.items() if v is not None}
+    h.update(json.dumps(opts, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _disk_path(key: str):
+    if not OCR_CACHE_DIR:
+        return None
+    return os.path.join(OCR_CACHE_DIR, key[:2], f"{key}.json")
+
+
+def _mem_put(key: str, stored_at: float, value: dict):
+    with _LOCK:
+        _MEM[key] = (stored_at, value)
+        _MEM.move_to_end(key)
+        while len(_MEM) > OCR_CACHE_MEM_ITEMS:
+            _MEM.popitem(last=False)
+
+
+def get(key: str):
+    """Return the cached provider result for `key`, or None (expired entries are dropped)."""
+    now = time.time()
+    with _LOCK:
+        hit = _MEM.get(key)
+        if hit and now - hit[0] <= OCR_CACHE_TTL_S:
+            _MEM.move_to_end(key)
+            _STATS["mem_hits"] += 1
+            return hit[1]
+        if hit:
+            _MEM.pop(key, None)
+
+    path = _disk_path(key)
+    if path and os.path.exists(path):
+        try:
+            stored_at = os.path.getmtime(path)
+            if now - stored_at > OCR_CACHE_TTL_S:
+                os.remove(path)
+            else:
+                with open(path, "r", encoding="utf-8") as fh:
+                    value = json.load(fh)
+                _mem_put(key, stored_at, value)
+                with _LOCK:
+                    _STATS["disk_hits"] += 1
+                return value
+        except Exception as e:
+            log.warning(f"OCR cache read failed for {key[:12]}: {e}")
+
+    with _LOCK:
+        _STATS["misses"] += 1
+    return None
+
+
+def put(key: str, value: dict):
+    """Store a successful provider result in both tiers (disk write is atomic)."""
+    now = time.time()
+    _mem_put(key, now, value)
+    with _LOCK:
+        _STATS["writes"] += 1
+    path = _disk_path(key)
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(value, fh, ensure_ascii=False)
+        os.replace(tmp, path)
+    except Exception as e:
+        log.warning(f"OCR cache write failed for {key[:12]}: {e}")
+
+
+def stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+        out["mem_items"] = len(_MEM)
+    lookups = out["mem_hits"] + out["disk_hits"] + out["misses"]
+    out["hit_rate"] = round((out["mem_hits"] + out["disk_hits"]) / lookups, 4) if lookups else 0.0
+    return out
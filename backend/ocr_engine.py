@@ -0,0 +1,525 @@
+# ocr_engine.py — one OCR pipeline for app.py (/ocr, /api/ocr, /api/ocr/jobs) and ocr_routes.ocr_bp
+#
+# Pipeline: content-hash cache -> image prep -> PDF text layer -> provider (page-split for multi-page scans)
+# Providers share one interface and return OCR.Space-shaped JSON:
+#   {"ParsedResults": [{"ParsedText": "..."}...], "IsErroredOnProcessing": bool, "ErrorMessage": ...}
+import os, io, time, random, threading, logging, mimetypes
+from abc import ABC, abstractmethod
+import os.path as osp
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.utils import secure_filename
+
+import ocr_cache
+import image_prep
+
+# ENV:
+#   OCR_PROVIDER=ocrspace             (ocrspace | textlayer | fake)
+#   OCR_SPACE_API_KEY=your_key
+#   OCR_SPACE_URL=https://api.ocr.space/parse/image
+#   OCR_PROVIDER_LIMIT_MB=1           (Free=1, PRO=5, PRO PDF=100+)
+#   OCR_CONNECT_TIMEOUT_S=10  OCR_READ_TIMEOUT_S=180
+#   OCR_HTTP_POOL=16                  (pooled keep-alive connections to the provider)
+#   OCR_PDF_MIN_CHARS=40              (alnum chars for a PDF page to count as "has text")
+#   OCR_PAGE_WORKERS=4  OCR_PAGE_RETRIES=2  OCR_PAGES_PER_CHUNK=1
+#   OCR_FAKE_LATENCY_S=0.05  OCR_FAKE_FAIL_RATE=0   (fake provider, for load tests / offline benchmarks)
+OCR_PROVIDER = os.getenv("OCR_PROVIDER", "ocrspace").strip().lower()
+OCR_SPACE_API_KEY = os.getenv("OCR_SPACE_API_KEY")
+OCR_SPACE_URL = os.getenv("OCR_SPACE_URL", "https://api.ocr.space/parse/image")
+PROVIDER_LIMIT_MB = int(os.getenv("OCR_PROVIDER_LIMIT_MB", "1"))
+OCR_CONNECT_TIMEOUT_S = float(os.getenv("OCR_CONNECT_TIMEOUT_S", "10"))
+OCR_READ_TIMEOUT_S = float(os.getenv("OCR_READ_TIMEOUT_S", "180"))
+OCR_HTTP_POOL = int(os.getenv("OCR_HTTP_POOL", "16"))
+OCR_PDF_MIN_CHARS = int(os.getenv("OCR_PDF_MIN_CHARS", "40"))
+OCR_PAGE_WORKERS = int(os.getenv("OCR_PAGE_WORKERS", "4"))
+OCR_PAGE_RETRIES = int(os.getenv("OCR_PAGE_RETRIES", "2"))
+OCR_PAGES_PER_CHUNK = max(1, int(os.getenv("OCR_PAGES_PER_CHUNK", "1")))
+
+log = logging.getLogger("ocr-engine")
+
+# Expand mimetypes so we don't default to image/png for everything
+mimetypes.add_type("application/pdf", ".pdf")
+mimetypes.add_type("image/jpeg", ".jpg")
+mimetypes.add_type("image/jpeg", ".jpeg")
+mimetypes.add_type("image/png", ".png")
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/tiff", ".tif")
+mimetypes.add_type("image/tiff", ".tiff")
+mimetypes.add_type("image/bmp", ".bmp")
+mimetypes.add_type("image/gif", ".gif")
+mimetypes.add_type("image/heic", ".heic")
+mimetypes.add_type("image/heif", ".heif")
+
+# Accept **all common images + PDF** (no “png-only” behavior)
+ALLOWED_EXTS = {
+    "pdf", "png", "jpg", "jpeg", "webp", "tif", "tiff", "bmp", "gif", "heic", "heif"
+}
+REJECTED_PREFIXES = ("video/", "audio/")
+
+
+class OcrFailure(Exception):
+    """OCR produced no usable text; carries the HTTP status + extra fields for _json_error."""
+    def __init__(self, message, status=502, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+_METRICS_LOCK = threading.Lock()
+_METRICS = {
+    "documents": 0, "cache_hits": 0, "failures": 0,
+    "text_layer_pages": 0, "provider_pages": 0,
+    "provider_calls": 0, "provider_errors": 0, "provider_retries": 0,
+    "provider_bytes": 0, "provider_seconds": 0.0, "document_seconds": 0.0,
+    "image_prep_bytes_saved": 0,
+}
+
+
+def _count(key: str, n=1):
+    with _METRICS_LOCK:
+        _METRICS[key] += n
+
+
+def metrics() -> dict:
+    with _METRICS_LOCK:
+        out = dict(_METRICS)
+    calls, docs = out["provider_calls"], out["documents"]
+    out["provider_avg_s"] = round(out["provider_seconds"] / calls, 4) if calls else 0.0
+    out["document_avg_s"] = round(out["document_seconds"] / docs, 4) if docs else 0.0
+    out["provider"] = provider().name
+    out["cache"] = ocr_cache.stats()
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+def guess_mimetype(filename: str, fallback: str = None) -> str:
+    ext = (osp.splitext(filename)[1] or "").lower()
+    if not ext:
+        return fallback or "application/octet-stream"
+    mime, _ = mimetypes.guess_type(filename)
+    return mime or fallback or "application/octet-stream"
+
+
+def is_pdf(ext: str, mimetype: str = None) -> bool:
+    return (ext or "").lower() == "pdf" or (mimetype or "") == "application/pdf"
+
+
+def aggregate_parsed_text(result_json):
+    """Combine text across OCR.Space pages; return (text, page_count)."""
+    if result_json.get("IsErroredOnProcessing") or "ParsedResults" not in result_json:
+        return None, 0
+    pages = result_json.get("ParsedResults") or []
+    texts = []
+    for p in pages:
+        t = (p or {}).get("ParsedText", "")
+        if t:
+            texts.append(t)
+    return ("\n\n".join(texts).strip(), len(pages))
+
+
+def pdf_text_layer(pdf_bytes: bytes):
+    """
+    Return the embedded text per page, with None for pages that look scanned.
+    Returns None when PyMuPDF is unavailable or the bytes are not a readable PDF.
+    """
+    try:
+        import fitz  # PyMuPDF
+    except ImportError:
+        return None
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except Exception:
+        return None
+    pages = []
+    with doc:
+        if doc.needs_pass:
+            return None
+        for page in doc:
+            t = (page.get_text("text") or "").strip()
+            usable = sum(ch.isalnum() for ch in t) >= OCR_PDF_MIN_CHARS
+            pages.append(t if usable else None)
+    return pages
+
+
+def pdf_subset(pdf_bytes: bytes, page_indexes: List[int]) -> bytes:
+    """Build a new PDF holding only `page_indexes` (in order)."""
+    import fitz
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as src, fitz.open() as out:
+        for i in page_indexes:
+            out.insert_pdf(src, from_page=i, to_page=i)
+        return out.tobytes(garbage=3, deflate=True)
+
+
+def merge_text_layer(layer: list, provider_result: dict = None, scanned: List[int] = None) -> dict:
+    """
+    Build an OCR.Space-shaped result (so aggregate_parsed_text / the cache work unchanged),
+    filling scanned pages from the provider's ParsedResults in order.
+    """
+    provider_pages = (provider_result or {}).get("ParsedResults") or []
+    by_index = dict(zip(scanned or [], provider_pages))
+    parsed = []
+    for i, t in enumerate(layer):
+        if t is not None:
+            parsed.append({"ParsedText": t, "TextSource": "text-layer"})
+        else:
+            p = by_index.get(i) or {}
+            parsed.append({"ParsedText": p.get("ParsedText", ""), "TextSource": "provider"})
+    return {
+        "ParsedResults": parsed,
+        "IsErroredOnProcessing": False,
+        "TextLayerPages": sum(1 for t in layer if t is not None),
+        "ProviderPages": len(scanned or []),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Providers
+# ---------------------------------------------------------------------------
+class OcrProvider(ABC):
+    """
+    Interface: ocr(data, filename, mimetype, **options) -> OCR.Space-shaped dict.
+    Network/transport problems raise requests exceptions; unparseable replies raise RuntimeError.
+    """
+    name = "base"
+    configured = True
+
+    @abstractmethod
+    def ocr(self, data: bytes, filename: str, mimetype: str, language="eng", overlay="false", engine="2",
+            is_table=None, scale=None, detect_orientation=None) -> dict:
+        ...
+
+
+class OcrSpaceProvider(OcrProvider):
+    name = "ocrspace"
+
+    def __init__(self, api_key: Optional[str] = None, url: str = OCR_SPACE_URL):
+        self.api_key = api_key if api_key is not None else OCR_SPACE_API_KEY
+        self.url = url
+        self.configured = bool(self.api_key)
+        # One keep-alive pool per process instead of a fresh TLS handshake per upload/page
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=OCR_HTTP_POOL, pool_maxsize=OCR_HTTP_POOL)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def ocr(self, data: bytes, filename: str, mimetype: str, language="eng", overlay="false", engine="2",
+            is_table=None, scale=None, detect_orientation=None) -> dict:
+        form = {
+            "apikey": self.api_key,
+            "language": language,
+            "isOverlayRequired": overlay,
+            "OCREngine": engine,  # "1" or "2"
+        }
+        if is_table is not None:
+            form["isTable"] = is_table
+        if scale is not None:
+            form["scale"] = scale
+        if detect_orientation is not None:
+            form["detectOrientation"] = detect_orientation
+
+        resp = self.session.post(
+            self.url,
+            files={"file": (filename, io.BytesIO(data), mimetype)},
+            data=form,
+            timeout=(OCR_CONNECT_TIMEOUT_S, OCR_READ_TIMEOUT_S),
+            headers={"Accept": "application/json"},
+        )
+        content_type = resp.headers.get("Content-Type", "")
+        try:
+            return resp.json()
+        except ValueError:
+            snippet = (resp.text or "").strip()[:300]
+            raise RuntimeError(
+                f"OCR provider returned non-JSON response (status {resp.status_code}, ct {content_type}). "
+                f"Snippet: {snippet}"
+            )
+
+
+class TextLayerProvider(OcrProvider):
+    """Local-only: PDF text layer, no network. Scanned pages / images come back empty."""
+    name = "textlayer"
+
+    def ocr(self, data: bytes, filename: str, mimetype: str, **options) -> dict:
+        layer = pdf_text_layer(data) if is_pdf(osp.splitext(filename)[1].lstrip("."), mimetype) else None
+        if not layer:
+            return {"IsErroredOnProcessing": True, "ErrorMessage": "No embedded text layer"}
+        return {
+            "ParsedResults": [{"ParsedText": t or ""} for t in layer],
+            "IsErroredOnProcessing": False,
+        }
+
+
+class FakeProvider(OcrProvider):
+    """Deterministic stand-in for load tests and offline benchmarks (no network, no key)."""
+    name = "fake"
+
+    def __init__(self, latency_s: float = None, fail_rate: float = None):
+        self.latency_s = float(os.getenv("OCR_FAKE_LATENCY_S", "0.05")) if latency_s is None else latency_s
+        self.fail_rate = float(os.getenv("OCR_FAKE_FAIL_RATE", "0")) if fail_rate is None else fail_rate
+
+    def ocr(self, data: bytes, filename: str, mimetype: str, **options) -> dict:
+        n_pages = 1
+        if mimetype == "application/pdf":
+            try:
+                import fitz
+                with fitz.open(stream=data, filetype="pdf") as doc:
+                    n_pages = doc.page_count
+            except Exception:
+                pass
+        time.sleep(self.latency_s * n_pages)
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise requests.exceptions.ConnectionError("fake provider: injected failure")
+        return {
+            "ParsedResults": [
+                {"ParsedText": f"FAKE OCR {filename} page {i + 1} ({len(data)} bytes)"} for i in range(n_pages)
+            ],
+            "IsErroredOnProcessing": False,
+        }
+
+
+PROVIDERS = {"ocrspace": OcrSpaceProvider, "textlayer": TextLayerProvider, "fake": FakeProvider}
+_PROVIDER = None
+
+
+def provider() -> OcrProvider:
+    """Process-wide provider selected by OCR_PROVIDER (created lazily, shared by all routes)."""
+    global _PROVIDER
+    if _PROVIDER is None:
+        _PROVIDER = PROVIDERS.get(OCR_PROVIDER, OcrSpaceProvider)()
+    return _PROVIDER
+
+
+def set_provider(p: OcrProvider):
+    """Swap the provider (tests, benchmarks)."""
+    global _PROVIDER
+    _PROVIDER = p
+
+
+def _call_provider(prov: OcrProvider, data: bytes, filename: str, mimetype: str, opts: dict) -> dict:
+    t0 = time.time()
+    _count("provider_calls")
+    _count("provider_bytes", len(data))
+    try:
+        return prov.ocr(
+            data, secure_filename(filename) or "upload", mimetype,
+            language=opts["language"], overlay=opts["overlay"], engine=opts["engine"],
+            is_table=opts.get("is_table"), scale=opts.get("scale"), detect_orientation=opts.get("detect_orientation"),
+        )
+    except Exception:
+        _count("provider_errors")
+        raise
+    finally:
+        _count("provider_seconds", time.time() - t0)
+
+
+# ---------------------------------------------------------------------------
+# Parallel page-split for multi-page PDFs
+# ---------------------------------------------------------------------------
+# Each page (or small page range) is uploaded as its own PDF, so the plan limit applies per chunk
+# and a long document takes about as long as its slowest page.
+PAGE_POOL = ThreadPoolExecutor(max_workers=OCR_PAGE_WORKERS, thread_name_prefix="ocr-page")
+
+
+def _ocr_pdf_chunk(prov: OcrProvider, pdf_bytes: bytes, pages: List[int], filename: str, opts: dict):
+    """OCR one page range with retries; returns the provider ParsedResults for those pages."""
+    chunk = pdf_subset(pdf_bytes, pages)
+    provider_limit = PROVIDER_LIMIT_MB * 1024 * 1024
+    if len(chunk) > provider_limit:
+        raise RuntimeError(
+            f"Page {pages[0] + 1} exceeds your OCR plan limit ({PROVIDER_LIMIT_MB}MB) even after splitting."
+        )
+    stem = osp.splitext(filename or "upload")[0]
+    name = f"{stem}_p{pages[0] + 1}.pdf"
+    last_err = None
+    for attempt in range(OCR_PAGE_RETRIES + 1):
+        if attempt:
+            _count("provider_retries")
+            time.sleep(0.5 * (2 ** (attempt - 1)) + random.random() * 0.25)
+        try:
+            result = _call_provider(prov, chunk, name, "application/pdf", opts)
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            last_err = str(e)
+            continue
+        text, _ = aggregate_parsed_text(result)
+        if text is None:
+            last_err = result.get("ErrorMessage") or "No detailed message"
+            continue
+        parsed = list(result.get("ParsedResults") or [])
+        # keep positions aligned with the requested pages even if the provider drops one
+        parsed += [{"ParsedText": ""}] * (len(pages) - len(parsed))
+        return parsed[:len(pages)]
+    raise RuntimeError(f"OCR failed on page {pages[0] + 1} after {OCR_PAGE_RETRIES + 1} attempts: {last_err}")
+
+
+def ocr_pdf_pages_parallel(prov: OcrProvider, pdf_bytes: bytes, page_indexes: List[int], filename: str,
+                           opts: dict, on_chunk=None) -> dict:
+    """
+    OCR the given PDF pages concurrently (bounded by OCR_PAGE_WORKERS) and return an
+    OCR.Space-shaped result whose ParsedResults follow `page_indexes` order.
+    `on_chunk(n_pages)` fires as each chunk finishes (completion order).
+    """
+    chunks = [page_indexes[i:i + OCR_PAGES_PER_CHUNK] for i in range(0, len(page_indexes), OCR_PAGES_PER_CHUNK)]
+    futures = []
+    for pages in chunks:
+        fut = PAGE_POOL.submit(_ocr_pdf_chunk, prov, pdf_bytes, pages, filename, opts)
+        if on_chunk:
+            fut.add_done_callback(
+                lambda f, n=len(pages): on_chunk(n) if not f.cancelled() and f.exception() is None else None
+            )
+        futures.append(fut)
+    parsed = []
+    try:
+        for fut in futures:
+            parsed.extend(fut.result())
+    finally:
+        for fut in futures:
+            fut.cancel()
+    return {"ParsedResults": parsed, "IsErroredOnProcessing": False}
+
+
+# ---------------------------------------------------------------------------
+# Engine entry point
+# ---------------------------------------------------------------------------
+def run(file_bytes: bytes, filename: str, ext: str, mimetype: str, opts: dict,
+        session_id: str = "", on_progress=None, prov: OcrProvider = None) -> dict:
+    """
+    Cache -> image prep -> PDF text layer -> provider (page-split for multi-page scans).
+    Works on plain bytes so it can run inside a request or a background job.
+    `opts` needs language/overlay/engine (is_table/scale/detect_orientation optional).
+    `on_progress(done_pages, total_pages)` is called as pages become available.
+    Returns {text, pages, mimetype, cached, result, prep}; raises OcrFailure.
+    """
+    prov = prov or provider()
+    t_start = time.time()
+    _count("documents")
+    progress = on_progress or (lambda done, total: None)
+    try:
+        return _run(prov, file_bytes, filename, ext, mimetype, opts, session_id, progress)
+    except OcrFailure:
+        _count("failures")
+        raise
+    finally:
+        _count("document_seconds", time.time() - t_start)
+
+
+def _run(prov, file_bytes, filename, ext, mimetype, opts, session_id, progress):
+    language, overlay, engine = opts["language"], opts["overlay"], opts["engine"]
+
+    # ---- content-hash cache (same bytes + options => same text) ----
+    cache_key = ocr_cache.cache_key(
+        file_bytes, language=language, engine=engine, isTable=opts.get("is_table"),
+        overlay=overlay, scale=opts.get("scale"), detectOrientation=opts.get("detect_orientation"),
+    )
+    result = ocr_cache.get(cache_key)
+    cached = result is not None
+
+    prep = None
+    if not cached:
+        # ---- photos: fix orientation, downscale + recompress to fit the provider plan ----
+        if (mimetype or "").startswith("image/") and not is_pdf(ext, mimetype):
+            file_bytes, mimetype, prep = image_prep.prepare_image(file_bytes, mimetype, "ocr")
+            if prep["changed"]:
+                ext = "jpg"
+                filename = osp.splitext(filename)[0] + ".jpg"
+                _count("image_prep_bytes_saved", prep["bytes_before"] - prep["bytes_after"])
+                log.info(
+                    "OCR image prep: session_id=%s %s -> %s bytes",
+                    session_id, prep["bytes_before"], prep["bytes_after"]
+                )
+
+        # ---- PDF text layer first; only scanned pages go to the provider ----
+        layer = pdf_text_layer(file_bytes) if is_pdf(ext, mimetype) else None
+        scanned = [i for i, t in enumerate(layer or []) if t is None]
+        total = len(layer) if layer else 1
+        if layer:
+            _count("text_layer_pages", total - len(scanned))
+            progress(total - len(scanned), total)
+
+        upload_bytes = file_bytes
+        if layer and scanned:
+            upload_bytes = pdf_subset(file_bytes, scanned)
+            mimetype = "application/pdf"
+
+        if layer and not scanned:
+            result, forced_mime = merge_text_layer(layer), "application/pdf"
+            log.info("OCR text-layer hit: session_id=%s pages=%s", session_id, len(layer))
+        elif layer and len(scanned) > 1:
+            # ---- multi-page scans: split locally, OCR pages concurrently, reassemble in order ----
+            t0 = time.time()
+            done = [total - len(scanned)]
+            done_lock = threading.Lock()
+
+            def _on_chunk(n):
+                with done_lock:
+                    done[0] += n
+                    progress(done[0], total)
+
+            try:
+                result = ocr_pdf_pages_parallel(prov, file_bytes, scanned, filename, opts, on_chunk=_on_chunk)
+            except RuntimeError as e:
+                log.error("OCR page-split failed: %s", e)
+                raise OcrFailure(str(e), 502)
+            _count("provider_pages", len(scanned))
+            result, forced_mime = merge_text_layer(layer, result, scanned), "application/pdf"
+            log.info(
+                "OCR page-split: session_id=%s pages=%s took=%.2fs", session_id, len(scanned), time.time() - t0
+            )
+        else:
+            provider_limit = PROVIDER_LIMIT_MB * 1024 * 1024
+            if len(upload_bytes) > provider_limit:
+                # Provider free plans are small; let clients see a helpful message
+                raise OcrFailure(
+                    f"File exceeds your OCR plan limit ({PROVIDER_LIMIT_MB}MB). "
+                    f"Please compress the file or upgrade your OCR plan.",
+                    413, provider_limit_mb=PROVIDER_LIMIT_MB
+                )
+
+            # ---- provider call (works for PDF + image types) ----
+            # Prefer the browser/werkzeug-detected mimetype; otherwise guess by extension
+            forced_mime = mimetype or guess_mimetype(filename, "application/octet-stream")
+            try:
+                result = _call_provider(prov, upload_bytes, filename or f"upload.{ext or 'bin'}", forced_mime, opts)
+            except requests.exceptions.RequestException as e:
+                log.exception("OCR provider network error")
+                raise OcrFailure("OCR request failed", 502, detail=str(e))
+            except RuntimeError as e:
+                log.error("OCR provider returned non-JSON/HTML error: %s", e)
+                raise OcrFailure(str(e), 502)
+
+            _count("provider_pages", len(scanned) or 1)
+            if layer and aggregate_parsed_text(result)[0] is not None:
+                result = merge_text_layer(layer, result, scanned)
+            progress(total, total)
+    else:
+        _count("cache_hits")
+        forced_mime = mimetype or guess_mimetype(filename, "application/octet-stream")
+        log.info("OCR cache hit: session_id=%s key=%s", session_id, cache_key[:12])
+
+    # ---- parse / validate provider response ----
+    text, pages = aggregate_parsed_text(result)
+    if text and not cached:
+        ocr_cache.put(cache_key, result)
+    if text is None:
+        log.error("OCR provider error payload: %s", result)
+        raise OcrFailure(
+            "OCR failed",
+            400,
+            message=result.get("ErrorMessage", "No detailed message"),
+            details=result
+        )
+    if not text:
+        log.warning("OCR succeeded but empty text")
+        raise OcrFailure("OCR succeeded but returned no text", 502, provider=result)
+    if cached:
+        progress(pages, pages)
+
+    return {"text": text, "pages": pages, "mimetype": forced_mime, "cached": cached, "result": result, "prep": prep}
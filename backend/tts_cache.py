@@ -0,0 +1,120 @@
+# tts_cache.py — content-hash cache for synthesized speech (memory LRU by bytes + disk, with TTL)
+import os, time, hashlib, tempfile, threading, logging
+from collections import OrderedDict
+
+# ENV:
+#   TTS_CACHE_DIR=/var/cache/tts       (disk tier; default <tmp>/tts_cache, empty string disables)
+#   TTS_CACHE_TTL_S=2592000            (entry lifetime; default 30 days)
+#   TTS_CACHE_MEM_MB=64                (in-process LRU size, audio bytes)
+#   TTS_CACHE_MAX_CHARS=2000           (longer inputs are never cached: unlikely to repeat)
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tts_cache"))
+TTS_CACHE_TTL_S = int(os.getenv("TTS_CACHE_TTL_S", str(30 * 24 * 3600)))
+TTS_CACHE_MEM_BYTES = int(float(os.getenv("TTS_CACHE_MEM_MB", "64")) * 1024 * 1024)
+TTS_CACHE_MAX_CHARS = int(os.getenv("TTS_CACHE_MAX_CHARS", "2000"))
+
+log = logging.getLogger("tts-cache")
+
+_MEM: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (stored_at, audio_bytes)
+_MEM_BYTES = 0
+_LOCK = threading.Lock()
+_STATS = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+
+
+def cache_key(text: str, **options):
+    """
+    SHA-256 over the whitespace-normalized text plus model/voice/format. None when the text is too long
+    to be worth caching.
+    """
+    norm = " ".join((text or "").split())
+    if not norm or len(norm) > TTS_CACHE_MAX_CHARS:
+        return None
+    h = hashlib.sha256(norm.encode("utf-8"))
+    for k in sorted(options):
+        h.update(f"|{k}={options[k]}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _disk_path(key: str):
+    if not TTS_CACHE_DIR:
+        return None
+    return os.path.join(TTS_CACHE_DIR, key[:2], f"{key}.mp3")
+
+
+def _mem_put(key: str, stored_at: float, audio: bytes):
+    global _MEM_BYTES
+    with _LOCK:
+        old = _MEM.pop(key, None)
+        if old:
+            _MEM_BYTES -= len(old[1])
+        _MEM[key] = (stored_at, audio)
+        _MEM_BYTES += len(audio)
+        while _MEM_BYTES > TTS_CACHE_MEM_BYTES and len(_MEM) > 1:
+            _, (_, gone) = _MEM.popitem(last=False)
+            _MEM_BYTES -= len(gone)
+
+
+def get(key):
+    """Cached audio bytes for `key`, or None (expired entries are dropped)."""
+    if not key:
+        return None
+    global _MEM_BYTES
+    now = time.time()
+    with _LOCK:
+        hit = _MEM.get(key)
+        if hit and now - hit[0] <= TTS_CACHE_TTL_S:
+            _MEM.move_to_end(key)
+            _STATS["mem_hits"] += 1
+            return hit[1]
+        if hit:
+            _MEM.pop(key, None)
+            _MEM_BYTES -= len(hit[1])
+
+    path = _disk_path(key)
+    if path and os.path.exists(path):
+        try:
+            stored_at = os.path.getmtime(path)
+            if now - stored_at > TTS_CACHE_TTL_S:
+                os.remove(path)
+            else:
+                with open(path, "rb") as fh:
+                    audio = fh.read()
+                _mem_put(key, stored_at, audio)
+                with _LOCK:
+                    _STATS["disk_hits"] += 1
+                return audio
+        except Exception as e:
+            log.warning(f"TTS cache read failed for {key[:12]}: {e}")
+
+    with _LOCK:
+        _STATS["misses"] += 1
+    return None
+
+
+def put(key, audio: bytes):
+    """Store complete audio in both tiers (disk write is atomic)."""
+    if not key or not audio:
+        return
+    _mem_put(key, time.time(), audio)
+    with _LOCK:
+        _STATS["writes"] += 1
+    path = _disk_path(key)
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(audio)
+        os.replace(tmp, path)
+    except Exception as e:
+        log.warning(f"TTS cache write failed for {key[:12]}: {e}")
+
+
+def stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+        out["mem_items"] = len(_MEM)
+        out["mem_bytes"] = _MEM_BYTES
+    lookups = out["mem_hits"] + out["disk_hits"] + out["misses"]
+    out["hit_rate"] = round((out["mem_hits"] + out["disk_hits"]) / lookups, 4) if lookups else 0.0
+    return out
@@ -0,0 +1,140 @@
+# vision_files.py — upload-once image handles for the two-phase /vision/analyze flow
+#
+# Phase A uploads the prepared image once (provider Files API, purpose="vision"); phase A and phase B both
+# reference it by file_id, so the image crosses the wire once and no data URL is held between phases.
+# Identical images (same SHA-256) reuse the live handle, which restarts its TTL.
+# VISION_FILES_LOCAL=1 swaps in LocalFiles: bytes stay in process and are inlined per request
+# (tests / deployments without a files endpoint).
+import os, time, base64, hashlib, threading, logging, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+# ENV:
+#   VISION_FILES_LOCAL=0
+#   VISION_FILES_TTL_S=3600     (handles unused for this long are deleted; phase B must come before)
+#   VISION_FILES_MAX=512        (live handles kept; oldest deleted first)
+VISION_FILES_LOCAL = os.getenv("VISION_FILES_LOCAL", "0").lower() in ("1", "true", "yes")
+VISION_FILES_TTL_S = int(os.getenv("VISION_FILES_TTL_S", "3600"))
+VISION_FILES_MAX = int(os.getenv("VISION_FILES_MAX", "512"))
+
+log = logging.getLogger("vision-files")
+
+
+class LocalFiles:
+    """Stand-in for client.files: create/delete plus data_url() for inlining."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blobs: dict = {}   # file_id -> (bytes, mimetype)
+
+    def create(self, file, purpose="vision"):
+        name, data, mimetype = file
+        fid = f"local-{uuid.uuid4().hex[:16]}"
+        with self._lock:
+            self._blobs[fid] = (bytes(data), mimetype)
+        return SimpleNamespace(id=fid, filename=name, purpose=purpose, bytes=len(data))
+
+    def delete(self, file_id):
+        with self._lock:
+            self._blobs.pop(file_id, None)
+
+    def data_url(self, file_id):
+        with self._lock:
+            blob = self._blobs.get(file_id)
+        if blob is None:
+            return None
+        return f"data:{blob[1]};base64,{base64.b64encode(blob[0]).decode('ascii')}"
+
+
+LOCAL = LocalFiles()
+
+_LOCK = threading.Lock()
+_HANDLES: "OrderedDict[str, dict]" = OrderedDict()  # sha256 -> {"file_id", "bytes", "mimetype", "created_at", "local"}
+_STATS = {"uploads": 0, "reuses": 0, "bytes_uploaded": 0, "bytes_reused": 0, "deleted": 0,
+          "requests": 0, "request_bytes": 0}
+_GC_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vision-files-gc")
+
+
+def _files(client):
+    return LOCAL if VISION_FILES_LOCAL or client is None else client.files
+
+
+def _delete(client, h: dict):
+    try:
+        (LOCAL if h["local"] else client.files).delete(h["file_id"])
+        with _LOCK:
+            _STATS["deleted"] += 1
+    except Exception as e:
+        log.warning(f"vision file delete failed ({h['file_id']}): {e}")
+
+
+def prune(client):
+    """Drop expired (and over-cap) handles; provider deletes run in the background."""
+    now = time.time()
+    gone = []
+    with _LOCK:
+        for sha, h in list(_HANDLES.items()):
+            if now - h["created_at"] > VISION_FILES_TTL_S or len(_HANDLES) > VISION_FILES_MAX:
+                gone.append(_HANDLES.pop(sha))
+    for h in gone:
+        _GC_POOL.submit(_delete, client, h)
+    return len(gone)
+
+
+def upload(client, data: bytes, mimetype: str, filename: str = "image.jpg") -> dict:
+    """Handle for the image bytes: {"file_id", "sha256", "bytes", "mimetype", "local", "reused"}."""
+    sha = hashlib.sha256(data).hexdigest()
+    with _LOCK:
+        h = _HANDLES.get(sha)
+        if h and time.time() - h["created_at"] <= VISION_FILES_TTL_S:
+            # a new study starts its own TTL window on the shared handle (prune counts from here)
+            h["created_at"] = time.time()
+            _HANDLES.move_to_end(sha)
+            _STATS["reuses"] += 1
+            _STATS["bytes_reused"] += len(data)
+            return dict(h, sha256=sha, reused=True)
+    files = _files(client)
+    f = files.create(file=(filename, data, mimetype), purpose="vision")
+    h = {"file_id": f.id, "bytes": len(data), "mimetype": mimetype, "created_at": time.time(),
+         "local": files is LOCAL}
+    with _LOCK:
+        _HANDLES[sha] = h
+        _STATS["uploads"] += 1
+        _STATS["bytes_uploaded"] += len(data)
+    return dict(h, sha256=sha, reused=False)
+
+
+def alive(file_id: str) -> bool:
+    with _LOCK:
+        return any(h["file_id"] == file_id for h in _HANDLES.values())
+
+
+def image_part(handle: dict, detail: str | None = None) -> dict:
+    """Responses API input_image part referencing the handle (inlined only for local handles)."""
+    part = {"type": "input_image"}
+    if handle.get("local"):
+        url = LOCAL.data_url(handle["file_id"])
+        if url is None:
+            raise KeyError(f"Unknown local file {handle['file_id']}")
+        part["image_url"] = url
+    else:
+        part["file_id"] = handle["file_id"]
+    if detail:
+        part["detail"] = detail
+    return part
+
+
+def record_request(payload_bytes: int):
+    """Account one model request's serialized input size (bytes sent per study)."""
+    with _LOCK:
+        _STATS["requests"] += 1
+        _STATS["request_bytes"] += int(payload_bytes)
+
+
+def stats() -> dict:
+    with _LOCK:
+        out = dict(_STATS)
+        out["live_handles"] = len(_HANDLES)
+    out["local"] = VISION_FILES_LOCAL
+    return out